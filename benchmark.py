@@ -0,0 +1,364 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Conversion benchmark on synthetic data shaped like the HC_PACIENTES and EINSTEIN_Exames tables.
+
+The data is generated from a seed, so that every run (and every machine) converts the same rows. Every
+configuration is measured in a fresh process, so that the peak memory of one does not hide that of the
+next. The results are written as JSON, and can be compared with those of an earlier run:
+
+    python benchmark.py --table exames --rows 100000 --processes 1 2 4 --chunksize 1000 5000 --output new.json --baseline old.json
+"""
+
+from src.converter.csvw import CSVWConverter
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import datetime
+import argparse
+import platform
+import resource
+import subprocess
+import unicodecsv as csv
+
+BASE = 'https://repositoriodatasharingfapesp.uspdigital.usp.br/'
+
+# The csvw terms used by the schemas below, so that they do not depend on fetching the remote context. As in that
+# context, the names of the builtin datatypes (such as "string", which build_schema writes for text columns) stand
+# for the xsd datatypes; otherwise they would be read as terms of the csvw vocabulary.
+CSVW_CONTEXT = {
+    "@vocab": "http://www.w3.org/ns/csvw#",
+    "csvw": "http://www.w3.org/ns/csvw#",
+    "xsd": "http://www.w3.org/2001/XMLSchema#",
+    "dc": "http://purl.org/dc/terms/",
+    "columns": {"@id": "csvw:column", "@container": "@list"},
+    "url": {"@id": "csvw:url", "@type": "@id"},
+    "datatype": {"@id": "csvw:datatype", "@type": "@vocab"},
+    "null": {"@id": "csvw:null"},
+    "primaryKey": {"@id": "csvw:primaryKey"},
+    "virtual": {"@id": "csvw:virtual", "@type": "xsd:boolean"},
+    "string": "xsd:string",
+    "boolean": "xsd:boolean",
+    "gYear": "xsd:gYear",
+    "integer": "xsd:integer",
+    "decimal": "xsd:decimal",
+    "date": "xsd:date",
+    "dateTime": "xsd:dateTime",
+    "anyURI": "xsd:anyURI"
+}
+
+EXAMES = [
+    ('Hemograma', ['Hemoglobina', 'Hematócrito', 'Leucócitos', 'Plaquetas'], ['g/dL', '%', '/mm3', '/mm3']),
+    ('Função renal', ['Uréia', 'Creatinina'], ['mg/dL', 'mg/dL']),
+    ('Eletrólitos', ['Sódio', 'Potássio', 'Cálcio iônico'], ['mEq/L', 'mEq/L', 'mmol/L']),
+    ('Proteína C reativa', ['Proteína C reativa'], ['mg/L']),
+    ('Glicose', ['Glicose'], ['mg/dL']),
+    ('Dímero D', ['Dímero D'], ['ng/mL']),
+    ('Gasometria venosa', ['pH', 'pCO2', 'Bicarbonato'], ['', 'mmHg', 'mmol/L']),
+    ('SARS-CoV-2 (COVID-19), PCR', ['Covid 19, Detecção por PCR'], ['']),
+    ('SARS-CoV-2 (COVID-19), Anticorpos IgG', ['Covid 19, Anticorpos IgG, Elisa'], [''])
+]
+
+ORIGENS = ['LAB', 'HOSP', 'UPA']
+
+QUALITATIVE = ['Detectado', 'Não detectado', 'Reagente', 'Não reagente', 'Inconclusivo']
+
+MUNICIPIOS = ['3550308', '3509502', '3548708', '3518800', '3534401', '3304557', '3106200']
+
+UFS = ['SP', 'RJ', 'MG', 'PR']
+
+
+def patient_id(rng):
+    """
+    An identifier hashed like those of the published tables
+    """
+    return hashlib.md5(str(rng.getrandbits(64)).encode('ascii')).hexdigest().upper()
+
+
+def pacientes_rows(rows, seed=1):
+    """
+    Generates ``rows`` rows like those of HC_PACIENTES, with the placeholders (AAAA, UU, MMMM, CCCC) that
+    anonymization leaves for unknown or suppressed values
+    """
+    rng = random.Random(seed)
+    yield ['ID_PACIENTE', 'IC_SEXO', 'AA_NASCIMENTO', 'CD_PAIS', 'CD_UF', 'CD_MUNICIPIO', 'CD_CEPREDUZIDO']
+    for _ in range(rows):
+        suppressed = rng.random() < 0.05
+        abroad = rng.random() < 0.01
+        yield [patient_id(rng),
+               rng.choice('FM'),
+               'AAAA' if suppressed else str(rng.randint(1925, 2019)),
+               'XX' if abroad else 'BR',
+               'UU' if abroad else rng.choice(UFS),
+               'MMMM' if abroad or suppressed else rng.choice(MUNICIPIOS),
+               'CCCC' if abroad or suppressed else '{:05d}'.format(rng.randint(1000, 99999))]
+
+
+def exames_rows(rows, seed=1, patients=None):
+    """
+    Generates ``rows`` rows like those of EINSTEIN_Exames: every attendance of a patient yields the analytes of
+    one exam, with numeric or qualitative results, and empty units and reference values where they do not apply
+    """
+    rng = random.Random(seed)
+    patients = patients if patients else max(rows // 50, 1)
+    ids = [patient_id(rng) for _ in range(patients)]
+    start = datetime.date(2020, 1, 1)
+    yield ['ID_PACIENTE', 'ID_ATENDIMENTO', 'DT_COLETA', 'DE_ORIGEM', 'DE_EXAME', 'DE_ANALITO', 'DE_RESULTADO',
+           'CD_UNIDADE', 'DE_VALOR_REFERENCIA']
+    count = 0
+    attendance = 0
+    while count < rows:
+        attendance += 1
+        patient = rng.choice(ids)
+        collected = (start + datetime.timedelta(days=rng.randint(0, 365))).isoformat()
+        origin = rng.choice(ORIGENS)
+        exam, analytes, units = rng.choice(EXAMES)
+        for analyte, unit in zip(analytes, units):
+            if count == rows:
+                break
+            if unit:
+                low = round(rng.uniform(0.5, 150), 1)
+                result = str(round(low * rng.uniform(0.5, 1.5), 1))
+                reference = '{} a {}'.format(low, round(low * 1.3, 1)).replace('.', ',')
+            else:
+                result = rng.choice(QUALITATIVE)
+                reference = rng.choice(['', 'Não detectado', 'Não reagente'])
+            yield [patient, str(attendance), collected, origin, exam, analyte, result, unit, reference]
+            count += 1
+
+
+TABLES = {
+    'pacientes': {
+        'name': 'HC_PACIENTES',
+        'rows': pacientes_rows,
+        'aboutUrl': BASE + 'paciente/{ID_PACIENTE}',
+        'primaryKey': 'ID_PACIENTE',
+        'columns': {
+            'ID_PACIENTE': {'datatype': 'string'},
+            'IC_SEXO': {'datatype': 'string'},
+            'AA_NASCIMENTO': {'datatype': 'xsd:gYear', 'null': 'AAAA'},
+            'CD_PAIS': {'datatype': 'string'},
+            'CD_UF': {'datatype': 'string', 'null': 'UU'},
+            'CD_MUNICIPIO': {'datatype': 'string', 'null': 'MMMM',
+                             'valueUrl': BASE + 'municipio/{CD_MUNICIPIO}'},
+            'CD_CEPREDUZIDO': {'datatype': 'string', 'null': 'CCCC'}
+        }
+    },
+    'exames': {
+        'name': 'EINSTEIN_Exames',
+        'rows': exames_rows,
+        'aboutUrl': BASE + 'exame/{_row}',
+        'primaryKey': None,
+        'columns': {
+            'ID_PACIENTE': {'datatype': 'string', 'valueUrl': BASE + 'paciente/{ID_PACIENTE}'},
+            'ID_ATENDIMENTO': {'datatype': 'string', 'valueUrl': BASE + 'atendimento/{ID_ATENDIMENTO}'},
+            'DT_COLETA': {'datatype': 'xsd:date'},
+            'DE_ORIGEM': {'datatype': 'string'},
+            'DE_EXAME': {'datatype': 'string', 'lang': 'pt'},
+            'DE_ANALITO': {'datatype': 'string', 'lang': 'pt'},
+            'DE_RESULTADO': {'datatype': 'string'},
+            'CD_UNIDADE': {'datatype': 'string', 'null': ''},
+            'DE_VALOR_REFERENCIA': {'datatype': 'string', 'null': ''}
+        }
+    }
+}
+
+
+def schema(table, url):
+    """
+    The CSVW schema of a generated ``table``, in the form written by :func:`build_schema`
+    """
+    spec = TABLES[table]
+    base = BASE[:-1]
+    columns = []
+    for name, properties in spec['columns'].items():
+        column = {"@id": "{}/{}/column/{}".format(base, url, name),
+                  "name": name,
+                  "titles": [name],
+                  "dc:description": name}
+        column.update(properties)
+        columns.append(column)
+    metadata = {
+        "@id": "{}/{}".format(base, url),
+        "@context": [CSVW_CONTEXT, {"@language": "en", "@base": BASE}],
+        "url": url,
+        "dialect": {"delimiter": "|", "encoding": "utf-8", "quoteChar": "\""},
+        "dc:title": spec['name'],
+        "tableSchema": {"columns": columns, "aboutUrl": spec['aboutUrl']}
+    }
+    if spec['primaryKey']:
+        metadata['tableSchema']['primaryKey'] = spec['primaryKey']
+    return metadata
+
+
+def generate(table, rows, seed=1, directory='benchmark-data'):
+    """
+    Writes ``rows`` rows of the ``table`` generated from ``seed`` (and its schema) to ``directory``, unless they
+    were generated before. Returns the name of the CSV file
+    """
+    spec = TABLES[table]
+    os.makedirs(directory, exist_ok=True)
+    url = "{}_{}_{}.csv".format(spec['name'], rows, seed)
+    file_name = os.path.join(directory, url)
+    if not os.path.exists(file_name):
+        print("Generating {} rows of {}".format(rows, spec['name']))
+        with open(file_name + '.tmp', 'wb') as f:
+            w = csv.writer(f, delimiter='|', quotechar='\"', encoding='utf-8', lineterminator='\n')
+            w.writerows(spec['rows'](rows, seed))
+        os.replace(file_name + '.tmp', file_name)
+    with open(file_name + '-metadata.json', 'w') as f:
+        json.dump(schema(table, url), f, indent=True)
+    return file_name
+
+
+def peak_rss():
+    """
+    The peak resident memory (in MB) of this process and of the largest of its finished child processes
+    """
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit)
+
+
+def measure(file_name, rows, mode, processes, chunksize):
+    """
+    Converts ``file_name`` once in ``mode`` (simple, parallel or sharded), in this process, and returns the
+    throughput and peak memory of the conversion
+    """
+    c = CSVWConverter(file_name, processes=processes if mode != 'simple' else 1, chunksize=chunksize,
+                      output_format='nquads', base=BASE, sharded=mode == 'sharded')
+    if os.path.exists(c.target_file):
+        os.remove(c.target_file)
+
+    start = time.perf_counter()
+    c.convert()
+    seconds = time.perf_counter() - start
+
+    with open(c.target_file, 'rb') as f:
+        quads = sum(1 for _ in f)
+    os.remove(c.target_file)
+    rss, worker_rss = peak_rss()
+    return {'mode': mode,
+            'processes': processes if mode != 'simple' else 1,
+            'chunksize': chunksize,
+            'seconds': round(seconds, 3),
+            'rows_per_s': round(rows / seconds, 1),
+            'triples_per_s': round(quads / seconds, 1),
+            'triples': quads,
+            'peak_rss_mb': round(rss, 1),
+            'peak_worker_rss_mb': round(worker_rss, 1)}
+
+
+def measure_apart(file_name, rows, mode, processes, chunksize):
+    """
+    Runs :func:`measure` in a fresh Python process
+    """
+    config = json.dumps([file_name, rows, mode, processes, chunksize])
+    done = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', config],
+                          stdout=subprocess.PIPE, check=True)
+    return json.loads(done.stdout.decode('utf-8').strip().splitlines()[-1])
+
+
+def configurations(modes, processes, chunksizes):
+    """
+    The (mode, processes, chunksize) combinations to measure; the simple conversion runs once per chunksize
+    """
+    for chunksize in chunksizes:
+        for mode in modes:
+            if mode == 'simple':
+                yield mode, 1, chunksize
+            else:
+                for p in processes:
+                    if p > 1:
+                        yield mode, p, chunksize
+
+
+def run(table, rows, seed=1, modes=('simple', 'parallel'), processes=(2, 4), chunksizes=(1000, 5000), repeat=3,
+        directory='benchmark-data'):
+    """
+    Measures the conversion of the generated ``table`` for all configurations, ``repeat`` times each, and
+    returns the results with the fastest run of every configuration
+    """
+    file_name = generate(table, rows, seed, directory)
+    results = []
+    for mode, p, chunksize in configurations(modes, processes, chunksizes):
+        runs = [measure_apart(file_name, rows, mode, p, chunksize) for _ in range(repeat)]
+        best = min(runs, key=lambda r: r['seconds'])
+        best['runs'] = [r['seconds'] for r in runs]
+        print("{mode:>8} {processes:>3} processes, chunksize {chunksize:>6}: {rows_per_s:>10.1f} rows/s "
+              "{triples_per_s:>11.1f} triples/s, peak RSS {peak_rss_mb:.1f} MB "
+              "(workers {peak_worker_rss_mb:.1f} MB)".format(**best))
+        results.append(best)
+
+    return {'table': TABLES[table]['name'],
+            'rows': rows,
+            'seed': seed,
+            'date': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'results': results}
+
+
+def compare(baseline, report, tolerance=0.1):
+    """
+    Prints the change in rows/s of every configuration in ``report`` that was also measured in ``baseline``, and
+    returns those that became slower by more than ``tolerance``
+    """
+    if (baseline['table'], baseline['rows'], baseline['seed']) != (report['table'], report['rows'], report['seed']):
+        print("Warning: the baseline converted {rows} rows of {table} (seed {seed})".format(**baseline))
+    key = lambda r: (r['mode'], r['processes'], r['chunksize'])
+    before = {key(r): r for r in baseline['results']}
+    regressions = []
+    for r in report['results']:
+        if key(r) not in before:
+            continue
+        change = r['rows_per_s'] / before[key(r)]['rows_per_s'] - 1
+        print("{:>8} {:>3} processes, chunksize {:>6}: {:+.1%}".format(*key(r), change))
+        if change < -tolerance:
+            regressions.append(r)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the conversion of synthetic HC_PACIENTES or EINSTEIN_Exames data")
+    parser.add_argument('--table', dest='table', choices=sorted(TABLES), default='exames', help="The table to generate and convert")
+    parser.add_argument('--rows', dest='rows', default=50000, type=int, help="The number of rows to generate")
+    parser.add_argument('--seed', dest='seed', default=1, type=int, help="The seed of the generated data")
+    parser.add_argument('--modes', dest='modes', nargs='+', choices=['simple', 'parallel', 'sharded'], default=['simple', 'parallel'], help="The conversion modes to measure")
+    parser.add_argument('--processes', dest='processes', nargs='+', default=[2, 4], type=int, help="The numbers of processes to measure the parallel modes with")
+    parser.add_argument('--chunksize', dest='chunksizes', nargs='+', default=[1000, 5000], type=int, help="The chunksizes to measure")
+    parser.add_argument('--repeat', dest='repeat', default=3, type=int, help="The number of times every configuration is measured (the fastest run is reported)")
+    parser.add_argument('--directory', dest='directory', default='benchmark-data', type=str, help="Where the generated data is kept")
+    parser.add_argument('--output', dest='output', default=None, type=str, help="Write the results to this JSON file")
+    parser.add_argument('--baseline', dest='baseline', default=None, type=str, help="Compare the results with those in this JSON file, and exit with an error if any configuration became slower")
+    parser.add_argument('--tolerance', dest='tolerance', default=0.1, type=float, help="The fraction of rows/s a configuration may lose before it counts as slower")
+    parser.add_argument('--measure', dest='measure', default=None, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(*json.loads(args.measure))))
+        return
+
+    report = run(args.table, args.rows, args.seed, args.modes, args.processes, args.chunksizes, args.repeat, args.directory)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        if regressions:
+            print("{} configuration(s) became slower".format(len(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
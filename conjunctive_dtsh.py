@@ -2,380 +2,147 @@ import rdflib
 from rdflib import Graph,ConjunctiveGraph
 from rdflib.namespace import XSD,DC,DCTERMS,VOID,XSD,RDF,RDFS,OWL
 from rdflib import Graph, URIRef, Literal, Namespace, Dataset
+import os
 import re
 
-def query_pacientes_id_at(g):
-	q1 = '''
-			PREFIX: <https://repositoriodatasharingfapesp.uspdigital.usp.br/>
-			PREFIX datashIdAt: <https://repositoriodatasharingfapesp.uspdigital.usp.br/graph>
-			PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-
-			SELECT DISTINCT ?id ?IdAtendimento
-			WHERE { ?x :Id  ?id .
-					?x :IdAtendimento ?IdAtendimento .
-					}
-	'''
-	q2 = '''
-			PREFIX: <https://repositoriodatasharingfapesp.uspdigital.usp.br/>
-			PREFIX datashIdAt: <https://repositoriodatasharingfapesp.uspdigital.usp.br/graph>
-			PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-
-			SELECT ?idAtendimento ?dtcoleta
-			WHERE { ?x :DtColeta  ?dtcoleta .
-					?x :IdAtendimento ?idAtendimento .
-					}
-			ORDER BY ?dtcoleta
-	'''
-
+from quadstore import QuadStore
+from queries import QueryRegistry
+from linking import KeyIndex, graph_keys, join
+
+STORE = 'dados/abox/dtsh.sqlite'
+SOURCES = [
+	#'dados/abox/pacientes_id_at.ttl',
+	'dados/abox/test_exames.ttl',
+	#'dados/abox/HC_PACIENTES_1.nq',
+	'dados/abox/measurements-csv-sample.ttl',
+	'dados/abox/EINSTEIN_Exames_2_SAMPLE.csv.nq',
+]
+
+DTSH = Namespace('http://www.semanticweb.org/datasharingbr#')
+SCHEMA = Namespace('http://schema.org/')
+DATASHARING = Namespace('https://repositoriodatasharingfapesp.uspdigital.usp.br/')
+IISG_VOCAB = Namespace('https://iisg.amsterdam/vocab/')
+
+# Predicados cujos literais sao filtrados com regex nas consultas; o indice de literais responde esses filtros
+LITERAL_INDEX = [
+	DATASHARING['DeExame'],
+	DATASHARING['graphMUNICIPIO'],
+	SCHEMA['codeValue'],
+	SCHEMA['identifier'],
+]
+
+# As consultas ficam em conjunctive_dtsh.rq, e sao preparadas (parse + algebra) uma unica vez
+QUERIES = QueryRegistry(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'conjunctive_dtsh.rq'))
 
-
-	cnst1 = g.query(q1)
+def query_pacientes_id_at(g):
+	cnst1 = QUERIES.query(g, 'pacientes_id_atendimento')
 
 	for x in cnst1:
 		print(f" Paciente Id: {x.id}, id de atendimento: {x.IdAtendimento}")
 
-	for x in g.query(q2):
+	for x in QUERIES.query(g, 'atendimentos_por_coleta'):
 		print(f"{x.dtcoleta}, {x.idAtendimento}")
 
 
 #identificando quais instâncias de exames pertencem a categoria de Observation conforme a ontolgoia do grupo query_dtsh_Haiss
 #match com o termpo (string) na q1 e identificando quais e qntos pacientes no arquivo HC_EXAMES_SAMPLE tem os mesmo id
 
-def query_identify_exams_urea(g):
-	q1 = '''
-			PREFIX : <https://repositoriodatasharingfapesp.uspdigital.usp.br/>
-			PREFIX datashIdAt: <https://repositoriodatasharingfapesp.uspdigital.usp.br/graph>
-			PREFIX owl: <http://www.w3.org/2002/07/owl#>
-			PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-
-			SELECT DISTINCT ?exame ?id_ex
-			WHERE { ?x :DeExame ?exame  .
-					?id_ex :DeExame ?exame  .
-					FILTER regex (?exame, "uréia", "i")
-				}
-
-	'''
-	for x in g.query(q1):
+def query_identify_exams_urea(g, descricao="uréia"):
+	for x in QUERIES.query(g, 'exames_por_descricao', descricao=descricao):
 		print(f"{x.id_ex}")
 
 
-	q2= """
-			PREFIX : <https://repositoriodatasharingfapesp.uspdigital.usp.br/>
-			PREFIX vocab: <https://iisg.amsterdam/vocab/>
-			PREFIX owl: <http://www.w3.org/2002/07/owl#>
-			PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-			PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-			PREFIX xml: <http://www.w3.org/XML/1998/namespace>
-			PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-			PREFIX schema: <http://schema.org/>
-			PREFIX dtsh: <http://www.semanticweb.org/datasharingbr#>
-
-			SELECT DISTINCT ?s ?id
-
-			WHERE {
-					?x vocab:ID_PACIENTE ?s.
-					?y schema:identifier ?id.
-					FILTER regex(?s, ?id)
-			}
-
-	"""
+	# exames ligados aos pacientes pelo ID_PACIENTE: um hash join em tempo linear, em vez de comparar com regex
+	# cada ID_PACIENTE com cada schema:identifier
 	count = 0
-	for r in g.query(q2):
-		print (r.s, r.id)
+	pacientes = KeyIndex(graph_keys(g, SCHEMA['identifier']))
+	for key, paciente, exame in join(pacientes, graph_keys(g, IISG_VOCAB['ID_PACIENTE'])):
+		print (exame, paciente)
 		count+= 1
 	print (count)
 
-def query_pacientes(g):
-	q2 = '''
-			PREFIX : <https://repositoriodatasharingfapesp.uspdigital.usp.br/>
-			PREFIX datashIdAt: <https://repositoriodatasharingfapesp.uspdigital.usp.br/graph>
-			PREFIX owl: <http://www.w3.org/2002/07/owl#>
-			PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-
-			SELECT ?id ?MUNICIPIO
-			WHERE { ?x :Id  ?id .
-					?x datashIdAt:MUNICIPIO ?MUNICIPIO  .
-					FILTER regex (?MUNICIPIO, "sao paulo", "i")
-	}
-
-	'''
-
-
-
-
-	cnst2 = g.query(q2)
+def query_pacientes(g, municipio="sao paulo"):
+	cnst2 = QUERIES.query(g, 'pacientes_por_municipio', nome_municipio=municipio)
 	#print ("Municipio:\n")
 	for x in cnst2:
 		print(f"{x.id}")
 
 
-def query(g):
-	consulta1= """
-			PREFIX : <https://repositoriodatasharingfapesp.uspdigital.usp.br/>
-			PREFIX vocab: <https://repositoriodatasharingfapesp.uspdigital.usp.br/vocab/>
-			PREFIX owl: <http://www.w3.org/2002/07/owl#>
-			PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-			PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-			PREFIX xml: <http://www.w3.org/XML/1998/namespace>
-			PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-
-			SELECT ?s ?sexo
-
-			WHERE {
-					?x vocab:ID_PACIENTE ?s.
-					?x   vocab:IC_SEXO ?sexo.
-					FILTER regex (?sexo, "F")
-			}
-	"""
-	for r in g.query(consulta1):
+def query(g, sexo="F"):
+	for r in QUERIES.query(g, 'pacientes_por_sexo', codigo_sexo=sexo):
 			print(r.s,r.sexo)
 
 
+#medicoes de um paciente (ex.: dtsh:123456789)
+def query_medicoes_paciente(g, paciente=DTSH['123456789']):
+	for r in QUERIES.query(g, 'medicoes_paciente', paciente=paciente):
+		print(r.s, r.caresite, r.codevalue, r.codesystem, r.value)
+
 
 #listagem das instâncias segundo o modelo de propriedades utilizado
-def query_dtsh_Haiss(g):
-	consulta_paciente_id = """
-			PREFIX schema: <http://schema.org/>
-			PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-			PREFIX owl: <http://www.w3.org/2002/07/owl#>
-			PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-			PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-
-
-			SELECT ?id
-
-			WHERE {
-					?x schema:identifier ?id.
-					FILTER regex (?id, "00006490d57666d73747c29c01079b60b1353002")
-			}
-	"""
-	for r in g.query(consulta1):
+def query_dtsh_Haiss(g, paciente="00006490d57666d73747c29c01079b60b1353002"):
+	for r in QUERIES.query(g, 'paciente_por_identificador', identificador=paciente):
 			print(r.id)
 
 
-	ct2_scale= """
-			PREFIX schema: <http://schema.org/>
-			PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-			PREFIX owl: <http://www.w3.org/2002/07/owl#>
-			PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-			PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-			PREFIX dtsh: <http://www.semanticweb.org/datasharingbr#>
-
-			SELECT DISTINCT ?scale
-
-			WHERE {
-					?x ?id_atendimento dtsh:Measurement.
-					?y schema:codeValue ?scale
-					FILTER regex (?scale, "LP7753-9")
-			}
-
-
-	"""
 	count = 0
-	for x in g.query(ct2_scale):
+	for x in QUERIES.query(g, 'escalas_por_codigo', codigo="LP7753-9"):
 		print(x.scale)
 		count +=1
 	print ('- datasharingbr#hasScale',count)
 
 
-
-	ct2_unit= """
-			PREFIX schema: <http://schema.org/>
-			PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-			PREFIX owl: <http://www.w3.org/2002/07/owl#>
-			PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-			PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-			PREFIX dtsh: <http://www.semanticweb.org/datasharingbr#>
-
-			SELECT DISTINCT ?unit
-
-			WHERE {
-					?x dtsh:hasUnit ?unit
-			}
-
-
-	"""
-
 	count = 0
-	for x in g.query(ct2_unit):
+	for x in QUERIES.query(g, 'unidades'):
 		print (x.unit)
 		count +=1
 	print ('- datasharingbr#hasUnit',count)
 
 
-	ct2_careSite="""
-			PREFIX schema: <http://schema.org/>
-			PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-			PREFIX owl: <http://www.w3.org/2002/07/owl#>
-			PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-			PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-			PREFIX dtsh: <http://www.semanticweb.org/datasharingbr#>
-
-			SELECT DISTINCT ?care_site
-
-			WHERE {
-					?x dtsh:hasCareSite ?care_site
-			}
-
-	"""
 	count = 0
-	for x in g.query(ct2_careSite):
+	for x in QUERIES.query(g, 'locais_de_atendimento'):
 		print (x.care_site)
 		count +=1
 	print ('- datasharingbr#hasCareSite',count)
 
-	ct2_property="""
-			PREFIX schema: <http://schema.org/>
-			PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-			PREFIX owl: <http://www.w3.org/2002/07/owl#>
-			PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-			PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-			PREFIX dtsh: <http://www.semanticweb.org/datasharingbr#>
-
-			SELECT DISTINCT ?property
-
-			WHERE {
-					?x dtsh:hasProperty ?property
-			}
-
-	"""
 	count = 0
-	for x in g.query(ct2_property):
+	for x in QUERIES.query(g, 'propriedades'):
 		print (x.property)
 		count +=1
 	print ('- datasharingbr#hasProperty',count)
 
-	ct2_patient="""
-			PREFIX schema: <http://schema.org/>
-			PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-			PREFIX owl: <http://www.w3.org/2002/07/owl#>
-			PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-			PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-			PREFIX dtsh: <http://www.semanticweb.org/datasharingbr#>
-
-			SELECT DISTINCT ?patient
-
-			WHERE {
-					?x dtsh:hasPatient ?patient
-			}
-
-	"""
 	count = 0
-	for x in g.query(ct2_patient):
+	for x in QUERIES.query(g, 'pacientes'):
 		#print (x.patient)
 		count +=1
 	print ('- datasharingbr#hasPatient',count)
 
-	ct2_concept="""
-			PREFIX schema: <http://schema.org/>
-			PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-			PREFIX owl: <http://www.w3.org/2002/07/owl#>
-			PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-			PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-			PREFIX dtsh: <http://www.semanticweb.org/datasharingbr#>
-
-			SELECT DISTINCT ?concept
-
-			WHERE {
-					?x dtsh:hasConcept ?concept
-			}
-
-	"""
 	count = 0
-	for x in g.query(ct2_concept):
+	for x in QUERIES.query(g, 'conceitos'):
 		print (x.concept)
 		count +=1
 	print ('- datasharingbr#hasConcept',count)
 
 #listagem mais detalhada conforme o modelo de conceito e vocabulario(vocab)
 def observation_specimen_dtsh_Haiss(g):
-	observation="""
-			PREFIX schema: <http://schema.org/>
-			PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-			PREFIX owl: <http://www.w3.org/2002/07/owl#>
-			PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-			PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-			PREFIX dtsh: <http://www.semanticweb.org/datasharingbr#>
-
-			SELECT DISTINCT ?concept ?vocab
-
-			WHERE {
-					?x schema:codeValue ?concept .
-					?x schema:codeSystem ?vocab
-					FILTER regex (?concept, "LP14288-2")
-			}
-
-		"""
 	count = 0
-	for x in g.query(observation):
+	for x in QUERIES.query(g, 'conceitos_por_codigo', codigo="LP14288-2"):
 		print (x.concept, x.vocab)
 
-	ct2_observation="""
-			PREFIX schema: <http://schema.org/>
-			PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-			PREFIX owl: <http://www.w3.org/2002/07/owl#>
-			PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-			PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-			PREFIX dtsh: <http://www.semanticweb.org/datasharingbr#>
-
-			SELECT ?observation
-
-			WHERE {
-					?x dtsh:hasObservation ?observation
-			}
-	"""
 	count = 0
-	for x in g.query(ct2_observation):
+	for x in QUERIES.query(g, 'observacoes_medicoes'):
 		count +=1
 	print(count)
 	print (x.observation)
 
 
-
-	specimen = """
-			PREFIX schema: <http://schema.org/>
-			PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-			PREFIX owl: <http://www.w3.org/2002/07/owl#>
-			PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-			PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-			PREFIX dtsh: <http://www.semanticweb.org/datasharingbr#>
-
-			SELECT DISTINCT ?concept ?vocab
-
-			WHERE {
-					?x a dtsh:Specimen .
-					?x schema:codeValue ?concept .
-					?x dtsh:codeSystem ?vocab
-			}
-
-
-		"""
 	count = 0
-	for x in g.query(specimen):
+	for x in QUERIES.query(g, 'especimes'):
 		print (x.concept, x.vocab)
 
 
-	ct2_specimen= """
-						PREFIX schema: <http://schema.org/>
-						PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-						PREFIX owl: <http://www.w3.org/2002/07/owl#>
-						PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-						PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-						PREFIX dtsh: <http://www.semanticweb.org/datasharingbr#>
-
-						SELECT ?specimen
-
-						WHERE {
-								?x ?id_atendimento dtsh:Measurement.
-								?y schema:codeValue ?specimen
-								FILTER regex (?specimen, "119364003")
-						}
-
-
-				"""
-
 	count = 0
-	for x in g.query(ct2_specimen):
+	for x in QUERIES.query(g, 'especimes_por_codigo', codigo="119364003"):
 		count +=1
 	print (count)
 	print(x.specimen)
@@ -385,18 +152,19 @@ def observation_specimen_dtsh_Haiss(g):
 
 
 def conjunctive_dtsh():
-	gnq = ConjunctiveGraph()
-
-	#gnq.parse('dados/abox/pacientes_id_at.ttl',format='ttl')
-	gnq.parse('dados/abox/test_exames.ttl',format='ttl')
-	#gnq.parse('dados/abox/HC_PACIENTES_1.nq', format='nquads')
-	gnq.parse('dados/abox/measurements-csv-sample.ttl', format='ttl')
-	gnq.parse('dados/abox/EINSTEIN_Exames_2_SAMPLE.csv.nq')
+	# Parsed once into the persistent store, by all cores; later runs only open it (and load what was added to the files)
+	store = QuadStore(STORE)
+	store.load_parallel(SOURCES)
+	for predicate in LITERAL_INDEX:
+		store.index_literals(predicate)
+	gnq = ConjunctiveGraph(store=store)
 
 	#query_identify_exams_urea(gnq)
 	query_pacientes_id_at(gnq)
 	#query_dtsh_Haiss(gnq)
 	#observation_specimen_dtsh_Haiss(gnq)
+	#query_medicoes_paciente(gnq)
+	store.close()
 
 
 if __name__ == "__main__":
@@ -7,17 +7,31 @@ import json
 import logging
 import iribaker
 import traceback
+import pickle
+import shutil
+import tempfile
+import queue
+import threading
+import re
+import sqlite3
+import sys
+import time
+import resource
 import rfc3987
 from chardet.universaldetector import UniversalDetector
 import multiprocessing as mp
 import unicodecsv as csv
 from jinja2 import Template
+from .streams import compression_of, open_compressed, nquads_statements, bounded_imap, quote_literal
 from .util import patch_namespaces_to_disk, process_namespaces, get_namespaces, Nanopublication, validateTerm, parse_value, CSVW, PROV, DC, SKOS, RDF
 from rdflib import URIRef, Literal, Graph, BNode, XSD, Dataset
 from rdflib.resource import Resource
 from rdflib.collection import Collection
-from functools import partial
-from itertools import zip_longest
+from functools import partial, lru_cache
+from itertools import zip_longest, islice
+from string import Formatter
+from collections import deque, Counter, OrderedDict
+from hashlib import sha1
 
 import io
 
@@ -33,13 +47,205 @@ rdfTermLogger.setLevel(logging.ERROR) # It's too chatty with warnings and it was
 # Serialization extension dictionary
 extensions = {'xml': 'xml', 'n3' : 'n3', 'turtle': 'ttl', 'nt' : 'nt', 'pretty-xml' : 'xml', 'trix' : 'trix', 'trig' : 'trig', 'nquads' : 'nq'}
 
+# Line-based formats that can be written by the streaming QuadWriter
+streaming_formats = ['nquads', 'nt']
+
 UTF8 = 'utf-8'
 
-def build_schema(infile, outfile, delimiter=None, quotechar='\"', encoding=None, dataset_name=None, base="https://iisg.amsterdam/"):
+# Default number of validated IRIs kept by every BurstConverter
+IRI_CACHE_SIZE = 100000
+
+# A run of characters that can be put in the path of an IRI as is (see iribaker.to_iri)
+IPATH_CHARS = rfc3987.get_compiled_pattern("(?:%(iunreserved)s|%(pct_encoded)s|%(sub_delims)s|:|@|/)*")
+# Values that compile_iri_pattern fills into a pattern to check that its IRIs are those of iribaker.to_iri: with
+# spaces, non-ASCII and reserved characters, percent-encoding and path separators
+IRI_PROBES = ['a b', 'Uréia', 'São Paulo/SP', 'x?y#z', '[a]', '<a>"b"', '50%', '%20', 'a:b@c', "!$&'()*+,;=", '../..', '']
+
+def find_schema_file(file_name):
+    """Returns the name of the CSVW schema of a CSV file: ``<file>-metadata.json``, or for a compressed file the
+    schema of the uncompressed name (``data.csv-metadata.json`` for ``data.csv.gz``) if it has none of its own"""
+    schema_file_name = "{}-metadata.json".format(file_name)
+    if compression_of(file_name) and not os.path.exists(schema_file_name):
+        uncompressed_schema_file_name = "{}-metadata.json".format(os.path.splitext(file_name)[0])
+        if os.path.exists(uncompressed_schema_file_name):
+            return uncompressed_schema_file_name
+    return schema_file_name
+
+
+class ThreadedWriter(object):
+    """Writes to a (compressing) file in a separate thread, so that compressing a chunk overlaps with converting
+    the next. The codecs release the GIL while compressing. At most ``max_pending`` writes are queued, after which
+    :meth:`write` waits. Has the ``write``, ``flush``, ``tell`` and ``close`` methods of the file it wraps, where
+    ``tell`` counts the (uncompressed) bytes written."""
+
+    def __init__(self, file, max_pending=8):
+        self.file = file
+        self.position = 0
+        self.error = None
+        self.queue = queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            try:
+                if data is None:
+                    return
+                if self.error is None:
+                    self.file.write(data)
+            except Exception as e:
+                # Raised again in the thread that writes
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, data):
+        self._raise()
+        self.queue.put(data)
+        self.position += len(data)
+        return len(data)
+
+    def flush(self):
+        self.queue.join()
+        self._raise()
+        self.file.flush()
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.file.close()
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Automatic tuning (see tune): a chunk should take about TARGET_CHUNK_SECONDS to convert, and a process is only
+# worth starting for at least MIN_PROCESS_SECONDS of work
+TUNING_SAMPLE_ROWS = 500
+TARGET_CHUNK_SECONDS = 1.0
+MIN_PROCESS_SECONDS = 2.0
+MIN_CHUNKSIZE = 100
+MAX_CHUNKSIZE = 100000
+CHUNKS_PER_PROCESS = 4
+MEMORY_SHARE = 0.5
+
+
+# The number of bytes of a file that are read to detect its encoding and delimiter
+DETECTION_BUDGET = 64 * 1024
+# The delimiters that are considered when detecting the dialect of a file
+DELIMITERS = ',;|\t'
+
+
+def detect_dialect(infile, budget=DETECTION_BUDGET, samples=4):
+    """Detects the encoding and delimiter of a CSV file, returned as a dictionary with ``encoding`` and ``delimiter``.
+
+    Only ``budget`` bytes are read, in ``samples`` blocks spread over the file (or only from its start if it is
+    compressed): the start of the file does not always show the characters that give the encoding away. The result
+    is cached in ``<file>.dialect.json``, for as long as the size and modification time of the file do not change."""
+    cache_file = "{}.dialect.json".format(infile)
+    stat = os.stat(infile)
+    key = {'size': stat.st_size, 'mtime': stat.st_mtime, 'budget': budget}
+    try:
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+        if cached['file'] == key:
+            logger.info("Using the encoding and delimiter detected before, from {}".format(cache_file))
+            return cached['dialect']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    blocks = _sample_blocks(infile, budget, samples)
+    detector = UniversalDetector()
+    for block in blocks:
+        detector.feed(block)
+        if detector.done:
+            break
+    detector.close()
+    encoding = detector.result['encoding'] or UTF8
+    logger.info("Detected encoding: {} ({} confidence)".format(encoding, detector.result['confidence']))
+    if encoding.lower() == 'ascii':
+        # Non-ascii characters may well be in the part of the file that we did not read
+        encoding = UTF8
+
+    # Several lines tell more about the delimiter than only the header
+    text = blocks[0].decode(encoding, errors='ignore')
+    try:
+        delimiter = csv.Sniffer().sniff(text, delimiters=DELIMITERS).delimiter
+    except csv.Error:
+        delimiter = _count_delimiter(text)
+    logger.info("Detected delimiter: '{}'".format(delimiter))
+
+    dialect = {'encoding': encoding, 'delimiter': delimiter}
+    try:
+        with open(cache_file, 'w') as f:
+            json.dump({'file': key, 'dialect': dialect}, f, indent=True)
+    except OSError:
+        logger.warning("Could not cache the detected encoding and delimiter in {}".format(cache_file))
+    return dialect
+
+
+def _sample_blocks(infile, budget, samples):
+    """Reads ``samples`` blocks of complete lines, of together about ``budget`` bytes, from places spread over the file"""
+    size = budget // samples
+    blocks = []
+    with open_compressed(infile) as f:
+        block = f.read(size)
+        # The block at the start of the file is at least one line long
+        if b'\n' in block:
+            block = block[:block.rfind(b'\n') + 1]
+        else:
+            block += f.readline()
+        blocks.append(block)
+
+        if compression_of(infile) is None:
+            file_size = os.path.getsize(infile)
+            # The last block ends at the end of the file
+            for i in range(1, samples):
+                offset = max(file_size - size, 0) * i // (samples - 1)
+                if offset < len(blocks[0]):
+                    continue
+                f.seek(offset)
+                block = f.read(size)
+                # Only whole lines, so that no multibyte character is cut in half
+                block = block[block.find(b'\n') + 1:block.rfind(b'\n') + 1]
+                if block:
+                    blocks.append(block)
+    return blocks
+
+
+def _count_delimiter(text):
+    """Returns the delimiter that occurs the same (non-zero) number of times on the most lines, or a comma"""
+    lines = text.splitlines()[:20]
+    best, best_score = ',', 0
+    for delimiter in DELIMITERS:
+        counts = Counter(line.count(delimiter) for line in lines)
+        count, lines_with_count = counts.most_common(1)[0] if counts else (0, 0)
+        if count > 0 and lines_with_count > best_score:
+            best, best_score = delimiter, lines_with_count
+    return best
+
+
+def build_schema(infile, outfile, delimiter=None, quotechar='\"', encoding=None, dataset_name=None, base="https://iisg.amsterdam/", infer=True, sample_size=100000, processes=1, detection_budget=DETECTION_BUDGET):
     """
     Build a CSVW schema based on the ``infile`` CSV file, and write the resulting JSON CSVW schema to ``outfile``.
 
     Takes various optional parameters for instructing the CSV reader, but is also quite good at guessing the right values.
+    Unless ``infer`` is False, the datatypes of the columns are inferred from a sample of ``sample_size`` rows, or from
+    the whole file (read by ``processes`` processes) if there is no ``sample_size`` (see :func:`infer_datatypes`).
+    The encoding and delimiter, if not given, are detected from ``detection_budget`` bytes (see :func:`detect_dialect`).
     """
 
     url = os.path.basename(infile)
@@ -49,25 +255,10 @@ def build_schema(infile, outfile, delimiter=None, quotechar='\"', encoding=None,
     if dataset_name is None:
         dataset_name = url
 
-    if encoding is None:
-        detector = UniversalDetector()
-        with open(infile, 'rb') as f:
-            for line in f:
-                detector.feed(line)
-                if detector.done:
-                    break
-        detector.close()
-        encoding = detector.result['encoding']
-        logger.info("Detected encoding: {} ({} confidence)".format(detector.result['encoding'],
-                                                                   detector.result['confidence']))
-
-    if delimiter is None:
-        with open(infile, 'r', errors='ignore') as csvfile:
-            # dialect = csv.Sniffer().sniff(csvfile.read(1024), delimiters=";,$\t")
-            dialect = csv.Sniffer().sniff(csvfile.readline()) #read only the header instead of the entire file to determine delimiter
-            csvfile.seek(0)
-        logger.info("Detected dialect: {} (delimiter: '{}')".format(dialect, dialect.delimiter))
-        delimiter = dialect.delimiter
+    if encoding is None or delimiter is None:
+        dialect = detect_dialect(infile, detection_budget)
+        encoding = encoding if encoding else dialect['encoding']
+        delimiter = delimiter if delimiter else dialect['delimiter']
 
 
     logger.info("Delimiter is: {}".format(delimiter))
@@ -101,7 +292,7 @@ def build_schema(infile, outfile, delimiter=None, quotechar='\"', encoding=None,
         }
     }
 
-    with io.open(infile, 'rb') as infile_file:
+    with open_compressed(infile) as infile_file:
         r = csv.reader(infile_file, delimiter=delimiter, quotechar=quotechar, encoding=encoding)
 
         header = next(r)
@@ -116,16 +307,25 @@ def build_schema(infile, outfile, delimiter=None, quotechar='\"', encoding=None,
         # First column is primary key
         metadata['tableSchema']['primaryKey'] = header[0]
 
-        for head in header:
-            col = {
-                "@id": iribaker.to_iri("{}/{}/column/{}".format(base, url, head)),
-                "name": head,
-                "titles": [head],
-                "dc:description": head,
-                "datatype": "string"
-            }
+    if infer:
+        profiles = infer_datatypes(infile, delimiter, quotechar, encoding, sample_size, processes)
+        datatypes = [profile.datatype() for profile in profiles]
+    else:
+        datatypes = [('string', [])] * len(header)
+
+    for head, (datatype, nulls) in zip(header, datatypes):
+        col = {
+            "@id": iribaker.to_iri("{}/{}/column/{}".format(base, url, head)),
+            "name": head,
+            "titles": [head],
+            "dc:description": head,
+            "datatype": datatype
+        }
+        if nulls:
+            logger.info("Column {} is {}, with null values {}".format(head, datatype, nulls))
+            col["null"] = nulls if len(nulls) > 1 else nulls[0]
 
-            metadata['tableSchema']['columns'].append(col)
+        metadata['tableSchema']['columns'].append(col)
 
     with open(outfile, 'w') as outfile_file:
         outfile_file.write(json.dumps(metadata, indent=True))
@@ -134,6 +334,167 @@ def build_schema(infile, outfile, delimiter=None, quotechar='\"', encoding=None,
     return
 
 
+def _is_date(value, format):
+    try:
+        datetime.datetime.strptime(value, format)
+    except ValueError:
+        return False
+    return True
+
+
+_BOOLEAN = re.compile(r'(?:true|false|True|False|TRUE|FALSE)$')
+_YEAR = re.compile(r'(?:18|19|20)[0-9]{2}$')
+# Column names of years (AA_NASCIMENTO, ANO_COLETA, BIRTH_YEAR): only these can be inferred as xsd:gYear, as any
+# other integer column whose values happen to lie between 1800 and 2099 (counts, codes) would be too
+_YEAR_COLUMN = re.compile(r'(?:^|[^A-Za-z])(?:AA|ANO|YEAR|YR)(?:[^A-Za-z]|$)', re.IGNORECASE)
+# No leading zeros, as they would be lost: those are codes rather than numbers
+_INTEGER = re.compile(r'[+-]?(?:0|[1-9][0-9]*)$')
+_DECIMAL = re.compile(r'[+-]?(?:0|[1-9][0-9]*)?\.[0-9]+$')
+_DATE = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}$')
+_DATETIME = re.compile(r'([0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2})(?:\.[0-9]+)?(?:Z|[+-][0-9]{2}:[0-9]{2})?$')
+
+# The datatypes that build_schema infers, in order of preference: a column gets the first one that all its values
+# have. The later numeric types include the earlier ones (a gYear is an integer, an integer is a decimal). A
+# gYear is only inferred for columns with the name of a year (see _YEAR_COLUMN).
+DATATYPES = [
+    ('xsd:boolean', _BOOLEAN.match),
+    ('xsd:gYear', _YEAR.match),
+    ('xsd:integer', _INTEGER.match),
+    ('xsd:decimal', lambda value: _INTEGER.match(value) or _DECIMAL.match(value)),
+    ('xsd:date', lambda value: _DATE.match(value) and _is_date(value, '%Y-%m-%d')),
+    ('xsd:dateTime', lambda value: _DATETIME.match(value) and _is_date(_DATETIME.match(value).group(1), '%Y-%m-%dT%H:%M:%S')),
+]
+
+# The number of distinct placeholders (like MMMM) that may fail a datatype, as null values
+MAX_NULL_TOKENS = 3
+# Placeholders: the ones the anonymized hospital tables use for unknown or suppressed values (AAAA, UU, MMMM, CCCC),
+# a run of placeholder punctuation (--, ??, ***) or a common marker of missing values. Any other run of a
+# repeated letter may well be a value (SS, MM), and would be dropped from the output as a null token.
+_NULL_TOKEN = re.compile(r'(?:AAAA|UU|MMMM|CCCC|[-.?*_]{2,}|NA|N/A|n/a|NULL|null|None|-|\?|\\N)$')
+
+
+class ColumnProfile(object):
+    """Keeps track of the datatypes that all values of the column ``name`` seen so far have.
+
+    A value that does not fit a datatype rules it out, unless it is one of a few placeholders (such as ``MMMM`` for
+    an unknown municipality): these are kept as null tokens of the datatype. Profiles of parts of
+    a file are combined with :meth:`merge`."""
+
+    # The number of distinct values for which the datatypes they do not fit are remembered, so that they are checked once
+    MAX_SEEN = 10000
+
+    def __init__(self, name=''):
+        self.values = 0
+        # Datatype -> Counter of its null tokens, for the datatypes that are not ruled out
+        self.candidates = {datatype: Counter() for datatype, _ in DATATYPES}
+        if not _YEAR_COLUMN.search(name):
+            del self.candidates['xsd:gYear']
+        self.seen = {}
+
+    def add(self, value):
+        if value == '':
+            return
+        self.values += 1
+        if not self.candidates:
+            return
+
+        failed = self.seen.get(value)
+        if failed is None:
+            failed = tuple(datatype for datatype, matches in DATATYPES
+                           if datatype in self.candidates and not matches(value))
+            if len(self.seen) < self.MAX_SEEN:
+                self.seen[value] = failed
+        for datatype in failed:
+            tokens = self.candidates.get(datatype)
+            if tokens is None:
+                continue
+            tokens[value] += 1
+            if not _NULL_TOKEN.match(value) or len(tokens) > MAX_NULL_TOKENS:
+                del self.candidates[datatype]
+
+    def merge(self, other):
+        self.values += other.values
+        for datatype in list(self.candidates):
+            if datatype not in other.candidates:
+                del self.candidates[datatype]
+                continue
+            tokens = self.candidates[datatype]
+            tokens.update(other.candidates[datatype])
+            if len(tokens) > MAX_NULL_TOKENS:
+                del self.candidates[datatype]
+
+    def datatype(self):
+        """Returns the inferred datatype and its null tokens, or ``string`` (and no null tokens)"""
+        for datatype, _ in DATATYPES:
+            tokens = self.candidates.get(datatype)
+            # There should be at least one actual value of the datatype
+            if tokens is not None and sum(tokens.values()) < self.values:
+                return datatype, sorted(tokens)
+        return 'string', []
+
+
+def infer_datatypes(infile, delimiter, quotechar, encoding, sample_size=100000, processes=1, windows=16):
+    """Infers the datatype (and null tokens) of every column of a CSV file, returns a list of :class:`ColumnProfile`.
+
+    With a ``sample_size``, only about that many rows are read: half from the start of the file, and the other half
+    from ``windows`` places spread over the rest of it (when it is not compressed, so we can seek), so this takes
+    about as long for any size of file. Without one, the whole file is read, by ``processes`` processes that each
+    profile a byte range of the file."""
+    with open_compressed(infile) as f:
+        reader = csv.reader(f, delimiter=delimiter, quotechar=quotechar, encoding=encoding)
+        header = next(reader)
+        profiles = [ColumnProfile(name) for name in header]
+
+        if sample_size:
+            _profile_rows(profiles, islice(reader, sample_size // 2))
+            size = os.path.getsize(infile)
+            start = f.tell()
+            if compression_of(infile) is None and start < size:
+                for i in range(windows):
+                    # Start at the line after a place in the (remaining) file. We might start inside a quoted value,
+                    # so rows that do not have the right number of cells are skipped.
+                    f.seek(start + (size - start) * i // windows)
+                    f.readline()
+                    window = csv.reader(f, delimiter=delimiter, quotechar=quotechar, encoding=encoding)
+                    _profile_rows(profiles, islice(window, sample_size // 2 // windows))
+            return profiles
+
+    if processes > 1 and compression_of(infile) is None:
+        shard_size = max(os.path.getsize(infile) // (processes * 4), 1024 * 1024)
+        shards = [(infile, start, end, header, delimiter, quotechar, encoding)
+                  for start, end, _ in shard_csv(infile, quotechar, encoding, shard_size)]
+        pool = mp.Pool(processes=processes)
+        for shard_profiles in pool.imap(_profileShard, shards):
+            for profile, shard_profile in zip(profiles, shard_profiles):
+                profile.merge(shard_profile)
+        pool.close()
+        pool.join()
+    else:
+        with open_compressed(infile) as f:
+            reader = csv.reader(f, delimiter=delimiter, quotechar=quotechar, encoding=encoding)
+            next(reader)
+            _profile_rows(profiles, reader)
+    return profiles
+
+
+def _profile_rows(profiles, rows):
+    for row in rows:
+        if len(row) == len(profiles):
+            for profile, value in zip(profiles, row):
+                profile.add(value)
+
+
+def _profileShard(shard):
+    """The method called by the pool for every byte range of the file in the full scan of :func:`infer_datatypes`."""
+    infile, start, end, header, delimiter, quotechar, encoding = shard
+    with open(infile, 'rb') as f:
+        f.seek(start)
+        data = io.BytesIO(f.read(end - start))
+    profiles = [ColumnProfile(name) for name in header]
+    _profile_rows(profiles, csv.reader(data, delimiter=delimiter, quotechar=quotechar, encoding=encoding))
+    return profiles
+
+
 class Item(Resource):
     """Wrapper for the rdflib.resource.Resource class that allows getting property values from resources."""
 
@@ -161,6 +522,143 @@ class Item(Resource):
         return URIRef(self._graph.store.namespace(pfx) + name)
 
 
+def compile_pattern(pattern):
+    """Compiles a Jinja or Python formatted string into a function that applies it to a row.
+
+    Patterns are interpreted in two stages: first as a Jinja2 template, with all column/value pairs as
+    arguments, and then the result with Python string formatting. Most patterns have no Jinja syntax
+    at all, and only use ``{column}`` placeholders, so those skip Jinja and are rendered by simply
+    joining their parts; patterns without any placeholder are rendered only once. Jinja is only used
+    for actual Jinja syntax."""
+    pattern = str(pattern)
+
+    # Jinja strips a trailing newline, so leave anything with newlines to Jinja as well
+    if '{{' in pattern or '{%' in pattern or '{#' in pattern or '\n' in pattern or '\r' in pattern:
+        template = Template(pattern)
+        return lambda row: _format_rendered(template.render(**row), row)
+
+    try:
+        parsed = list(Formatter().parse(pattern))
+    except ValueError:
+        # Mismatched curly brackets, the pattern is taken as is
+        logger.warning(
+            "Could not apply python string formatting, probably due to mismatched curly brackets. IRI will be '{}'. ".format(pattern))
+        return lambda row: pattern
+
+    split = _split_placeholders(parsed)
+    if split is None:
+        # Anything beyond plain placeholders is left to str.format
+        return lambda row: _format_rendered(pattern, row)
+
+    parts, fields = split
+    if not fields:
+        constant = ''.join(parts)
+        return lambda row: constant
+
+    def render(row):
+        values = list(parts)
+        try:
+            for i, field in fields:
+                values[i] = str(row[field])
+        except KeyError:
+            logger.warning(
+                "Could not apply python string formatting, probably due to mismatched curly brackets. IRI will be '{}'. ".format(pattern))
+            return pattern
+        return ''.join(values)
+
+    return render
+
+
+def compile_iri_pattern(pattern):
+    """Compiles a URL pattern into a function that renders it for a row and only validates the row-dependent part.
+
+    This works for patterns with a valid constant ``scheme://authority/`` prefix and plain ``{column}``
+    placeholders in the path only. The rendered IRI is valid as long as every value consists of characters
+    that are allowed in an IRI path, which is much cheaper to check than parsing the whole IRI. The function
+    returns None for values that do not pass (these need the full normalization), and ``compile_iri_pattern``
+    returns None for patterns that are not eligible, or that give another IRI than ``iribaker.to_iri`` for any of
+    the IRI_PROBES."""
+    pattern = str(pattern)
+    if '{{' in pattern or '{%' in pattern or '{#' in pattern or '?' in pattern or '#' in pattern:
+        return None
+
+    try:
+        split = _split_placeholders(Formatter().parse(pattern))
+    except ValueError:
+        return None
+    if split is None or not split[1]:
+        return None
+    parts, fields = split
+
+    # The placeholders need to be in the path, after a complete authority
+    prefix = parts[0] or ''
+    scheme, sep, rest = prefix.partition('://')
+    if not sep or '/' not in rest:
+        return None
+    # ... and the pattern itself needs to be valid, with any path characters filled in
+    try:
+        rfc3987.parse(''.join(p if p is not None else 'x' for p in parts), rule='IRI')
+    except ValueError:
+        return None
+
+    def render(row):
+        values = list(parts)
+        for i, field in fields:
+            value = row.get(field)
+            if value is None:
+                return None
+            value = str(value)
+            if not IPATH_CHARS.fullmatch(value):
+                return None
+            values[i] = value
+        return ''.join(values)
+
+    for probe in IRI_PROBES:
+        iri = render({field: probe for _, field in fields})
+        if iri is not None and iri != iribaker.to_iri(iri):
+            logger.warning("The IRIs of {} are left to full normalization, as {} is not normalized by iribaker as given".format(pattern, iri))
+            return None
+    return render
+
+
+def _split_placeholders(parsed):
+    """Splits a parsed (see string.Formatter.parse) pattern into its literal parts and its plain ``{column}``
+    placeholders. Returns the parts (with None in place of the placeholders) and a list of (index, column)
+    pairs, or None if the pattern uses anything beyond plain placeholders."""
+    parts = []
+    fields = []
+    for literal, field, format_spec, conversion in parsed:
+        if literal:
+            parts.append(literal)
+        if field is None:
+            continue
+        if format_spec or conversion or not field or field.isdigit() or '.' in field or '[' in field:
+            return None
+        fields.append((len(parts), field))
+        parts.append(None)
+    return parts, fields
+
+
+def _to_valid_iri(url):
+    """Normalizes ``url`` to an IRI and validates it, as cached by :class:`BurstConverter`"""
+    try:
+        iri = iribaker.to_iri(url)
+        rfc3987.parse(iri, rule='IRI')
+    except:
+        raise Exception("Cannot convert `{}` to valid IRI".format(url))
+    return iri
+
+
+def _format_rendered(rendered_template, row):
+    """Formats a (rendered) pattern using the standard Python string formatting, or returns it as is when that fails"""
+    try:
+        return rendered_template.format(**row)
+    except:
+        logger.warning(
+            "Could not apply python string formatting, probably due to mismatched curly brackets. IRI will be '{}'. ".format(rendered_template))
+        return rendered_template
+
+
 class CSVWConverter(object):
     """
     Converter configuration object for **CSVW**-style conversion. Is used to set parameters for a conversion,
@@ -172,19 +670,66 @@ class CSVWConverter(object):
     * A nanopublication structure for publishing the converted data (using :class:`converter.util.Nanopublication`)
     """
 
-    def __init__(self, file_name, delimiter=',', quotechar='\"', encoding=UTF8, processes=4, chunksize=5000, output_format='nquads', base="https://iisg.amsterdam/"):
+    def __init__(self, file_name, delimiter=',', quotechar='\"', encoding=UTF8, processes=4, chunksize=5000, output_format='nquads', base="https://iisg.amsterdam/", streaming=False, deduplicate=False, max_inflight=None, sharded=False, shard_size=16 * 1024 * 1024, iri_cache_size=IRI_CACHE_SIZE, reject_file=None, error_samples=10, checkpoint=False, resume=False, incremental=False, delta_store=None, compression=None, detection_budget=DETECTION_BUDGET, profile=False, metrics_file=None, status_file=None, metrics_interval=10):
         logger.info("Initializing converter for {}".format(file_name))
         self.file_name = file_name
         self.output_format = output_format
+        self.streaming = streaming
+        self.deduplicate = deduplicate
+        if self.streaming and self.output_format not in streaming_formats:
+            logger.warning("Streaming is only supported for {}, building the graph in memory instead".format(", ".join(streaming_formats)))
+            self.streaming = False
+        # The output is compressed with the given compression extension (gz, bz2 or zst), if any
+        self.compression = compression
         self.target_file = f"{self.file_name}.{extensions[self.output_format]}"
-        schema_file_name = f"{file_name}-metadata.json"
+        if compression:
+            self.target_file = f"{self.target_file}.{compression}"
+        schema_file_name = find_schema_file(file_name)
 
         if not os.path.exists(schema_file_name) or not os.path.exists(file_name):
             raise Exception(
                 "Could not find source or metadata file in path; make sure you called with a .csv file")
 
+        # Either may be 'auto', to be tuned (see _tune) once the converter is set up
         self._processes = processes
         self._chunksize = chunksize
+        # Adjusts the chunksize during the conversion, when it is tuned
+        self._sizer = None
+        # The number of chunks that may be read ahead of the writer in parallel conversion
+        self._max_inflight = max_inflight
+        # Whether parallel workers read their own byte range of the file, instead of receiving parsed rows
+        self._sharded = sharded
+        if sharded and compression_of(file_name):
+            logger.warning("Cannot shard the compressed file {} by byte ranges, the processes receive parsed rows instead".format(file_name))
+            self._sharded = False
+        self._shard_size = shard_size
+        self._iri_cache_size = iri_cache_size
+        # Rows with failing cells are written to the reject_file (as JSON lines), if given
+        self.reject_file = reject_file
+        self._error_samples = error_samples
+        self.errors = ErrorCollector(error_samples)
+        self._rejects = None
+        # The progress is written to a manifest after every chunk when checkpointing; resuming implies it
+        self.resume = resume
+        self.checkpoint = Checkpoint(self.target_file,
+                                     {'source': os.path.abspath(file_name),
+                                      'size': os.path.getsize(file_name),
+                                      'mtime': os.path.getmtime(file_name),
+                                      'schema_mtime': os.path.getmtime(schema_file_name),
+                                      'output_format': self.output_format,
+                                      'streaming': self.streaming},
+                                     enabled=checkpoint or resume)
+        if self.checkpoint.enabled and compression:
+            logger.warning("A compressed target file cannot be resumed after its last chunk, not checkpointing")
+            self.checkpoint.enabled = self.resume = False
+        # Incremental conversion only converts the rows that changed since the delivery recorded in the delta store
+        self.incremental = incremental
+        self.delta_store = delta_store if delta_store else "{}.delta.sqlite".format(file_name)
+        # The time spent per stage and column is collected from all processes, and reported at the end
+        self.profile = Profile() if profile else None
+        self.profile_file = "{}.profile.json".format(file_name)
+        # Live metrics are written to a Prometheus text file and/or a JSON status file while converting
+        self.metrics = Metrics(file_name, metrics_file, status_file, metrics_interval)
         logger.info("Processes: {}".format(self._processes))
         logger.info("Chunksize: {}".format(self._chunksize))
 
@@ -247,6 +792,12 @@ class CSVWConverter(object):
             if self.metadata.csvw_dialect.csvw_encoding is not None:
                 self.encoding = str(self.metadata.csvw_dialect.csvw_encoding)
 
+        # Detect what is neither given nor in the schema
+        if self.encoding is None or self.delimiter is None:
+            dialect = detect_dialect(file_name, detection_budget)
+            self.encoding = self.encoding if self.encoding else dialect['encoding']
+            self.delimiter = self.delimiter if self.delimiter else dialect['delimiter']
+
         logger.info("Quotechar: {}".format(self.quotechar.__repr__()))
         logger.info("Delimiter: {}".format(self.delimiter.__repr__()))
         logger.info("Encoding : {}".format(self.encoding.__repr__()))
@@ -255,7 +806,7 @@ class CSVWConverter(object):
 
         # All IRIs in the metadata_graph need to at least be valid, this validates them
         headersDict = {}
-        with io.open(self.file_name, 'rb') as f:
+        with open_compressed(self.file_name) as f:
             r = csv.reader(f, delimiter=self.delimiter, quotechar=self.quotechar, encoding=self.encoding)
             headers = next(r)
             headersDict = dict.fromkeys(headers)
@@ -293,7 +844,45 @@ class CSVWConverter(object):
         # pprint('----------')
         # pprint([term for term in self.schema.csvw_column])
 
-
+        if self._processes == 'auto' or self._chunksize == 'auto':
+            self._tune()
+        if not self._max_inflight:
+            self._max_inflight = 2 * self._processes
+
+    def _tune(self, sample_rows=TUNING_SAMPLE_ROWS):
+        """Picks the number of processes and/or the chunksize that were set to 'auto' (see :func:`tune`), from the
+        time it takes to convert the first ``sample_rows`` rows. A tuned chunksize keeps being adjusted during the
+        conversion by a :class:`ChunkSizer`"""
+        c = BurstConverter(*self._burst_converter_args(), **dict(self._converter_options(), profile=False))
+        with open_compressed(self.file_name) as csvfile:
+            reader = csv.DictReader(csvfile, encoding=self.encoding, delimiter=self.delimiter, quotechar=self.quotechar)
+            rows = list(islice(reader, sample_rows))
+        start = time.perf_counter()
+        out = c.process(0, rows, 1)
+        row_seconds = (time.perf_counter() - start) / max(len(rows), 1)
+        # An in-memory graph takes many times the size of its serialization
+        row_memory = len(out) / max(len(rows), 1) * (2 if self.streaming else 10)
+        expected_rows = estimate_rows(self.file_name)
+        memory = available_memory()
+
+        tuned_processes, tuned_chunksize = tune(row_seconds, expected_rows, row_memory,
+                                                process_memory=peak_rss_mb() * 1024 * 1024, memory=memory,
+                                                processes=self._processes, chunksize=self._chunksize)
+        logger.info("Tuned to {} processes and chunks of {} rows ({:.3f} ms per row, {} rows expected, {} CPUs, {} MB available)".format(
+            tuned_processes, tuned_chunksize, 1000 * row_seconds, expected_rows, os.cpu_count(),
+            memory // (1024 * 1024) if memory is not None else 'unknown'))
+        if self._chunksize == 'auto':
+            # Keep enough chunks for all processes until the end
+            self._sizer = ChunkSizer(tuned_chunksize, tuned_processes,
+                                     maximum=expected_rows // (CHUNKS_PER_PROCESS * tuned_processes) if expected_rows and tuned_processes > 1 else MAX_CHUNKSIZE)
+            # Shards of about as many rows as a chunk
+            self._shard_size = max(int(tuned_chunksize * os.path.getsize(self.file_name) / expected_rows), 1024 * 1024) \
+                if expected_rows else self._shard_size
+        self._processes, self._chunksize = tuned_processes, tuned_chunksize
+
+    def _chunks(self):
+        """The chunksize for row_chunks: the ChunkSizer if it is tuned, otherwise the fixed chunksize"""
+        return self._sizer if self._sizer is not None else self._chunksize
 
     def convert_info(self):
         """Converts the CSVW JSON file to valid RDF for serializing into the Nanopublication publication info graph."""
@@ -340,16 +929,68 @@ class CSVWConverter(object):
     def convert(self):
         """Starts a conversion process (in parallel or as a single process) as defined in the arguments passed to the :class:`CSVWConverter` initialization"""
         logger.info("Starting conversion")
-
+        if not self._prepare():
+            return
+        self.metrics.start(self.checkpoint.rows)
+        try:
+            if self.incremental:
+                self._incremental()
+            else:
+                self._convert()
+        finally:
+            self.metrics.stop()
+            self._close_rejects()
+        self.errors.log_summary()
+        self._report_profile()
+
+    def _prepare(self):
+        """Loads the checkpoint to resume from (if resuming), and starts collecting errors. Returns False if
+        there is nothing left to convert"""
+        if not self.incremental:
+            if self.resume and self.checkpoint.load():
+                if self.checkpoint.complete:
+                    logger.info("{} was already converted completely, nothing to resume".format(self.file_name))
+                    return False
+                logger.info("Resuming the conversion of {} after {} chunks ({} rows)".format(
+                    self.file_name, self.checkpoint.chunks, self.checkpoint.rows))
+                self._restore_nanopublication(self.checkpoint.identifiers)
+            else:
+                self.checkpoint.reset()
+                self.checkpoint.identifiers = self._nanopublication_identifiers()
+
+        self._reset_errors()
+        # The hits and misses of the IRI caches of all BurstConverters of the conversion
+        self.iri_cache = Counter()
+        return True
+
+    def _report_profile(self):
+        """Logs the profile of the conversion as a table, and writes it to the profile file"""
+        if self.profile is None:
+            return
+        self.profile.log_table()
+        with open(self.profile_file, 'w') as f:
+            json.dump(self.profile.as_dict(), f, indent=True)
+        logger.info("Wrote the profile to {}".format(self.profile_file))
+
+    def _close_rejects(self):
+        if self._rejects is not None:
+            self._rejects.close()
+            self._rejects = None
+
+    def _convert(self):
         # If the number of processes is set to 1, we start the 'simple' conversion (in a single thread)
         if self._processes == 1:
             self._simple()
         # Otherwise, we start the parallel processing procedure, but fall back to simple conversion
         # when it turns out that for some reason the parallel processing fails (this happens on some
-        # files. The reason could not yet be determined.)
+        # files. The reason could not yet be determined.) The serial conversion continues after the
+        # last chunk that the parallel conversion wrote.
         elif self._processes > 1:
             try:
-                self._parallel()
+                if self._sharded:
+                    self._parallel_sharded()
+                else:
+                    self._parallel()
             except TypeError:
                 logger.info(
                     "TypeError in multiprocessing... falling back to serial conversion")
@@ -362,10 +1003,115 @@ class CSVWConverter(object):
         else:
             logger.error("Incorrect process count specification")
 
+    def _converter_options(self):
+        """The keyword arguments for the BurstConverter(s) of this conversion"""
+        return {'streaming': self.streaming,
+                'deduplicate': self.deduplicate,
+                'iri_cache_size': self._iri_cache_size,
+                'error_samples': self._error_samples,
+                'keep_rejected': self.reject_file is not None,
+                'profile': self.profile is not None}
+
+    def _nanopublication_identifiers(self):
+        """The graph names and timestamp of the nanopublication, as recorded in a checkpoint"""
+        return {'uri': str(self.np.uri),
+                'assertion': str(self.np.ag.identifier),
+                'provenance': str(self.np.pg.identifier),
+                'pubinfo': str(self.np.pig.identifier),
+                'generatedAtTime': str(self.np.pig.value(self.np.uri, PROV['generatedAtTime']))}
+
+    def _restore_nanopublication(self, identifiers):
+        """Renames the graphs (and the timestamp) of the nanopublication to those of the conversion that is
+        resumed, so that the rows converted before and after resuming end up in the same assertion graph"""
+        current = self._nanopublication_identifiers()
+        mapping = {URIRef(current[key]): URIRef(identifiers[key])
+                   for key in ('uri', 'assertion', 'provenance', 'pubinfo')}
+        mapping[Literal(current['generatedAtTime'], datatype=XSD.dateTime)] = \
+            Literal(identifiers['generatedAtTime'], datatype=XSD.dateTime)
+
+        for graph in list(self.np.contexts()):
+            triples = [tuple(mapping.get(term, term) for term in triple) for triple in graph]
+            self.np.remove_graph(graph)
+            target = self.np.graph(mapping.get(graph.identifier, graph.identifier))
+            for triple in triples:
+                target.add(triple)
+
+        self.np.uri = URIRef(identifiers['uri'])
+        self.np.ag = self.np.graph(URIRef(identifiers['assertion']))
+        self.np.pg = self.np.graph(URIRef(identifiers['provenance']))
+        self.np.pig = self.np.graph(URIRef(identifiers['pubinfo']))
+
+    def _reset_errors(self):
+        """Starts collecting errors (and rejected rows) from scratch. When resuming, the rows rejected
+        before are kept in the reject file"""
+        self.errors = ErrorCollector(self._error_samples)
+        if self.reject_file is not None:
+            if self._rejects is not None:
+                self._rejects.close()
+            self._rejects = open(self.reject_file, 'a' if self.checkpoint.chunks else 'w')
+
+    def _collect(self, errors):
+        """Adds the errors of a converted chunk, and writes its rejected rows to the reject file"""
+        self.errors.merge(errors)
+        if self._rejects is not None:
+            for rejected in errors.rejected:
+                self._rejects.write(json.dumps(rejected, ensure_ascii=False) + '\n')
+
+    def _open_target(self):
+        """Opens the target file for writing after the chunks that were written before (if any), dropping
+        whatever was written after the last checkpoint. Compressed target files are written in a separate thread"""
+        if compression_of(self.target_file):
+            if self.checkpoint.chunks:
+                # A compressed stream cannot be cut off after the last chunk, so we start from the first row again
+                logger.info("Cannot continue the compressed {}, starting over".format(self.target_file))
+                identifiers = self.checkpoint.identifiers
+                self.checkpoint.reset()
+                self.checkpoint.identifiers = identifiers
+            return ThreadedWriter(open_compressed(self.target_file, 'wb'))
+        if self.checkpoint.chunks == 0:
+            return open(self.target_file, 'wb')
+        logger.info("Continuing after row {} of {}".format(self.checkpoint.rows, self.file_name))
+        target_file = open(self.target_file, 'r+b')
+        target_file.truncate(self.checkpoint.offset)
+        target_file.seek(self.checkpoint.offset)
+        return target_file
+
+    def _write_chunk(self, target_file, out, errors, next_row, position=None, profile=None, iri_cache=None):
+        """Writes a converted chunk to the target file, and records it in the checkpoint. ``iri_cache`` are the
+        hits and misses of the IRI cache while converting it"""
+        if self.profile is not None:
+            start = time.perf_counter()
+            target_file.write(out)
+            self.profile.add('write', time.perf_counter() - start)
+            if profile is not None:
+                self.profile.merge(profile)
+        else:
+            target_file.write(out)
+        self.metrics.written(next_row, out, len(errors), self.output_format in streaming_formats)
+        if self._sizer is not None:
+            self._sizer.written(next_row - self.checkpoint.rows)
+        self._collect(errors)
+        if iri_cache is not None:
+            self.iri_cache.update(hits=iri_cache[0], misses=iri_cache[1])
+        if self.checkpoint.enabled:
+            # The manifest should never point beyond what is actually in the target file
+            target_file.flush()
+            if self._rejects is not None:
+                self._rejects.flush()
+        self.checkpoint.advance(next_row, target_file.tell(), position)
+
+    def _finish(self, target_file):
+        """Writes the nanopublication info to the target file, which completes the conversion"""
+        logger.info("IRI cache: {} hits, {} misses".format(self.iri_cache['hits'], self.iri_cache['misses']))
+        self.convert_info()
+        target_file.write(self.np.serialize(format=self.output_format))
+        target_file.flush()
+        self.checkpoint.finish(target_file.tell())
+
     def _simple(self):
         """Starts a single process for converting the file"""
-        with open(self.target_file, 'wb') as target_file:
-            with open(self.file_name, 'rb') as csvfile:
+        with self._open_target() as target_file:
+            with open_compressed(self.file_name) as csvfile:
                 logger.info("Opening CSV file for reading")
                 reader = csv.DictReader(csvfile,
                                         encoding=self.encoding,
@@ -374,57 +1120,550 @@ class CSVWConverter(object):
 
                 logger.info("Starting in a single process")
                 c = BurstConverter(self.np.ag.identifier, self.columns,
-                                   self.schema, self.metadata_graph, self.encoding, self.output_format)
-                # Out will contain an N-Quads serialized representation of the
-                # converted CSV
-                out = c.process(0, reader, 1)
-                # We then write it to the file
-                target_file.write(out)
-
-            self.convert_info()
+                                   self.schema, self.metadata_graph, self.encoding, self.output_format,
+                                   **self._converter_options())
+                # When checkpointing (or reporting metrics), the rows are converted chunksize at a time so that the
+                # conversion can be resumed after every chunk. Out will contain an N-Quads serialized representation
+                # of the converted rows
+                chunksize = self._chunks() if self.checkpoint.enabled or self.metrics.enabled else None
+                for first_row, rows in row_chunks(reader, chunksize, self.checkpoint.rows):
+                    start = time.perf_counter()
+                    out = c.process(first_row, rows, 1)
+                    self.metrics.completed(time.perf_counter() - start, 0)
+                    # We then write it to the file
+                    self._write_chunk(target_file, out, c.pop_errors(), c.next_row, profile=c.pop_profile(),
+                                      iri_cache=c.pop_iri_cache_counts())
+
             # Finally, write the nanopublication info to file
-            target_file.write(self.np.serialize(format=self.output_format))
+            self._finish(target_file)
 
     def _parallel(self):
         """Starts parallel processes for converting the file. Each process will receive max ``chunksize`` number of rows"""
-        with open(self.target_file, 'wb') as target_file:
-            with open(self.file_name, 'rb') as csvfile:
+        with self._open_target() as target_file:
+            with open_compressed(self.file_name) as csvfile:
                 logger.info("Opening CSV file for reading")
                 reader = csv.DictReader(csvfile,
                                         encoding=self.encoding,
                                         delimiter=self.delimiter,
                                         quotechar=self.quotechar)
 
-                # Initialize a pool of processes (default=4)
-                pool = mp.Pool(processes=self._processes)
-                logger.info("Running in {} processes".format(self._processes))
-
-                # The _burstConvert function is partially instantiated, and will be successively called with
-                # chunksize rows from the CSV file
-                # print("LOOOOOOOOOOOOOOOOOOOOOOO")
-                # from pprint import pprint
-                # pprint([term.n3() for term in self.columns])
-                burstConvert_partial = partial(_burstConvert,
-                                               identifier=self.np.ag.identifier,
-                                               columns=self.columns,
-                                               schema=self.schema,
-                                               metadata_graph=self.metadata_graph,
-                                               encoding=self.encoding,
-                                               chunksize=self._chunksize,
-                                               output_format=self.output_format)
-
-                # The result of each chunksize run will be written to the
-                # target file
-                for out in pool.imap(burstConvert_partial, enumerate(grouper(self._chunksize, reader))):
-                    target_file.write(out)
+                pool = self._pool()
+
+                # The _burstConvert function will be successively called with chunksize rows from the CSV file,
+                # and the result of each chunksize run will be written to the target file, in order. At most
+                # max_inflight chunks are read ahead, so the reader waits when the writer falls behind.
+                chunks = row_chunks(reader, self._chunks(), self.checkpoint.rows)
+                if self.profile is not None:
+                    chunks = self.profile.timed_iter('read', chunks)
+                for out, errors, next_row, _, profile, iri_cache in bounded_imap(pool, _burstConvert, chunks, self._max_inflight, self.metrics):
+                    self._write_chunk(target_file, out, errors, next_row, profile=profile, iri_cache=iri_cache)
 
                 # Make sure to close and join the pool once finished.
                 pool.close()
                 pool.join()
 
-            self.convert_info()
             # Finally, write the nanopublication info to file
-            target_file.write(self.np.serialize(format=self.output_format))
+            self._finish(target_file)
+
+    def _parallel_sharded(self):
+        """Starts parallel processes for converting the file, where each process parses its own byte range
+        (of about ``shard_size`` bytes) of the file, rather than receiving rows parsed by the parent process"""
+        if self.checkpoint.chunks and self.checkpoint.position is None:
+            # The checkpoint was made by a conversion that did not shard the file, so we only know the row
+            logger.info("The checkpoint has no position in the source file, continuing without sharding")
+            return self._parallel()
+
+        with self._open_target() as target_file:
+            with open_compressed(self.file_name) as csvfile:
+                header = next(csv.reader(csvfile, encoding=self.encoding, delimiter=self.delimiter, quotechar=self.quotechar))
+
+            pool = self._pool(reader={'file_name': self.file_name,
+                                      'fieldnames': header,
+                                      'encoding': self.encoding,
+                                      'delimiter': self.delimiter,
+                                      'quotechar': self.quotechar})
+
+            # The shards are computed while the first ones are already being converted
+            shards = shard_csv(self.file_name, self.quotechar, self.encoding, self._shard_size,
+                               start=self.checkpoint.position, first_row=self.checkpoint.rows)
+            for out, errors, next_row, position, profile, iri_cache in bounded_imap(pool, _burstConvertShard, shards, self._max_inflight, self.metrics):
+                self._write_chunk(target_file, out, errors, next_row, position, profile, iri_cache)
+
+            # Make sure to close and join the pool once finished.
+            pool.close()
+            pool.join()
+
+            # Finally, write the nanopublication info to file
+            self._finish(target_file)
+
+    def _incremental(self):
+        """Converts only the rows that are new or changed since the previous delivery of the file, as recorded
+        in the delta store, and writes the quads that appear and disappear to separate addition and deletion
+        files (see :class:`DeltaStore`). The rows of a primary key (``tableSchema.primaryKey``) are compared as a
+        whole, so a key that appears on several rows is converted again when any of its rows changes."""
+        if self.output_format not in streaming_formats:
+            raise Exception("Incremental conversion is only supported for {}".format(", ".join(streaming_formats)))
+        primary_key = self.schema.csvw_primaryKey
+        if primary_key is None:
+            raise Exception("Incremental conversion needs a primaryKey in the tableSchema of {}".format(self.file_name))
+        # The columns of a primaryKey list come from the graph in no particular order; the keys stored in the delta
+        # store must be made the same way in every delivery
+        key_columns = sorted(parse_value(k) for k in primary_key) if isinstance(primary_key, list) else [parse_value(primary_key)]
+
+        store = DeltaStore(self.delta_store)
+        try:
+            first_delivery = store.get('graph') is None
+            if first_delivery:
+                store.set('graph', str(self.np.ag.identifier))
+            # All deliveries are added to the assertion graph of the first one
+            identifier = URIRef(store.get('graph'))
+            options = dict(self._converter_options(), streaming=True, deduplicate=False, repeat_provenance=True)
+            c = BurstConverter(identifier, self.columns, self.schema, self.metadata_graph,
+                               self.encoding, self.output_format, **options)
+
+            # The stored rows can only be retracted if they are converted the same way as before
+            description = [self.output_format, str(c.aboutURLSchema)]
+            for plan in c.plan:
+                for name in ColumnPlan.__slots__:
+                    value = getattr(plan, name)
+                    description.append(str(sorted(value, key=str) if isinstance(value, (frozenset, tuple)) else value))
+            plan_digest = sha1(json.dumps(description).encode(UTF8)).hexdigest()
+            if first_delivery:
+                store.set('plan', plan_digest)
+            elif store.get('plan') != plan_digest:
+                raise Exception("The schema of {} changed since the delta store {} was made, convert it in full with a new delta store".format(self.file_name, self.delta_store))
+            # The row number only matters if it is used in a pattern
+            uses_row = '_row' in "".join(description)
+
+            def numbered_rows():
+                with open_compressed(self.file_name) as csvfile:
+                    reader = csv.DictReader(csvfile, encoding=self.encoding, delimiter=self.delimiter, quotechar=self.quotechar)
+                    for row_number, row in enumerate(reader):
+                        key = json.dumps([row.get(k) for k in key_columns], ensure_ascii=False)
+                        yield key, row_number, row
+
+            logger.info("Comparing {} with the previous delivery in {}".format(self.file_name, self.delta_store))
+            digests = ((key, sha1(json.dumps([sorted(row.items(), key=str), row_number if uses_row else None]).encode(UTF8)).digest())
+                       for key, row_number, row in numbered_rows())
+            store.add_digests(digests)
+            stale = store.find_stale()
+            logger.info("{} keys are new, changed or removed".format(len(stale)))
+
+            # Retract the quads of the rows that were stored for the stale keys...
+            for first_row, rows in consecutive_runs(store.stale_rows(), self._chunksize):
+                start = time.perf_counter()
+                store.count(c.process(first_row, rows, 1).split(b'\n'), -1)
+                self.metrics.completed(time.perf_counter() - start, 0)
+                c.pop_errors()
+                c.pop_profile()
+            store.replace_stale()
+
+            # ... and produce those of their rows in this delivery
+            new_rows = ((row_number, row) for key, row_number, row in numbered_rows() if key in stale)
+            for first_row, rows in consecutive_runs(new_rows, self._chunksize):
+                start = time.perf_counter()
+                out = c.process(first_row, rows, 1)
+                self.metrics.completed(time.perf_counter() - start, 0)
+                store.count(out.split(b'\n'), 1)
+                errors = c.pop_errors()
+                # The runs are counted where they end in the file, so the ETA follows the progress through it
+                self.metrics.written(first_row + len(rows), out, len(errors))
+                self._collect(errors)
+                if self.profile is not None:
+                    self.profile.merge(c.pop_profile())
+                store.add_rows((json.dumps([row.get(k) for k in key_columns], ensure_ascii=False), row.pop('_row'), row)
+                               for row in rows)
+
+            additions_file = "{}.additions.{}".format(self.file_name, extensions[self.output_format])
+            deletions_file = "{}.deletions.{}".format(self.file_name, extensions[self.output_format])
+            if self.compression:
+                additions_file = "{}.{}".format(additions_file, self.compression)
+                deletions_file = "{}.{}".format(deletions_file, self.compression)
+            with open_compressed(additions_file, 'wb') as additions, open_compressed(deletions_file, 'wb') as deletions:
+                added, deleted = store.apply(additions, deletions)
+                if first_delivery:
+                    # The first delivery is a full conversion, including the nanopublication info
+                    self.convert_info()
+                    additions.write(self.np.serialize(format=self.output_format))
+            store.commit()
+            logger.info("{} quads added ({}), {} quads deleted ({})".format(added, additions_file, deleted, deletions_file))
+        finally:
+            store.close()
+
+    def _burst_converter_args(self):
+        """The positional arguments for the BurstConverter(s) of this conversion"""
+        return (self.np.ag.identifier, self.columns, self.schema, self.metadata_graph,
+                self.encoding, self.output_format)
+
+    def _pool(self, reader=None):
+        """Initializes a pool of processes (default=4). The schema is sent to every worker only once,
+        by the initializer, which sets up a BurstConverter that lives as long as the worker does"""
+        pool = mp.Pool(processes=self._processes,
+                       initializer=_initBurstConverter,
+                       initargs=self._burst_converter_args() + (self._converter_options(), reader))
+        logger.info("Running in {} processes".format(self._processes))
+        return pool
+
+    def _batch_tasks(self, index, directory):
+        """Yields the chunks of rows of this file as tasks for :func:`convert_batch`, after opening the target file.
+        The arguments for the BurstConverters of the file are written to ``directory``, where the workers load them
+        when they get their first chunk of this file."""
+        setup_file = os.path.join(directory, "{}.pickle".format(index))
+        with open(setup_file, 'wb') as f:
+            pickle.dump((self._burst_converter_args(), self._converter_options()), f)
+
+        self._target = self._open_target()
+        with open_compressed(self.file_name) as csvfile:
+            reader = csv.DictReader(csvfile,
+                                    encoding=self.encoding,
+                                    delimiter=self.delimiter,
+                                    quotechar=self.quotechar)
+            # Tuned chunks keep being resized as they are written, as in _parallel
+            for first_row, rows in row_chunks(reader, self._chunks(), self.checkpoint.rows):
+                yield index, setup_file, first_row, rows
+
+
+class Checkpoint(object):
+    """Keeps track of how far a conversion got, so that an interrupted conversion can be resumed.
+
+    Chunks are written to the target file in order, so it suffices to know the number of rows converted,
+    the size of the target file after the last chunk and, for sharded conversion, the byte position in the
+    source file where the next shard starts. When ``enabled``, this is written to a manifest next to the
+    target file (``<target file>.checkpoint.json``) after every chunk, together with the identifiers of the
+    nanopublication (which contain the time of the conversion) so that a resumed conversion uses the same
+    ones. The ``settings`` identify the source file and output, a checkpoint made with other settings is
+    not resumed."""
+
+    def __init__(self, target_file, settings, enabled=False):
+        self.target_file = target_file
+        self.file_name = "{}.checkpoint.json".format(target_file)
+        self.settings = settings
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        """Starts from the first row"""
+        self.chunks = 0
+        self.rows = 0
+        self.offset = 0
+        self.position = None
+        self.identifiers = None
+        self.complete = False
+
+    def load(self):
+        """Reads the manifest of an earlier conversion, returns False if there is none that can be resumed"""
+        if not os.path.exists(self.file_name):
+            logger.info("No checkpoint found at {}, starting from scratch".format(self.file_name))
+            return False
+        with open(self.file_name, 'r') as f:
+            manifest = json.load(f)
+        if manifest['settings'] != self.settings:
+            logger.warning("The checkpoint {} was made for another version of the source file or with other settings, starting from scratch".format(self.file_name))
+            return False
+        if not os.path.exists(self.target_file) or os.path.getsize(self.target_file) < manifest['offset']:
+            logger.warning("The target file {} is missing or shorter than the checkpoint {} says, starting from scratch".format(self.target_file, self.file_name))
+            return False
+        for key in ('chunks', 'rows', 'offset', 'position', 'identifiers', 'complete'):
+            setattr(self, key, manifest[key])
+        return True
+
+    def save(self):
+        """Writes the manifest (if enabled). It is replaced at once, so it is never left half written"""
+        if not self.enabled:
+            return
+        manifest = {'settings': self.settings,
+                    'chunks': self.chunks,
+                    'rows': self.rows,
+                    'offset': self.offset,
+                    'position': self.position,
+                    'identifiers': self.identifiers,
+                    'complete': self.complete}
+        temporary_file = "{}.tmp".format(self.file_name)
+        with open(temporary_file, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(temporary_file, self.file_name)
+
+    def advance(self, rows, offset, position=None):
+        """Records that another chunk was written, up to row ``rows`` of the source file and byte ``offset``
+        of the target file. The ``position`` is where the next shard starts in the source file"""
+        self.chunks += 1
+        self.rows = rows
+        self.offset = offset
+        self.position = position
+        self.save()
+
+    def finish(self, offset):
+        """Records that the conversion is complete"""
+        self.offset = offset
+        self.complete = True
+        self.save()
+
+
+class DeltaStore(object):
+    """The state of an incremental conversion, kept in an SQLite database between deliveries of a file.
+
+    For every primary key it stores a digest of the rows with that key, and the rows themselves, so that the
+    triples of a row that changed or disappeared can be reproduced for the deletions. It also stores how many
+    times every quad was produced (by digest), as several rows can produce the same quad: a quad is only added
+    when it is first produced, and only deleted when no row produces it any more. Everything is changed in a
+    single transaction (committed at the very end), so an interrupted incremental conversion leaves the
+    store as it was."""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.db = sqlite3.connect(file_name)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, digest BLOB) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS rows (key TEXT, row_number INTEGER, data TEXT);
+            CREATE INDEX IF NOT EXISTS rows_key ON rows (key);
+            CREATE TABLE IF NOT EXISTS quads (digest BLOB PRIMARY KEY, count INTEGER) WITHOUT ROWID;
+            CREATE TEMP TABLE incoming (key TEXT, digest BLOB);
+            CREATE TEMP TABLE current (key TEXT PRIMARY KEY, digest BLOB) WITHOUT ROWID;
+            CREATE TEMP TABLE stale (key TEXT PRIMARY KEY) WITHOUT ROWID;
+            CREATE TEMP TABLE delta (digest BLOB PRIMARY KEY, line BLOB, change INTEGER) WITHOUT ROWID;
+        """)
+
+    def get(self, name):
+        row = self.db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, name, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, value))
+
+    def add_digests(self, digests):
+        """Adds (key, row digest) pairs of the delivered file, in the order of the rows"""
+        self.db.executemany("INSERT INTO incoming VALUES (?, ?)", digests)
+
+    def find_stale(self):
+        """Determines the keys that are new, changed or removed compared to the previous delivery, and
+        returns them as a set"""
+        def grouped():
+            digest, previous = None, None
+            for key, row_digest in self.db.execute("SELECT key, digest FROM incoming ORDER BY key, rowid"):
+                if key != previous:
+                    if previous is not None:
+                        yield previous, digest.digest()
+                    digest, previous = sha1(), key
+                digest.update(row_digest)
+            if previous is not None:
+                yield previous, digest.digest()
+
+        self.db.executemany("INSERT INTO current VALUES (?, ?)", grouped())
+        self.db.execute("""INSERT INTO stale SELECT c.key FROM current c LEFT JOIN keys k ON k.key = c.key
+                           WHERE k.digest IS NULL OR k.digest != c.digest""")
+        self.db.execute("INSERT INTO stale SELECT key FROM keys WHERE key NOT IN (SELECT key FROM current)")
+        return set(key for key, in self.db.execute("SELECT key FROM stale"))
+
+    def stale_rows(self):
+        """Yields the (row number, row) pairs stored for the stale keys, in the order of the row numbers"""
+        cursor = self.db.execute("SELECT row_number, data FROM rows WHERE key IN (SELECT key FROM stale) ORDER BY row_number")
+        for row_number, data in cursor:
+            yield row_number, json.loads(data)
+
+    def replace_stale(self):
+        """Drops the stored rows and digests of the stale keys, before the rows of the new delivery are added"""
+        self.db.execute("DELETE FROM rows WHERE key IN (SELECT key FROM stale)")
+        self.db.execute("DELETE FROM keys WHERE key IN (SELECT key FROM stale)")
+        self.db.execute("INSERT INTO keys SELECT key, digest FROM current WHERE key IN (SELECT key FROM stale)")
+
+    def add_rows(self, rows):
+        """Stores (key, row number, row) tuples of the new delivery"""
+        self.db.executemany("INSERT INTO rows VALUES (?, ?, ?)",
+                            ((key, row_number, json.dumps(row, ensure_ascii=False)) for key, row_number, row in rows))
+
+    def count(self, lines, change):
+        """Counts the quads (serialized ``lines``, without line ending) produced (``change`` 1) or retracted
+        (``change`` -1) by a number of rows"""
+        self.db.executemany("""INSERT INTO delta VALUES (?, ?, ?)
+                               ON CONFLICT (digest) DO UPDATE SET change = change + excluded.change""",
+                            ((sha1(line).digest()[:16], line, change * n) for line, n in Counter(lines).items() if line))
+
+    def apply(self, additions, deletions):
+        """Updates the quad counts, and writes the quads that appear to ``additions`` and those that disappear
+        to ``deletions``. Returns the number of both"""
+        added = deleted = 0
+        cursor = self.db.execute("""SELECT d.line, d.change, q.count FROM delta d LEFT JOIN quads q ON q.digest = d.digest
+                                    WHERE d.change != 0""")
+        for line, change, count in cursor:
+            before = count or 0
+            after = before + change
+            if after < 0:
+                logger.warning("Quad retracted more often than it was produced: {}".format(line.decode(UTF8, 'replace')))
+            if before <= 0 < after:
+                additions.write(line + b'\n')
+                added += 1
+            elif before > 0 >= after:
+                deletions.write(line + b'\n')
+                deleted += 1
+
+        self.db.execute("""INSERT INTO quads SELECT digest, change FROM delta WHERE change != 0
+                           ON CONFLICT (digest) DO UPDATE SET count = count + excluded.count""")
+        self.db.execute("DELETE FROM quads WHERE count <= 0")
+        return added, deleted
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def convert_batch(converters, processes=4, max_inflight=None):
+    """Converts the files of several :class:`CSVWConverter` objects with a single pool of ``processes`` processes.
+
+    Starting a pool takes longer than converting a small file, and the processes of a pool sit idle while the last
+    chunks of a file are converted. Here, the chunks of all files are fed to one pool, file after file, so that the
+    chunks of the next file are converted together with the last ones of the previous file. The results still come
+    back in order, so every file gets its own target file, written in order, and its own nanopublication. A file
+    whose chunks fail is converted on its own (in a single process) afterwards, after the chunks that were written."""
+    max_inflight = max_inflight if max_inflight else 2 * processes
+    directory = tempfile.mkdtemp(prefix='cow-batch-')
+    prepared = set()
+    failed = set()
+
+    def tasks():
+        for index, c in enumerate(converters):
+            logger.info("Starting conversion of {}".format(c.file_name))
+            if not c._prepare():
+                continue
+            prepared.add(index)
+            c.metrics.start(c.checkpoint.rows)
+            try:
+                for task in c._batch_tasks(index, directory):
+                    yield task
+            except Exception:
+                logger.error("Could not read {}, converting it on its own later".format(c.file_name))
+                traceback.print_exc()
+                failed.add(index)
+
+    def finish(index):
+        c = converters[index]
+        if index not in prepared:
+            return
+        c.metrics.stop()
+        if index in failed:
+            if getattr(c, '_target', None) is not None:
+                c._target.close()
+            return
+        with c._target:
+            c._finish(c._target)
+        c._close_rejects()
+        c.errors.log_summary()
+        c._report_profile()
+
+    pool = mp.Pool(processes=processes)
+    logger.info("Converting {} files in {} processes".format(len(converters), processes))
+    try:
+        # Every file is finished once the results of the next file start coming in
+        finished = 0
+        for index, out, errors, next_row, profile, iri_cache in bounded_imap(pool, _burstConvertBatch, tasks(), max_inflight):
+            while finished < index:
+                finish(finished)
+                finished += 1
+            if out is None:
+                failed.add(index)
+            if index not in failed:
+                converters[index]._write_chunk(converters[index]._target, out, errors, next_row, profile=profile, iri_cache=iri_cache)
+        while finished < len(converters):
+            finish(finished)
+            finished += 1
+
+        pool.close()
+        pool.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    for index in sorted(failed):
+        c = converters[index]
+        logger.error("Some exception occurred in {}, falling back to serial conversion".format(c.file_name))
+        c.metrics.start(c.checkpoint.rows)
+        try:
+            c._simple()
+        finally:
+            c.metrics.stop()
+            c._close_rejects()
+        c.errors.log_summary()
+        c._report_profile()
+
+
+def tune(row_seconds, rows=None, row_memory=0, process_memory=0, memory=None, cpus=None, processes='auto', chunksize='auto'):
+    """Picks the number of processes and the chunksize, for those that are 'auto', for converting ``rows`` rows (None
+    if unknown) that take ``row_seconds`` each and ``row_memory`` bytes while converted.
+
+    A pool takes longer to start than a small file takes to convert, so every process should get at least
+    MIN_PROCESS_SECONDS of work, and there are never more processes than ``cpus``. Chunks take TARGET_CHUNK_SECONDS,
+    and there are at least CHUNKS_PER_PROCESS of them for every process, so that all processes stay busy until
+    the end. At most MEMORY_SHARE of the available ``memory`` is used by the processes (``process_memory`` each)
+    and the chunks they convert, and the chunks read ahead (about three per process in all)."""
+    cpus = cpus if cpus else os.cpu_count() or 1
+    row_seconds = max(row_seconds, 1e-6)
+    auto_processes = processes == 'auto'
+    if auto_processes:
+        work = rows * row_seconds if rows is not None else float('inf')
+        processes = int(max(1, min(cpus, work / MIN_PROCESS_SECONDS)))
+    if chunksize == 'auto':
+        chunksize = TARGET_CHUNK_SECONDS / row_seconds
+        if rows is not None and processes > 1:
+            chunksize = min(chunksize, rows / (CHUNKS_PER_PROCESS * processes))
+        chunksize = int(max(MIN_CHUNKSIZE, min(MAX_CHUNKSIZE, chunksize)))
+    if memory is not None:
+        budget = memory * MEMORY_SHARE
+        while auto_processes and processes > 1 and processes * (process_memory + 3 * chunksize * row_memory) > budget:
+            processes -= 1
+        if row_memory:
+            chunksize = int(max(MIN_CHUNKSIZE, min(chunksize, (budget / processes - process_memory) / (3 * row_memory))))
+    return processes, chunksize
+
+
+class ChunkSizer(object):
+    """Adjusts the number of rows per chunk during the conversion, so that a chunk keeps taking about ``target``
+    seconds to convert when rows get more or less expensive.
+
+    Every process converts one chunk at a time, so when the ``processes`` together write ``rate`` rows per second,
+    a chunk of ``size`` rows takes about ``size * processes / rate`` seconds. Results come in bursts (the chunks
+    finished while waiting for the oldest one), so the rate is measured over the last few chunks written (see
+    :meth:`written`), and the size changes by at most a factor two per chunk."""
+
+    def __init__(self, size, processes=1, target=TARGET_CHUNK_SECONDS, minimum=MIN_CHUNKSIZE, maximum=MAX_CHUNKSIZE):
+        self.size = size
+        self.processes = processes
+        self.target = target
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.written_chunks = deque(maxlen=2 * processes + 1)
+
+    def written(self, rows):
+        """Counts a chunk of ``rows`` rows that was written, and adjusts the size"""
+        now = time.perf_counter()
+        self.written_chunks.append((now, rows))
+        if len(self.written_chunks) < self.written_chunks.maxlen:
+            return
+        since = self.written_chunks[0][0]
+        if now <= since:
+            return
+        rate = sum(rows for _, rows in islice(self.written_chunks, 1, None)) / (now - since)
+        size = int(self.target * rate / self.processes)
+        size = max(self.size // 2, min(self.size * 2, size))
+        size = max(self.minimum, min(self.maximum, size))
+        if size != self.size:
+            logger.debug("Chunksize {} -> {} ({:.1f} rows/s)".format(self.size, size, rate))
+        self.size = size
+
+
+def available_memory():
+    """The memory available for new processes (MemAvailable on Linux), in bytes, or None if unknown"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
 
 
 def grouper(n, iterable, padvalue=None):
@@ -432,33 +1671,798 @@ def grouper(n, iterable, padvalue=None):
     return zip_longest(*[iter(iterable)] * n, fillvalue=padvalue)
 
 
-# This has to be a global method for the parallelization to work.
-def _burstConvert(enumerated_rows, identifier, columns, schema, metadata_graph, encoding, chunksize, output_format):
-    """The method used as partial for the parallel processing initiated in :func:`_parallel`."""
+def row_chunks(reader, chunksize, first_row=0):
+    """Groups the rows of ``reader`` in chunks of ``chunksize`` rows, after skipping the first ``first_row`` rows
+    (that were converted before). Yields ``(first_row, rows)`` tuples, where ``first_row`` is the number of the first
+    row in the chunk, as used for ``_row``. Without a ``chunksize``, all remaining rows form a single chunk. With a
+    :class:`ChunkSizer`, every chunk has its current size."""
+    rows = iter(reader)
+    deque(islice(rows, first_row), maxlen=0)
+    if chunksize is None:
+        yield first_row, rows
+        return
+    if isinstance(chunksize, ChunkSizer):
+        while True:
+            chunk = list(islice(rows, chunksize.size))
+            if not chunk:
+                return
+            yield first_row, chunk
+            first_row += len(chunk)
+    for chunk in grouper(chunksize, rows):
+        yield first_row, chunk
+        first_row += chunksize
+
+
+def consecutive_runs(numbered_rows, limit):
+    """Groups ``(row number, row)`` pairs into runs of at most ``limit`` rows with consecutive row numbers.
+    Yields ``(first_row, rows)`` tuples, like :func:`row_chunks`."""
+    first_row, rows = None, []
+    for row_number, row in numbered_rows:
+        if rows and (row_number != first_row + len(rows) or len(rows) >= limit):
+            yield first_row, rows
+            rows = []
+        if not rows:
+            first_row = row_number
+        rows.append(row)
+    if rows:
+        yield first_row, rows
+
+
+def shard_csv(file_name, quotechar, encoding, shard_size, block_size=1024 * 1024, start=None, first_row=0):
+    """Splits the data rows of a CSV file into byte ranges of at least ``shard_size`` bytes, that start and end on record boundaries.
+
+    Yields ``(start, end, first_row)`` tuples, where ``first_row`` is the number of the first record in the range
+    (not counting the header), as used for ``_row``. The file is read once, in blocks, keeping track of whether
+    we are inside a quoted field so that newlines in quoted values do not count as record boundaries, and
+    blank lines are not counted as records (just like the csv reader skips them). This only counts bytes, and is
+    much cheaper than parsing the rows. Records are expected to end with ``\\n`` or ``\\r\\n``.
+
+    To continue after the shards that were converted before, ``start`` gives the position of the next record
+    and ``first_row`` its number."""
+    quote = quotechar.encode(encoding)
+    blank = (b'', b'\r')
+
+    with open(file_name, 'rb') as f:
+        if start is None:
+            # The header record ends at the first newline outside of quotes
+            header = b''
+            for line in f:
+                header += line
+                if header.count(quote) % 2 == 0 and header.strip():
+                    break
+            start = len(header)
+        else:
+            f.seek(start)
+
+        position = start
+        rows = 0
+        in_quotes = False
+        at_line_start = True
+
+        for block in iter(partial(f.read, block_size), b''):
+            boundary = None
+            offset = 0
+            for i, part in enumerate(block.split(quote)):
+                if i > 0:
+                    # Every quote character toggles the quoting, and makes the current line non-empty
+                    in_quotes = not in_quotes
+                    at_line_start = False
+                    offset += len(quote)
+
+                if not in_quotes and b'\n' in part:
+                    lines = part.split(b'\n')
+                    # Count the terminated lines that are not empty
+                    empty = lines.count(b'') + lines.count(b'\r')
+                    if lines[-1] in blank:
+                        empty -= 1
+                    if lines[0] in blank and not at_line_start:
+                        empty -= 1
+                    rows += len(lines) - 1 - empty
+                    boundary = position + offset + part.rfind(b'\n') + 1
+                    at_line_start = lines[-1] in blank
+                elif part and not (at_line_start and part == b'\r'):
+                    at_line_start = False
+                offset += len(part)
+            position += len(block)
+
+            # All rows counted so far end before the last boundary in this block
+            if boundary is not None and boundary - start >= shard_size:
+                yield (start, boundary, first_row)
+                start = boundary
+                first_row += rows
+                rows = 0
+
+        if position > start:
+            yield (start, position, first_row)
+
+
+# The BurstConverter of a pool worker, set up once by _initBurstConverter
+_worker_converter = None
+_worker_reader = None
+
+
+# These have to be global methods for the parallelization to work.
+def _initBurstConverter(identifier, columns, schema, metadata_graph, encoding, output_format, options, reader=None):
+    """The pool initializer for the parallel processing initiated in :func:`_parallel`. Builds the
+    BurstConverter (with keyword arguments ``options``) that the worker will reuse for every chunk it
+    receives. The ``reader`` options are only given when the worker reads its own shards of the file."""
+    global _worker_converter, _worker_reader
+    _worker_converter = BurstConverter(identifier, columns, schema,
+                                       metadata_graph, encoding, output_format,
+                                       **options)
+    _worker_reader = reader
+
+
+# The BurstConverters of a batch worker (see convert_batch), by the file with their arguments. Only the last few
+# are kept, as the files are converted one after the other
+_batch_converters = OrderedDict()
+BATCH_CONVERTERS = 4
+
+
+def _burstConvertBatch(task):
+    """The method called by the pool for every chunk of rows of every file in :func:`convert_batch`. Returns the
+    index of the file with what :func:`_burstConvert` returns, or only the index if the conversion failed."""
+    index, setup_file, first_row, rows = task
+    try:
+        converter = _batch_converters.get(setup_file)
+        if converter is None:
+            with open(setup_file, 'rb') as f:
+                args, options = pickle.load(f)
+            converter = _batch_converters[setup_file] = BurstConverter(*args, **options)
+            if len(_batch_converters) > BATCH_CONVERTERS:
+                _batch_converters.popitem(last=False)
+
+        logger.info("Process {}, file {}, row {}, {} rows".format(
+            mp.current_process().name, index, first_row, len(rows)))
+
+        result = converter.process(first_row, rows, 1)
+        return index, result, converter.pop_errors(), converter.next_row, converter.pop_profile(), converter.pop_iri_cache_counts()
+    except:
+        traceback.print_exc()
+        return index, None, None, None, None, None
+
+
+def _burstConvertShard(shard):
+    """The method called by the pool for every byte range of the file in the parallel processing initiated in :func:`_parallel_sharded`.
+    Returns the converted shard, its errors, the number of the next row, the position of the next shard, its profile
+    and the hits and misses of the IRI cache while converting it."""
     try:
-        count, rows = enumerated_rows
-        c = BurstConverter(identifier, columns, schema,
-                           metadata_graph, encoding, output_format)
+        start, end, first_row = shard
 
-        logger.info("Process {}, nr {}, {} rows".format(
-            mp.current_process().name, count, len(rows)))
+        logger.info("Process {}, bytes {}-{}, starting at row {}".format(
+            mp.current_process().name, start, end, first_row))
 
-        result = c.process(count, rows, chunksize)
+        with open(_worker_reader['file_name'], 'rb') as f:
+            f.seek(start)
+            data = io.BytesIO(f.read(end - start))
+
+        rows = csv.DictReader(data,
+                              fieldnames=_worker_reader['fieldnames'],
+                              encoding=_worker_reader['encoding'],
+                              delimiter=_worker_reader['delimiter'],
+                              quotechar=_worker_reader['quotechar'])
+
+        # With a chunksize of 1, the count is the row number of the first row
+        result = _worker_converter.process(first_row, rows, 1)
 
         logger.info("Process {} done".format(mp.current_process().name))
+        return result, _worker_converter.pop_errors(), _worker_converter.next_row, end, _worker_converter.pop_profile(), \
+            _worker_converter.pop_iri_cache_counts()
+    except:
+        traceback.print_exc()
+
 
-        return result
+def _burstConvert(chunk):
+    """The method called by the pool for every chunk of rows in the parallel processing initiated in :func:`_parallel`.
+    Returns the converted chunk, its errors, the number of the next row (and no shard position), its profile and the
+    hits and misses of the IRI cache while converting it."""
+    try:
+        first_row, rows = chunk
+
+        logger.info("Process {}, row {}, {} rows".format(
+            mp.current_process().name, first_row, len(rows)))
+
+        result = _worker_converter.process(first_row, rows, 1)
+
+        logger.info("Process {} done".format(mp.current_process().name))
+        return result, _worker_converter.pop_errors(), _worker_converter.next_row, None, _worker_converter.pop_profile(), \
+            _worker_converter.pop_iri_cache_counts()
     except:
         traceback.print_exc()
 
 
-class BurstConverter(object):
-    """The actual converter, that processes the chunk of lines from the CSV file, and uses the instructions from the ``schema`` graph to produce RDF."""
+def null_values(csvw_null):
+    """Returns the (string) null values given by a ``csvw:null`` specification, which can be a single value or
+    several. An rdf:List of (column name, null value) pairs is not a null value of the cell itself."""
+    if csvw_null is None or isinstance(csvw_null, Item):
+        return []
+    if isinstance(csvw_null, list):
+        return [parse_value(n) for n in csvw_null if not isinstance(n, Item)]
+    return [parse_value(csvw_null)]
+
+
+class ColumnPlan(object):
+    """A flat, pre-resolved view of one CSVW column specification.
+
+    Building an :class:`Item` per cell and querying the metadata graph for every attribute is more
+    expensive than the conversion itself, so :class:`BurstConverter` resolves each column once into
+    one of these and drives :meth:`BurstConverter.process` from the plan alone."""
+
+    __slots__ = ('key', 'name', 'label', 'virtual', 'value', 'about_url', 'value_url', 'property_url',
+                 'datatype', 'datatype_ref', 'lang', 'collection_url', 'scheme_url',
+                 'nulls', 'null_pairs', 'column_id', 'row_only_iri')
+
+    def __init__(self, column, metadata_graph, schema_nulls=()):
+        c = Item(metadata_graph, column)
+
+        # The raw key used to look the cell up in the row, and the parsed name used everywhere else
+        self.key = str(c.csvw_name)
+        self.name = parse_value(c.csvw_name)
+        self.virtual = parse_value(c.csvw_virtual)
+        self.value = parse_value(c.csvw_value)
+        self.about_url = parse_value(c.csvw_aboutUrl)
+        self.value_url = parse_value(c.csvw_valueUrl)
+        self.datatype = parse_value(c.csvw_datatype)
+        self.datatype_ref = URIRef(self.datatype) if self.datatype is not None else None
+        self.lang = c.csvw_lang
+        self.collection_url = c.csvw_collectionUrl
+        self.scheme_url = c.csvw_schemeUrl
+
+        # If propertyUrl is specified, use it, otherwise use the column name
+        if c.csvw_propertyUrl is not None:
+            self.property_url = c.csvw_propertyUrl
+        elif "" in metadata_graph.namespaces():
+            self.property_url = metadata_graph.namespaces()[""][self.name]
+        else:
+            self.property_url = "{}{}".format(get_namespaces()['sdv'], self.name)
+
+        # How the column is referred to in error reports (virtual columns have no name)
+        self.label = self.name if self.name is not None else str(self.property_url)
+
+        # All values of a cell that mean it should be skipped: the empty string (unless parseOnEmpty is set),
+        # and the null value(s) of both the column and the table
+        csvw_null = c.csvw_null
+        nulls = set(schema_nulls)
+        nulls.update(null_values(csvw_null))
+        if str(c.csvw_parseOnEmpty) == "true":
+            nulls.discard('')
+        else:
+            nulls.add('')
+        self.nulls = frozenset(nulls)
+
+        # If the null values are specified in an array, they are (column name, null value) pairs
+        # that are checked against the whole row
+        if isinstance(csvw_null, Item):
+            nulls = Collection(metadata_graph, BNode(csvw_null.identifier))
+            self.null_pairs = []
+            for n in nulls:
+                n = Item(metadata_graph, n)
+                self.null_pairs.append((str(n.csvw_name), str(n.csvw_null)))
+        else:
+            self.null_pairs = None
+
+        self.column_id = URIRef(c['@id']) if '@id' in c else None
+
+        # With "iriValidation": "row", only the values filled into the URL patterns of this column are validated
+        self.row_only_iri = str(c.csvw_iriValidation) == "row"
+
+
+class ErrorCollector(object):
+    """Keeps account of the cells that could not be converted.
+
+    Counts the errors by column and error class, and keeps the details of the first ``max_samples`` errors.
+    With ``keep_rejected``, every row with a failing cell is kept as well (until it is written to the reject
+    file by :class:`CSVWConverter`). Collectors of chunks converted in parallel are combined with :meth:`merge`."""
+
+    def __init__(self, max_samples=10, keep_rejected=False):
+        self.max_samples = max_samples
+        self.keep_rejected = keep_rejected
+        self.counts = Counter()
+        self.samples = []
+        self.rejected = []
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def add(self, row_number, column, error):
+        """Counts a failing cell, and keeps it as a sample if there is still room for one"""
+        self.counts[(column, type(error).__name__)] += 1
+        if len(self.samples) < self.max_samples:
+            self.samples.append({'row': row_number, 'column': column, 'error': _describe(error)})
+            logger.debug("Could not convert column {} of row {}".format(column, row_number), exc_info=error)
+
+    def reject(self, row, errors):
+        """Keeps a row that had one or more failing cells, given as (column, error) pairs"""
+        if self.keep_rejected:
+            self.rejected.append({'row': row.get('_row'),
+                                  'errors': [{'column': column, 'error': _describe(error)} for column, error in errors],
+                                  'values': row})
+
+    def merge(self, other):
+        """Adds the counts and (as far as there is room) the samples of another collector"""
+        self.counts.update(other.counts)
+        self.samples.extend(other.samples[:max(0, self.max_samples - len(self.samples))])
+
+    def log_summary(self):
+        """Logs the number of failing cells per column and error class, and the samples"""
+        if not self.counts:
+            return
+        logger.warning("{} cells could not be converted:".format(len(self)))
+        for (column, error), count in self.counts.most_common():
+            logger.warning("  {:>10}  {}  ({})".format(count, column, error))
+        for sample in self.samples:
+            logger.warning("  row {row}, column {column}: {error}".format(**sample))
+
+
+def _describe(error):
+    return "{}: {}".format(type(error).__name__, error)
+
+
+# The stages of the conversion that are timed by a Profile, in the order of the report
+PROFILE_STAGES = ['read', 'render', 'iri', 'literal', 'add', 'serialize', 'write']
+
+
+class Profile(object):
+    """Cumulative timers and counters of the stages of the conversion, of the columns and of the chunks.
+
+    Functions wrapped with :meth:`timed` count their calls and the time spent in them, not counting the time spent
+    in other timed functions they call, so the stages add up. The time of a column runs from the start of one
+    cell to the start of the next, and includes the stages it calls. For every chunk the duration, the number of
+    rows and the peak resident memory of the process after the chunk are kept. Profiles of chunks converted in
+    parallel are combined with :meth:`merge`; the times of the workers add up, like CPU time."""
+
+    def __init__(self):
+        self.seconds = Counter()
+        self.calls = Counter()
+        self.column_seconds = Counter()
+        self.cells = Counter()
+        self.chunks = []
+        self._inner = 0.0
+        self._column = None
+        self._mark = 0.0
+
+    def add(self, stage, seconds, calls=1):
+        self.seconds[stage] += seconds
+        self.calls[stage] += calls
+
+    def timed(self, stage, func):
+        """Wraps ``func`` so that its calls are counted and timed as ``stage``"""
+        def timed_func(*args, **kwargs):
+            outer = self._inner
+            self._inner = 0.0
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.add(stage, elapsed - self._inner)
+                self._inner = outer + elapsed
+        return timed_func
+
+    def timed_iter(self, stage, iterable):
+        """Yields from ``iterable``, timing every item as ``stage``"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add(stage, time.perf_counter() - start)
+            yield item
+
+    def cell(self, column):
+        """Starts timing a cell of ``column``, which ends the cell before it. None ends the last cell"""
+        now = time.perf_counter()
+        if self._column is not None:
+            self.column_seconds[self._column] += now - self._mark
+            self.cells[self._column] += 1
+        self._column = column
+        self._mark = now
+
+    def chunk(self, first_row, rows, seconds):
+        self.chunks.append({'process': mp.current_process().name,
+                            'first_row': first_row,
+                            'rows': rows,
+                            'seconds': round(seconds, 6),
+                            'peak_rss_mb': round(peak_rss_mb(), 1)})
+
+    def pop(self):
+        """Returns what was counted since the last call, and starts counting from scratch"""
+        popped = Profile()
+        popped.merge(self)
+        self.seconds.clear()
+        self.calls.clear()
+        self.column_seconds.clear()
+        self.cells.clear()
+        self.chunks = []
+        return popped
+
+    def merge(self, other):
+        self.seconds.update(other.seconds)
+        self.calls.update(other.calls)
+        self.column_seconds.update(other.column_seconds)
+        self.cells.update(other.cells)
+        self.chunks.extend(other.chunks)
+
+    def as_dict(self):
+        return {'stages': {stage: {'seconds': round(self.seconds[stage], 6), 'calls': self.calls[stage]}
+                           for stage in PROFILE_STAGES if stage in self.calls},
+                'columns': {column: {'seconds': round(seconds, 6), 'cells': self.cells[column]}
+                            for column, seconds in self.column_seconds.most_common()},
+                'chunks': sorted(self.chunks, key=lambda chunk: chunk['first_row']),
+                'peak_rss_mb': max([chunk['peak_rss_mb'] for chunk in self.chunks] + [round(peak_rss_mb(), 1)])}
+
+    def log_table(self):
+        """Logs the time per stage and per column, and the slowest chunk"""
+        total = sum(self.seconds.values())
+        logger.info("{:<40} {:>10} {:>12} {:>6}".format('stage', 'seconds', 'calls', '%'))
+        for stage in PROFILE_STAGES:
+            if stage in self.calls:
+                logger.info("{:<40} {:>10.3f} {:>12} {:>6.1%}".format(
+                    stage, self.seconds[stage], self.calls[stage], self.seconds[stage] / total if total else 0))
+        logger.info("{:<40} {:>10} {:>12} {:>6}".format('column', 'seconds', 'cells', 'µs'))
+        for column, seconds in self.column_seconds.most_common():
+            logger.info("{:<40} {:>10.3f} {:>12} {:>6.1f}".format(
+                column, seconds, self.cells[column], 1e6 * seconds / self.cells[column]))
+        if self.chunks:
+            slowest = max(self.chunks, key=lambda chunk: chunk['seconds'])
+            logger.info("{} chunks, the slowest took {:.3f}s for {} rows (from row {}, in {})".format(
+                len(self.chunks), slowest['seconds'], slowest['rows'], slowest['first_row'], slowest['process']))
+            logger.info("Peak memory {} MB per process, after the chunk from row {}".format(
+                max(chunk['peak_rss_mb'] for chunk in self.chunks),
+                max(self.chunks, key=lambda chunk: chunk['peak_rss_mb'])['first_row']))
+
+
+def peak_rss_mb():
+    """The peak resident memory of this process so far, in MB"""
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+# The metrics written by Metrics, with their Prometheus type and help text
+METRICS = [
+    ('cow_rows_total', 'counter', "Rows of the source file converted"),
+    ('cow_triples_total', 'counter', "Triples (lines) written to the target file"),
+    ('cow_bytes_written_total', 'counter', "Bytes written to the target file (before compression)"),
+    ('cow_chunks_total', 'counter', "Chunks written to the target file"),
+    ('cow_failed_cells_total', 'counter', "Cells that could not be converted"),
+    ('cow_rows_per_second', 'gauge', "Rows converted per second since the start of the conversion"),
+    ('cow_queue_depth', 'gauge', "Chunks submitted to the processes and not yet written"),
+    ('cow_expected_rows', 'gauge', "Estimated number of rows in the source file"),
+    ('cow_eta_seconds', 'gauge', "Estimated number of seconds until the conversion is done"),
+    ('cow_last_chunk_age_seconds', 'gauge', "Seconds since the last chunk was written"),
+    ('cow_running', 'gauge', "Whether the conversion is still running"),
+]
+
+
+class Metrics(object):
+    """Live metrics of a running conversion, for spotting stalls and tuning the number of processes.
+
+    Every chunk written to the target file is counted (:meth:`written`), and the latency of every chunk, from
+    submitting it to the processes until its result is taken, is kept for the last ``window`` chunks
+    (:meth:`completed`, called by :func:`bounded_imap`). While the conversion runs, a thread writes the metrics
+    every ``interval`` seconds to ``metrics_file``, in the Prometheus text format (as read by the textfile
+    collector of the node exporter), and/or to ``status_file`` as JSON. Both files are replaced at once, so they
+    are never read half written. The ETA is based on the number of rows estimated from the size of the source
+    file (there is none for compressed files). Without either file nothing is counted."""
+
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, source_file, metrics_file=None, status_file=None, interval=10, window=1000):
+        self.source_file = source_file
+        self.metrics_file = metrics_file
+        self.status_file = status_file
+        self.interval = interval
+        self.enabled = metrics_file is not None or status_file is not None
+        self.expected_rows = estimate_rows(source_file) if self.enabled else None
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.thread = None
+        self._reset(0)
+
+    def start(self, first_row=0):
+        """Starts counting (from row ``first_row``, when resuming) and writing the metrics"""
+        if not self.enabled:
+            return
+        self._reset(first_row)
+        if self.thread is None:
+            self.stopping = threading.Event()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _reset(self, first_row):
+        self.first_row = self.rows = first_row
+        self.triples = self.bytes = self.chunks = self.failed_cells = 0
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.queue_depth = 0
+        self.latencies.clear()
+        self.started = self.last_chunk = time.time()
+        self.running = True
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.write()
+            except Exception:
+                logger.warning("Could not write the metrics of {}".format(self.source_file), exc_info=True)
+
+    def stop(self):
+        """Stops the thread, and writes the final metrics"""
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        self.running = False
+        self.write()
+
+    def written(self, rows, out, failed_cells, lines=True):
+        """Counts a chunk of ``rows`` rows written as ``out``, where every line is a triple if ``lines``"""
+        if not self.enabled:
+            # Counting the lines is a pass over the whole output
+            return
+        with self.lock:
+            self.rows = rows
+            self.triples += sum(1 for line in out.split(b'\n') if line.strip()) if lines else 0
+            self.bytes += len(out)
+            self.chunks += 1
+            self.failed_cells += failed_cells
+            self.last_chunk = time.time()
+
+    def completed(self, latency, queue_depth):
+        """Counts the ``latency`` of a chunk, with the number of chunks still in the pipeline"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.latencies.append(latency)
+            self.latency_sum += latency
+            self.latency_count += 1
+            self.queue_depth = queue_depth
+            self.last_chunk = time.time()
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            elapsed = now - self.started
+            rate = (self.rows - self.first_row) / elapsed if elapsed > 0 else 0.0
+            expected = self.expected_rows
+            if not self.running:
+                expected = self.rows
+            elif expected is not None and self.rows > expected:
+                expected = None
+            latencies = sorted(self.latencies)
+            return {'file': self.source_file,
+                    'running': self.running,
+                    'started': datetime.datetime.utcfromtimestamp(self.started).isoformat(timespec='seconds'),
+                    'elapsed_seconds': round(elapsed, 3),
+                    'rows': self.rows,
+                    'triples': self.triples,
+                    'bytes_written': self.bytes,
+                    'chunks': self.chunks,
+                    'failed_cells': self.failed_cells,
+                    'rows_per_second': round(rate, 1),
+                    'queue_depth': self.queue_depth,
+                    'expected_rows': expected,
+                    'eta_seconds': round((expected - self.rows) / rate, 1) if expected is not None and rate else None,
+                    'last_chunk_age_seconds': round(now - self.last_chunk, 3),
+                    'chunk_latency_seconds': {str(q): round(latencies[min(int(q * len(latencies)), len(latencies) - 1)], 6)
+                                              for q in self.QUANTILES} if latencies else {},
+                    'chunk_latency_seconds_sum': round(self.latency_sum, 6),
+                    'chunk_latency_seconds_count': self.latency_count}
+
+    def prometheus(self, status):
+        """The ``status`` in the Prometheus text format"""
+        source_file = self.source_file.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        label = '{{file="{}"}}'.format(source_file)
+        values = {'cow_rows_total': status['rows'],
+                  'cow_triples_total': status['triples'],
+                  'cow_bytes_written_total': status['bytes_written'],
+                  'cow_chunks_total': status['chunks'],
+                  'cow_failed_cells_total': status['failed_cells'],
+                  'cow_rows_per_second': status['rows_per_second'],
+                  'cow_queue_depth': status['queue_depth'],
+                  'cow_expected_rows': status['expected_rows'],
+                  'cow_eta_seconds': status['eta_seconds'],
+                  'cow_last_chunk_age_seconds': status['last_chunk_age_seconds'],
+                  'cow_running': int(status['running'])}
+        lines = []
+        for name, kind, description in METRICS:
+            if values[name] is None:
+                continue
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.append("{}{} {}".format(name, label, values[name]))
+        lines.append("# HELP cow_chunk_latency_seconds Seconds from submitting a chunk until its result is taken")
+        lines.append("# TYPE cow_chunk_latency_seconds summary")
+        for quantile, latency in status['chunk_latency_seconds'].items():
+            lines.append('cow_chunk_latency_seconds{{file="{}",quantile="{}"}} {}'.format(source_file, quantile, latency))
+        lines.append("cow_chunk_latency_seconds_sum{} {}".format(label, status['chunk_latency_seconds_sum']))
+        lines.append("cow_chunk_latency_seconds_count{} {}".format(label, status['chunk_latency_seconds_count']))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Replaces the metrics and/or status file with the current metrics"""
+        status = self.snapshot()
+        for file_name, content in ((self.metrics_file, lambda: self.prometheus(status)),
+                                   (self.status_file, lambda: json.dumps(status, indent=1))):
+            if file_name is None:
+                continue
+            temporary_file = "{}.tmp".format(file_name)
+            with open(temporary_file, 'w') as f:
+                f.write(content())
+            os.replace(temporary_file, file_name)
+
+
+def estimate_rows(file_name, budget=DETECTION_BUDGET):
+    """Estimates the number of data rows of a CSV file from the length of the lines in its first ``budget``
+    bytes. Returns None for compressed files, of which the size says little"""
+    if compression_of(file_name):
+        return None
+    size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as f:
+        head = f.read(budget)
+    lines = head.count(b'\n')
+    if len(head) == size:
+        # The whole file, of which the last line may not end with a newline (the first is the header)
+        return lines if head and not head.endswith(b'\n') else max(lines - 1, 0)
+    if lines == 0:
+        return None
+    return int(size * lines / len(head)) - 1
+
+
+class QuadWriter(object):
+    """Formats triples straight into N-Quads (or N-Triples) as they are produced.
+
+    Stands in for the assertion graph of a :class:`BurstConverter` (it has the same ``add`` method), but
+    keeps no store or indexes: the formatted lines are only buffered until :meth:`flush` is called.
+    Duplicate lines are dropped within a chunk only when ``deduplicate`` is set."""
+
+    def __init__(self, identifier, output_format='nquads', deduplicate=False):
+        if output_format == 'nquads':
+            self.suffix = " {} .\n".format(URIRef(identifier).n3())
+            self.encoding, self.errors = UTF8, 'replace'
+        else:
+            # N-Triples are ascii encoded, using the same escapes as the rdflib serializer
+            self.suffix = " .\n"
+            self.encoding, self.errors = 'ascii', 'nt_escape'
+
+        self.lines = []
+        self.seen = set() if deduplicate else None
+
+    def add(self, triple):
+        """Formats a single (s, p, o) triple and appends it to the buffer"""
+        s, p, o = triple
+        if isinstance(o, Literal):
+            o = quote_literal(o)
+        else:
+            o = o.n3()
+        line = "{} {} {}{}".format(s.n3(), p.n3(), o, self.suffix)
+
+        if self.seen is not None:
+            if line in self.seen:
+                return
+            self.seen.add(line)
+        self.lines.append(line)
+
+    def flush(self):
+        """Returns the buffered lines as encoded bytes, and empties the buffer"""
+        out = "".join(self.lines).encode(self.encoding, self.errors)
+        self.lines = []
+        if self.seen is not None:
+            self.seen.clear()
+        return out
+
+
+# Local names that can be written as a prefixed name without escaping
+_LOCAL_NAME = re.compile(r'[A-Za-z0-9_](?:[A-Za-z0-9_.-]*[A-Za-z0-9_-])?$')
+_PREFIX = re.compile(r'[A-Za-z][A-Za-z0-9_-]*$')
+
+# The formats that transcode can write
+transcode_formats = ['nt', 'turtle', 'trig']
+
+
+def transcode(nquads_file, output_file, output_format, namespaces=None, window=10000):
+    """Rewrites the N-Quads in (text) file ``nquads_file`` as N-Triples, Turtle or TriG to ``output_file``, line by line.
+
+    Parsing the N-Quads into a graph and serializing that graph needs the whole dataset (several times over)
+    in memory. The terms in N-Quads are already valid in the other formats, so they are only regrouped here:
+    for Turtle and TriG, statements are grouped by graph and subject within windows of ``window`` statements, so
+    a subject that is spread over the file may be written more than once (which is perfectly valid). IRIs in
+    the ``namespaces`` (a dictionary of prefix to namespace) are abbreviated to prefixed names."""
+    if output_format not in transcode_formats:
+        raise Exception("Cannot transcode N-Quads to {}, only to {}".format(output_format, ", ".join(transcode_formats)))
+
+    statements = nquads_statements(nquads_file)
+    if output_format == 'nt':
+        for s, p, o, g in statements:
+            output_file.write("{} {} {} .\n".format(s, p, o))
+        return
+
+    prefixes = {}
+    for prefix, namespace in (namespaces or {}).items():
+        if isinstance(prefix, str) and _PREFIX.match(prefix):
+            prefixes.setdefault(str(namespace), prefix)
+    for namespace, prefix in sorted(prefixes.items(), key=lambda item: item[1]):
+        output_file.write("@prefix {}: <{}> .\n".format(prefix, namespace))
+    output_file.write("\n")
+
+    def term(t):
+        if t.startswith('<'):
+            return _prefixed_name(t, prefixes)
+        if t.startswith('"') and t.endswith('>'):
+            literal, datatype = t.rsplit('^^', 1)
+            return "{}^^{}".format(literal, _prefixed_name(datatype, prefixes))
+        return t
+
+    while True:
+        # Graph -> subject -> predicate -> objects, in the order in which they are first seen
+        graphs = {}
+        for s, p, o, g in islice(statements, window):
+            if output_format == 'turtle':
+                g = None
+            objects = graphs.setdefault(g, {}).setdefault(s, {}).setdefault(p, [])
+            objects.append(o)
+        if not graphs:
+            break
+
+        for g, subjects in graphs.items():
+            indent = ""
+            if g is not None:
+                output_file.write("{} {{\n".format(term(g)))
+                indent = "    "
+            for s, predicates in subjects.items():
+                output_file.write(indent + term(s))
+                separator = " "
+                for p, objects in predicates.items():
+                    predicate = "a" if p == "<{}>".format(RDF.type) else term(p)
+                    output_file.write("{}{} {}".format(separator, predicate, " , ".join(term(o) for o in objects)))
+                    separator = " ;\n{}    ".format(indent)
+                output_file.write(" .\n")
+            if g is not None:
+                output_file.write("}\n")
+            output_file.write("\n")
+
+
+def _prefixed_name(iri, prefixes):
+    """Abbreviates an IRI (in <> notation) to a prefixed name, if its namespace is one of the ``prefixes``"""
+    value = iri[1:-1]
+    split = max(value.rfind('/'), value.rfind('#')) + 1
+    prefix = prefixes.get(value[:split])
+    if prefix is not None and _LOCAL_NAME.match(value[split:]):
+        return "{}:{}".format(prefix, value[split:])
+    return iri
 
-    def __init__(self, identifier, columns, schema, metadata_graph, encoding, output_format):
-        self.ds = Dataset()
-        # self.ds = apply_default_namespaces(Dataset())
-        self.g = self.ds.graph(URIRef(identifier))
+
+class BurstConverter(object):
+    """The actual converter, that processes the chunk of lines from the CSV file, and uses the instructions from the ``schema`` graph to produce RDF.
+
+    The prov:wasDerivedFrom triple that relates a property to its column is produced once by every converter, unless
+    ``repeat_provenance`` is set: then it is produced for every row, as the incremental conversion counts the
+    quads that every row produces."""
+
+    def __init__(self, identifier, columns, schema, metadata_graph, encoding, output_format, streaming=False, deduplicate=False, iri_cache_size=IRI_CACHE_SIZE, error_samples=10, keep_rejected=False, profile=False, repeat_provenance=False):
+        self.identifier = identifier
+        # The (property, column) pairs whose prov:wasDerivedFrom triple was produced, or None if it is produced for every row
+        self.derived = None if repeat_provenance else set()
+        self.errors = ErrorCollector(error_samples, keep_rejected)
+        # When profiling, the stages are timed by wrapping the functions that implement them (see Profile)
+        self.profile = Profile() if profile else None
+        self._literal = Literal
+        if profile:
+            self.render_pattern = self.profile.timed('render', self.render_pattern)
+            self.expandURL = self.profile.timed('iri', self.expandURL)
+            self._literal = self.profile.timed('literal', Literal)
+        if streaming:
+            # Skip the in-memory Dataset altogether, triples are formatted as they are produced
+            self.ds = None
+            self.g = QuadWriter(identifier, output_format, deduplicate)
+            if profile:
+                self.g.add = self.profile.timed('add', self.g.add)
+        else:
+            self._new_dataset()
 
         self.columns = columns
         self.schema = schema
@@ -467,16 +2471,41 @@ class BurstConverter(object):
         self.output_format = output_format
 
         self.templates = {}
+        self.iri_templates = {}
+        self.next_row = 0
+
+        # Most IRIs (property URLs, codes) repeat across rows and columns, so the validated IRIs are cached
+        self.to_iri = lru_cache(maxsize=iri_cache_size)(_to_valid_iri)
+        # The hits and misses of the IRI cache at the last call of pop_iri_cache_counts
+        self._iri_cache_counts = (0, 0)
 
         self.aboutURLSchema = self.schema.csvw_aboutUrl
+        # Resolve the column specifications once, rather than for every cell
+        schema_nulls = null_values(self.schema.csvw_null)
+        self.plan = [ColumnPlan(c, self.metadata_graph, schema_nulls) for c in self.columns]
+
+    def _new_dataset(self):
+        """Starts an empty Dataset (and assertion graph), so that the converter can be reused for the next chunk"""
+        self.ds = Dataset()
+        # self.ds = apply_default_namespaces(Dataset())
+        self.g = self.ds.graph(URIRef(self.identifier))
+        if self.profile is not None:
+            self.g.add = self.profile.timed('add', self.g.add)
+
+    def pop_errors(self):
+        """Returns the errors collected since the last call, and starts a new collection"""
+        errors = self.errors
+        self.errors = ErrorCollector(errors.max_samples, errors.keep_rejected)
+        return errors
+
+    def pop_profile(self):
+        """Returns the profile of the chunks converted since the last call (None when not profiling)"""
+        return self.profile.pop() if self.profile is not None else None
 
-    def equal_to_null(self, nulls, row):
+    def equal_to_null(self, null_pairs, row):
         """Determines whether a value in a cell matches a 'null' value as specified in the CSVW schema)"""
-        for n in nulls:
-            n = Item(self.metadata_graph, n)
-            col = str(n.csvw_name)
-            val = str(n.csvw_null)
-            if row[col] == val:
+        for col, val in null_pairs:
+            if row.get(col) == val:
                 # logger.debug("Value of column {} ('{}') is equal to specified 'null' value: '{}'".format(col, unicode(row[col]).encode('utf-8'), val))
                 # There is a match with null value
                 return True
@@ -487,12 +2516,18 @@ class BurstConverter(object):
         """Process the rows fed to the converter. Count and chunksize are used to determine the
         current row number (needed for default observation identifiers)"""
         obs_count = count * chunksize
+        first_row = obs_count
+
+        profile = self.profile
+        literal = self._literal
+        if profile is not None:
+            started = time.perf_counter()
+            rows = profile.timed_iter('read', rows)
 
         # logger.info("Row: {}".format(obs_count)) #removed for readability
 
         # We iterate row by row, and then column by column, as given by the CSVW mapping file.
         mult_proc_counter = 0
-        iter_error_counter= 0
         for row in rows:
             # This fixes issue:10
             if row is None:
@@ -506,136 +2541,105 @@ class BurstConverter(object):
             row['_row'] = obs_count
             count += 1
 
-            # print(row)
-
-            # The self.columns dictionary gives the mapping definition per column in the 'columns'
+            # The self.plan list gives the resolved mapping definition per column in the 'columns'
             # array of the CSVW tableSchema definition.
 
             default_subject = self.expandURL(self.aboutURLSchema, row)
+            row_errors = []
 
-            for c in self.columns:
+            for c in self.plan:
                 s = None
-                c = Item(self.metadata_graph, c)
+                if profile is not None:
+                    profile.cell(c.label)
 
-                try:
-                    # Can also be used to prevent the triggering of virtual
-                    # columns!
-
-                    # Get the raw value from the cell in the CSV file
-                    value = row[str(c.csvw_name)]
-
-                    # This checks whether we should continue parsing this cell, or skip it.
-                    if self.isValueNull(value, c):
-                        continue
+                # Get the raw value from the cell in the CSV file (None for virtual columns, which have no
+                # c.csvw_name key in the row)
+                value = row.get(c.key)
 
-                    # If the null values are specified in an array, we need to parse it as a collection (list)
-                    elif isinstance(c.csvw_null, Item):
-                        nulls = Collection(self.metadata_graph, BNode(c.csvw_null.identifier))
+                # This checks whether we should continue parsing this cell, or skip it.
+                if self.isValueNull(value, c):
+                    continue
 
-                        if self.equal_to_null(nulls, row):
-                            # Continue to next column specification in this row, if the value is equal to (one of) the null values.
-                            continue
-                except:
-                    # No column name specified (virtual) because there clearly was no c.csvw_name key in the row.
-                    # logger.debug(traceback.format_exc()) #removed for readability
-                    iter_error_counter +=1
-                    if isinstance(c.csvw_null, Item):
-                        nulls = Collection(self.metadata_graph, BNode(c.csvw_null.identifier))
-                        if self.equal_to_null(nulls, row):
-                            # Continue to next column specification in this row, if the value is equal to (one of) the null values.
-                            continue
+                # If the null values are specified in an array, we need to check them against the row
+                if c.null_pairs is not None and self.equal_to_null(c.null_pairs, row):
+                    # Continue to next column specification in this row, if the value is equal to (one of) the null values.
+                    continue
 
                 try:
                     # This overrides the subject resource 's' that has been created earlier based on the
                     # schema wide aboutURLSchema specification.
-
-                    #TODO: set your environment correctly
-                    csvw_virtual = parse_value(c.csvw_virtual)
-                    csvw_name = parse_value(c.csvw_name)
-                    csvw_value = parse_value(c.csvw_value)
-                    csvw_about_url = parse_value(c.csvw_aboutUrl)
-                    csvw_value_url = parse_value(c.csvw_valueUrl)
-                    csvw_datatype = parse_value(c.csvw_datatype)
+                    csvw_about_url = c.about_url
+                    csvw_value_url = c.value_url
 
                     if csvw_about_url is not None:
-                        s = self.expandURL(csvw_about_url, row)
+                        s = self.expandURL(csvw_about_url, row, row_only=c.row_only_iri)
 
-                    p = self.get_property_url(c.csvw_propertyUrl, csvw_name, row)
+                    p = self.expandURL(c.property_url, row, row_only=c.row_only_iri)
 
                     if csvw_value_url is not None:
                         # This is an object property, because the value needs to be cast to a URL
-                        o = self.expandURL(csvw_value_url, row)
+                        o = self.expandURL(csvw_value_url, row, row_only=c.row_only_iri)
                         object_value = str(o)
                         if self.isValueNull(os.path.basename(object_value), c):
                             logger.debug("skipping empty value")
                             continue
 
-                        if csvw_virtual == 'true' and csvw_datatype is not None: 
-                            
-                            if URIRef(csvw_datatype) == XSD.anyURI:
+                        if c.virtual == 'true' and c.datatype is not None:
+
+                            if c.datatype_ref == XSD.anyURI:
                                 # Special case: this is a virtual column with object values that are URIs
                                 # For now using a test special property
-                                value = row[csvw_name]
+                                value = row[c.name]
                                 o = URIRef(iribaker.to_iri(value))
 
-                            if URIRef(csvw_datatype) == XSD.linkURI:
+                            if c.datatype_ref == XSD.linkURI:
                                 csvw_about_url = csvw_about_url[csvw_about_url.find("{"):csvw_about_url.find("}")+1]
-                                s = self.expandURL(csvw_about_url, row)
+                                s = self.expandURL(csvw_about_url, row, row_only=c.row_only_iri)
                                 # logger.debug("s: {}".format(s))
                                 csvw_value_url = csvw_value_url[csvw_value_url.find("{"):csvw_value_url.find("}")+1]
-                                o = self.expandURL(csvw_value_url, row)
+                                o = self.expandURL(csvw_value_url, row, row_only=c.row_only_iri)
                                 # logger.debug("o: {}".format(o))
 
                         # For coded properties, the collectionUrl can be used to indicate that the
                         # value URL is a concept and a member of a SKOS Collection with that URL.
-                        if c.csvw_collectionUrl is not None:
-                            collection = self.expandURL(c.csvw_collectionUrl, row)
+                        if c.collection_url is not None:
+                            collection = self.expandURL(c.collection_url, row, row_only=c.row_only_iri)
                             self.g.add((collection, RDF.type, SKOS['Collection']))
                             self.g.add((o, RDF.type, SKOS['Concept']))
                             self.g.add((collection, SKOS['member'], o))
 
                         # For coded properties, the schemeUrl can be used to indicate that the
                         # value URL is a concept and a member of a SKOS Scheme with that URL.
-                        if c.csvw_schemeUrl is not None:
-                            scheme = self.expandURL(c.csvw_schemeUrl, row)
+                        if c.scheme_url is not None:
+                            scheme = self.expandURL(c.scheme_url, row, row_only=c.row_only_iri)
                             self.g.add((scheme, RDF.type, SKOS['Scheme']))
                             self.g.add((o, RDF.type, SKOS['Concept']))
                             self.g.add((o, SKOS['inScheme'], scheme))
                     else:
                         # This is a datatype property
-                        if csvw_value is not None:
-                            value = self.render_pattern(csvw_value, row)
-                        elif csvw_name is not None:
-                            # print s
-                            # print c.csvw_name, self.encoding
-                            # print row[unicode(c.csvw_name)], type(row[unicode(c.csvw_name)])
-                            # print row[unicode(c.csvw_name)].encode('utf-8')
-                            # print '...'
-                            value = row[csvw_name]
+                        if c.value is not None:
+                            value = self.render_pattern(c.value, row)
+                        elif c.name is not None:
+                            value = row[c.name]
                         else:
                             raise Exception("No 'name' or 'csvw:value' attribute found for this column specification")
 
-                        p = self.get_property_url(c.csvw_propertyUrl, csvw_name, row)
-
-                        if csvw_datatype is not None:
-                            if URIRef(csvw_datatype) == XSD.anyURI:
+                        if c.datatype is not None:
+                            if c.datatype_ref == XSD.anyURI:
                                 # The xsd:anyURI datatype will be cast to a proper IRI resource.
                                 o = URIRef(iribaker.to_iri(value))
-                            elif URIRef(csvw_datatype) == XSD.string and c.csvw_lang is not None:
+                            elif c.datatype_ref == XSD.string and c.lang is not None:
                                 # If it is a string datatype that has a language, we turn it into a
                                 # language tagged literal
                                 # We also render the lang value in case it is a
                                 # pattern.
-                                o = Literal(value, lang=self.render_pattern(
-                                    c.csvw_lang, row))
+                                o = literal(value, lang=self.render_pattern(
+                                    c.lang, row))
                             else:
-                                # csvw_datatype = str(c.csvw_datatype)
-                                # print(type(csvw_datatype))
-                                # print(csvw_datatype)
-                                o = Literal(value, datatype=csvw_datatype, normalize=False)
+                                o = literal(value, datatype=c.datatype, normalize=False)
                         else:
                             # It's just a plain literal without datatype.
-                            o = Literal(value)
+                            o = literal(value)
 
 
                     # Add the triple to the assertion graph
@@ -643,12 +2647,24 @@ class BurstConverter(object):
                     self.g.add((s, p, o))
 
                     # Add provenance relating the propertyUrl to the column id
-                    if '@id' in c:
-                        self.g.add((p, PROV['wasDerivedFrom'], URIRef(c['@id'])))
+                    if c.column_id is not None:
+                        derived = self.derived
+                        if derived is None:
+                            self.g.add((p, PROV['wasDerivedFrom'], c.column_id))
+                        elif (p, c.column_id) not in derived:
+                            derived.add((p, c.column_id))
+                            self.g.add((p, PROV['wasDerivedFrom'], c.column_id))
+
+                except Exception as e:
+                    # Count the failing cell, rather than printing a traceback for every one of them
+                    self.errors.add(obs_count, c.label, e)
+                    row_errors.append((c.label, e))
+
+            if profile is not None:
+                profile.cell(None)
 
-                except:
-                    # print row[0], value
-                    traceback.print_exc()
+            if row_errors:
+                self.errors.reject(row, row_errors)
 
             # We increment the observation (row number) with one
             obs_count += 1
@@ -658,10 +2674,21 @@ class BurstConverter(object):
 
         logger.debug(
             "{} row skips caused by multiprocessing (multiple of chunksize exceeds number of rows in file)...".format(mult_proc_counter))
-        logger.debug(
-            "{} errors encountered while trying to iterate over a NoneType...".format(mult_proc_counter))
         logger.info("... done")
-        return self.ds.serialize(format=self.output_format)
+        # The number of the row that follows the rows of this chunk
+        self.next_row = obs_count
+        if profile is not None:
+            serialize = time.perf_counter()
+        if self.ds is None:
+            out = self.g.flush()
+        else:
+            out = self.ds.serialize(format=self.output_format)
+            self._new_dataset()
+        if profile is not None:
+            now = time.perf_counter()
+            profile.add('serialize', now - serialize)
+            profile.chunk(first_row, obs_count - first_row, now - started)
+        return out
 
     # def serialize(self):
     #     trig_file_name = self.file_name + '.trig'
@@ -673,57 +2700,31 @@ class BurstConverter(object):
 
     def render_pattern(self, pattern, row):
         """Takes a Jinja or Python formatted string, and applies it to the row value"""
-        # Significant speedup by not re-instantiating Jinja templates for every
-        # row.
-
-        if pattern in self.templates:
-            template = self.templates[pattern]
-        else:
-            template = self.templates[pattern] = Template(pattern)
-
-        # TODO This should take into account the special CSVW instructions such as {_row}
-        # First we interpret the url_pattern as a Jinja2 template, and pass all
-        # column/value pairs as arguments
-        # row = {str('Int'): int('104906'), str('Country'): str('Luxembourg'), str('_row'): 1, str('Rank'): str('2')}
-
-        # print(pattern)
-        # print(type(pattern))
-        # print(row)
-        # print(type(row))
-        # rendered_template = template.render(Int=120000)
-
-        rendered_template = template.render(**row)
-
+        # Significant speedup by compiling every pattern only once (see compile_pattern),
+        # rather than rendering a Jinja template for every row.
         try:
-            # We then format the resulting string using the standard Python2
-            # expressions
-            return rendered_template.format(**row)
-        except:
-            logger.warning(
-                "Could not apply python string formatting, probably due to mismatched curly brackets. IRI will be '{}'. ".format(rendered_template))
-            return rendered_template
-
-    def get_property_url(self, csvw_propertyUrl, csvw_name, row):
-         # If propertyUrl is specified, use it, otherwise use the column name
-        p = None
-        propertyUrl = None
-        if csvw_propertyUrl is not None:
-            p = self.expandURL(csvw_propertyUrl, row)
-        else:
-            if "" in self.metadata_graph.namespaces():
-                propertyUrl = self.metadata_graph.namespaces()[""][
-                    csvw_name]
-            else:
-                propertyUrl = "{}{}".format(get_namespaces()['sdv'],
-                    csvw_name)
-            p = self.expandURL(propertyUrl, row)
-        return p
+            render = self.templates[pattern]
+        except KeyError:
+            render = self.templates[pattern] = compile_pattern(pattern)
+
+        return render(row)
 
-    def expandURL(self, url_pattern, row, datatype=False):
-        """Takes a Jinja or Python formatted string, applies it to the row values, and returns it as a URIRef"""
+    def expandURL(self, url_pattern, row, datatype=False, row_only=False):
+        """Takes a Jinja or Python formatted string, applies it to the row values, and returns it as a URIRef.
+        With ``row_only``, only the values filled into the pattern are validated if the pattern allows for it."""
 
         unicode_url_pattern = parse_value(url_pattern)
 
+        if row_only:
+            try:
+                render = self.iri_templates[unicode_url_pattern]
+            except KeyError:
+                render = self.iri_templates[unicode_url_pattern] = compile_iri_pattern(unicode_url_pattern)
+            if render is not None:
+                iri = render(row)
+                if iri is not None:
+                    return URIRef(iri)
+
         url = self.render_pattern(unicode_url_pattern, row)
 
         # DEPRECATED
@@ -732,26 +2733,19 @@ class BurstConverter(object):
         #         url = url.replace(ns + ':', nsuri)
         #         break
 
-        try:
-            iri = iribaker.to_iri(url)
-            rfc3987.parse(iri, rule='IRI')
-        except:
-            raise Exception("Cannot convert `{}` to valid IRI".format(url))
+        return URIRef(self.to_iri(url))
+
+    def iri_cache_info(self):
+        """Returns the hits, misses and size of the cache of validated IRIs"""
+        return self.to_iri.cache_info()
 
-        return URIRef(iri)
+    def pop_iri_cache_counts(self):
+        """Returns the hits and misses of the IRI cache since the last call, so that those of the workers can be summed"""
+        info = self.to_iri.cache_info()
+        hits, misses = self._iri_cache_counts
+        self._iri_cache_counts = (info.hits, info.misses)
+        return info.hits - hits, info.misses - misses
 
     def isValueNull(self, value, c):
         """This checks whether we should continue parsing this cell, or skip it because it is empty or a null value."""
-        try:
-            if len(value) == 0 and str(c.csvw_parseOnEmpty) == "true":
-                # print("Not skipping empty value")
-                return False #because it should not be skipped
-            elif len(value) == 0 or value == parse_value(c.csvw_null) or value in [parse_value(n) for n in c.csvw_null] or value == parse_value(self.schema.csvw_null):
-                # Skip value if length is zero and equal to (one of) the null value(s)
-                # logger.debug(
-                #     "Length is 0 or value is equal to specified 'null' value")
-                return True
-        except:
-            # logger.debug("null does not exist or is not a list.") #this line will print for every cell in a csv without a defined null value.
-            pass
-        return False
+        return value in c.nulls
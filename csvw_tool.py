@@ -2,11 +2,13 @@
 
 #try:
     # git install
-from src.converter.csvw import CSVWConverter, build_schema, extensions
+from src.converter.csvw import CSVWConverter, build_schema, extensions, IRI_CACHE_SIZE, transcode, transcode_formats, open_compressed, DETECTION_BUDGET, convert_batch
+from src.converter.util import get_namespaces
 #except ImportError:
     # pip install
     #from cow_csvw.converter.csvw import CSVWConverter, build_schema, extensions
 import os
+import io
 import datetime
 import argparse
 import sys
@@ -19,11 +21,18 @@ from pathlib import Path
 
 class COW(object):
 
-    def __init__(self, mode=None, files=None, dataset=None, delimiter=None, encoding=None, quotechar='\"', processes=4, chunksize=5000, base="https://iisg.amsterdam/", output_format='nquads'):
+    def __init__(self, mode=None, files=None, dataset=None, delimiter=None, encoding=None, quotechar='\"', processes=4, chunksize=5000, base="https://iisg.amsterdam/", output_format='nquads', streaming=False, deduplicate=False, sharded=False, iri_cache_size=IRI_CACHE_SIZE, rejects=False, checkpoint=False, resume=False, incremental=False, delta_store=None, compression=None, infer=True, sample_size=100000, detection_budget=DETECTION_BUDGET, batch=False, profile=False, metrics=False, status=False, metrics_interval=10):
         """
         COW entry point
         """
 
+        # The converters tune 'auto' processes to their file, a batch of files or the schema builder use all CPUs
+        pool_processes = (os.cpu_count() or 1) if processes == 'auto' else processes
+
+        # In batch mode the files share one pool of processes, and are converted together afterwards
+        batch = batch and pool_processes > 1 and not incremental
+        converters = []
+
         for source_file in files:
             if mode == 'build':
                 print("Building schema for {}".format(source_file))
@@ -38,23 +47,26 @@ class COW(object):
                     os.rename(path, new_path)
                     print(f"Backed up prior version of schema to {new_path}")
 
-                build_schema(source_file, target_file, dataset_name=dataset, delimiter=delimiter, encoding=encoding, quotechar=quotechar, base=base)
+                build_schema(source_file, target_file, dataset_name=dataset, delimiter=delimiter, encoding=encoding, quotechar=quotechar, base=base,
+                             infer=infer, sample_size=sample_size if sample_size else None, processes=pool_processes,
+                             detection_budget=detection_budget)
 
             elif mode == 'convert':
                 print("Converting {} to RDF".format(source_file))
 
                 try:
-                    c = CSVWConverter(source_file, delimiter=delimiter, quotechar=quotechar, encoding=encoding, processes=processes, chunksize=chunksize, output_format='nquads', base=base)
+                    c = CSVWConverter(source_file, delimiter=delimiter, quotechar=quotechar, encoding=encoding, processes=processes, chunksize=chunksize, output_format='nquads', base=base, streaming=streaming, deduplicate=deduplicate, sharded=sharded, iri_cache_size=iri_cache_size,
+                                      reject_file=source_file + '.rejected.jsonl' if rejects else None,
+                                      checkpoint=checkpoint, resume=resume, incremental=incremental, delta_store=delta_store,
+                                      compression=compression, detection_budget=detection_budget, profile=profile,
+                                      metrics_file=source_file + '.prom' if metrics else None,
+                                      status_file=source_file + '.status.json' if status else None,
+                                      metrics_interval=metrics_interval)
+                    if batch:
+                        converters.append(c)
+                        continue
                     c.convert()
-
-                    # We convert the output serialization if different from nquads
-                    if output_format not in ['nquads']:
-                        with open(source_file + '.' + 'nq', 'rb') as nquads_file:
-                            g = ConjunctiveGraph()
-                            g.parse(nquads_file, format='nquads')
-                        # We serialize in the requested format
-                        with open(source_file + '.' + extensions[output_format], 'w') as output_file:
-                            output_file.write(g.serialize(format=output_format).decode())
+                    self.reserialize(c, source_file, output_format, compression, incremental)
 
                 except ValueError:
                     raise
@@ -64,6 +76,46 @@ class COW(object):
             else:
                 print("Whoops for file {}".format(source_file))
 
+        if converters:
+            convert_batch(converters, processes=pool_processes)
+            for c in converters:
+                try:
+                    self.reserialize(c, c.file_name, output_format, compression, incremental)
+                except:
+                    print("Something went wrong, skipping {}.".format(c.file_name))
+                    traceback.print_exc(file=sys.stdout)
+
+    def reserialize(self, c, source_file, output_format, compression, incremental):
+        """
+        Convert the N-Quads output of `c` to the requested serialization, if different from nquads
+        """
+
+        # The additions and deletions of incremental conversion are always N-Quads. The line based
+        # formats are transcoded while reading the N-Quads, the others need the whole graph in memory
+        output_file_name = source_file + '.' + extensions[output_format]
+        if compression:
+            output_file_name += '.' + compression
+        if output_format in transcode_formats and not incremental:
+            with io.TextIOWrapper(open_compressed(c.target_file), encoding='utf-8') as nquads_file:
+                with io.TextIOWrapper(open_compressed(output_file_name, 'wb'), encoding='utf-8') as output_file:
+                    transcode(nquads_file, output_file, output_format, get_namespaces())
+        elif output_format not in ['nquads'] and not incremental:
+            with open_compressed(c.target_file) as nquads_file:
+                g = ConjunctiveGraph()
+                g.parse(nquads_file, format='nquads')
+            # We serialize in the requested format
+            with open_compressed(output_file_name, 'wb') as output_file:
+                output_file.write(g.serialize(format=output_format, encoding='utf-8'))
+
+def auto_or_int(value):
+    """An argument that is either a number or 'auto'"""
+    if value == 'auto':
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid value: '{}' (use a number or 'auto')".format(value))
+
 def main():
     parser = argparse.ArgumentParser(description="Not nearly CSVW compliant schema builder and RDF converter")
     parser.add_argument('mode', choices=['convert','build'], default='convert', help='Use the schema of the `file` specified to convert it to RDF, or build a schema from scratch.')
@@ -72,11 +124,30 @@ def main():
     parser.add_argument('--delimiter', dest='delimiter', default=None, type=str, help="The delimiter used in the CSV file(s)")
     parser.add_argument('--quotechar', dest='quotechar', default='\"', type=str, help="The character used as quotation character in the CSV file(s)")
     parser.add_argument('--encoding', dest='encoding', default=None, type=str, help="The character encoding used in the CSV file(s)")
-    parser.add_argument('--processes', dest='processes', default='4', type=int, help="The number of processes the converter should use")
-    parser.add_argument('--chunksize', dest='chunksize', default='5000', type=int, help="The number of rows processed at each time")
+    parser.add_argument('--processes', dest='processes', default='4', type=auto_or_int, help="The number of processes the converter should use, or `auto` to pick it from the number of CPUs, the available memory, the size of the file and the time it takes to convert its first rows")
+    parser.add_argument('--chunksize', dest='chunksize', default='5000', type=auto_or_int, help="The number of rows processed at each time, or `auto` to pick it like the processes and keep adjusting it so that a chunk takes about a second to convert")
     parser.add_argument('--base', dest='base', default='https://iisg.amsterdam/', type=str, help="The base for URIs generated with the schema (only relevant when `build`ing a schema)")
     parser.add_argument('--format', '-f', dest='format', nargs='?', choices=['xml', 'n3', 'turtle', 'nt', 'pretty-xml', 'trix', 'trig', 'nquads'], default='nquads', help="RDF serialization format")
 
+    parser.add_argument('--stream', dest='streaming', action='store_true', help="Write N-Quads directly as they are produced, instead of building an in-memory graph per chunk")
+    parser.add_argument('--sharded', dest='sharded', action='store_true', help="Let every process read and parse its own byte range of the CSV file (only relevant with more than one process)")
+    parser.add_argument('--iri-cache-size', dest='iri_cache_size', default=IRI_CACHE_SIZE, type=int, help="The number of validated IRIs each process keeps in its cache")
+    parser.add_argument('--rejects', dest='rejects', action='store_true', help="Write the rows with cells that could not be converted to `file`.rejected.jsonl")
+    parser.add_argument('--checkpoint', dest='checkpoint', action='store_true', help="Record the progress of the conversion in `file`.nq.checkpoint.json after every chunk, so that it can be resumed")
+    parser.add_argument('--resume', dest='resume', action='store_true', help="Continue an interrupted conversion from its checkpoint (implies `--checkpoint`)")
+    parser.add_argument('--incremental', dest='incremental', action='store_true', help="Only convert the rows that changed since the previous delivery of the file, and write the quads to add and delete to `file`.additions.nq and `file`.deletions.nq")
+    parser.add_argument('--delta-store', dest='delta_store', default=None, type=str, help="The SQLite database that keeps the state of incremental conversion between deliveries (default: `file`.delta.sqlite)")
+    parser.add_argument('--compress', dest='compression', choices=['gz', 'bz2', 'zst'], default=None, help="Compress the output files (compressed input files, ending in .gz, .bz2 or .zst, are always read as such)")
+    parser.add_argument('--no-infer', dest='infer', action='store_false', help="Do not infer the datatypes of the columns when `build`ing a schema, make them all strings")
+    parser.add_argument('--sample-size', dest='sample_size', default=100000, type=int, help="The number of rows to infer the datatypes from when `build`ing a schema, 0 to read the whole file (in parallel)")
+    parser.add_argument('--detection-budget', dest='detection_budget', default=DETECTION_BUDGET, type=int, help="The number of bytes read to detect the encoding and delimiter, if not given (the result is cached in `file`.dialect.json)")
+    parser.add_argument('--batch', dest='batch', action='store_true', help="Convert all files with one shared pool of processes, keeping the processes busy across file boundaries (only relevant with more than one file and process)")
+    parser.add_argument('--profile', dest='profile', action='store_true', help="Time the stages of the conversion and the columns in all processes, and report them in a table and in `file`.profile.json")
+    parser.add_argument('--metrics', dest='metrics', action='store_true', help="Write live metrics (rows, triples, chunk latency, queue depth, bytes, ETA) in the Prometheus text format to `file`.prom while converting")
+    parser.add_argument('--status', dest='status', action='store_true', help="Write the live metrics as JSON to `file`.status.json while converting")
+    parser.add_argument('--metrics-interval', dest='metrics_interval', default=10, type=float, help="The number of seconds between updates of the metrics and status files")
+    parser.add_argument('--deduplicate', dest='deduplicate', action='store_true', help="Drop duplicate quads within each chunk (only relevant with `--stream`)")
+
     parser.add_argument('--version', dest='version', action='version', version='x.xx')
 
     args = parser.parse_args()
@@ -92,7 +163,7 @@ def main():
             print("Invalid character encoding. See https://docs.python.org/3.8/library/codecs.html#standard-encodings to see which encodings are possible.")
             sys.exit(1)
 
-    COW(args.mode, files, args.dataset, args.delimiter, args.encoding, args.quotechar, args.processes, args.chunksize, args.base, args.format)
+    COW(args.mode, files, args.dataset, args.delimiter, args.encoding, args.quotechar, args.processes, args.chunksize, args.base, args.format, args.streaming, args.deduplicate, args.sharded, args.iri_cache_size, args.rejects, args.checkpoint, args.resume, args.incremental, args.delta_store, args.compression, args.infer, args.sample_size, args.detection_budget, args.batch, args.profile, args.metrics, args.status, args.metrics_interval)
 
 if __name__ == '__main__':
     main()
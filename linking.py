@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Links patients, encounters and exams through their ID_PACIENTE / ID_ATENDIMENTO values with hash joins.
+
+Matching every ID of one table or graph against every ID of the other (``FILTER regex(?s, ?id)``) takes time
+proportional to the product of their sizes. Here the smaller side is put in a hash index on the ID, and the other
+side is streamed past it once, so a link takes time proportional to their sum:
+
+    patients = KeyIndex(graph_keys(g, SCHEMA['identifier']))
+    for key, patient, exam in join(patients, table_keys('HC_EXAMES_1.csv', 'ID_PACIENTE', BASE + 'exame/{_row}')):
+        ...
+
+Either side can be a table (a CSV file, as it is converted) or a graph (any rdflib graph, including a QuadStore).
+The rows of a table are numbered as the conversion numbers them ({_row} is 0 for the first row after the header),
+so a template like the aboutUrl of its schema gives the IRIs of the converted rows; :func:`check_subjects` (or
+``--check`` with the converted files) verifies that. The links can be written as triples:
+
+    python linking.py HC_PACIENTES_1.csv:ID_PACIENTE HC_EXAMES_1.csv:ID_PACIENTE --left-subject 'https://.../paciente/{ID_PACIENTE}' \\
+        --right-subject 'https://.../exame/{_row}' --predicate http://www.semanticweb.org/datasharingbr#hasPatient --reverse --output links.nt
+"""
+
+import csv
+import logging
+import argparse
+import iribaker
+import rfc3987
+from collections import defaultdict
+from rdflib import URIRef, Literal
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+logger.addHandler(ch)
+
+# The delimiters a table is checked for when none is given; the hospital tables use |, converted ones ,
+DELIMITERS = '|,;\t'
+
+
+def link_key(value):
+    """The form in which IDs are compared: as text, ignoring surrounding spaces and case (the hashes that identify
+    patients are written in upper case in some tables and in lower case in others)"""
+    return str(value).strip().lower()
+
+
+def graph_keys(graph, predicate, objects=False):
+    """The (key, subject) pairs of the statements with ``predicate`` in ``graph``, keyed on their object; or the
+    (key, object) pairs if ``objects``"""
+    for s, o in graph.subject_objects(predicate):
+        yield link_key(o), o if objects else s
+
+
+def _column(header, name, file_name):
+    """The column of ``header`` called ``name``, ignoring case (ID_aTENDIMENTO is ID_ATENDIMENTO)"""
+    for column in header:
+        if column.strip().upper() == name.upper():
+            return column
+    raise Exception("{} has no column {} (columns: {})".format(file_name, name, ", ".join(header)))
+
+
+def row_iri(template, row):
+    """The IRI of ``template`` filled in with the values of ``row``, normalized as the conversion normalizes the
+    IRIs it makes (so ``.../{ID}`` of the ID ``a b`` gives ``.../a_b``); None if the row has no value for a
+    column of the template, or if it is not a valid IRI"""
+    try:
+        iri = iribaker.to_iri(template.format(**row))
+        rfc3987.parse(iri, rule='IRI')
+    except Exception:
+        # A KeyError for a column the row does not have, a ValueError from rfc3987, and iribaker raises an Exception
+        # for what has no scheme or authority
+        return None
+    return URIRef(iri)
+
+
+def table_keys(file_name, key, item=None, delimiter=None, encoding='utf-8'):
+    """The (key, item) pairs of the rows of the CSV table ``file_name``, keyed on the column ``key``.
+
+    The item is the row number (0 for the first row after the header, as _row in the conversion) if ``item`` is
+    None, an IRI (see :func:`row_iri`) if ``item`` is a template such as ``https://.../exame/{_row}`` or
+    ``.../{ID_PACIENTE}``, and otherwise the value of the column ``item`` as a literal. Rows without a key are
+    skipped, and so are rows with more or fewer fields than the header and rows that do not give an IRI (see
+    :func:`row_iri`); their number is logged."""
+    with open(file_name, 'r', encoding=encoding, newline='') as f:
+        if delimiter is None:
+            first_line = f.readline()
+            delimiter = max(DELIMITERS, key=first_line.count)
+            f.seek(0)
+        reader = csv.DictReader(f, delimiter=delimiter)
+        key_column = _column(reader.fieldnames, key, file_name)
+        item_column = _column(reader.fieldnames, item, file_name) if item is not None and '{' not in item else None
+
+        malformed = []
+        for row_number, row in enumerate(reader):
+            # DictReader puts the fields beyond the header under None, and fills in None for missing fields
+            if None in row or None in row.values():
+                malformed.append(row_number)
+                continue
+            value = row[key_column]
+            if not value.strip():
+                continue
+            if item is None:
+                yield link_key(value), row_number
+            elif item_column is None:
+                # As in the conversion, _row is the row number even if the table has a column called _row
+                row['_row'] = row_number
+                iri = row_iri(item, row)
+                if iri is None:
+                    malformed.append(row_number)
+                    continue
+                yield link_key(value), iri
+            else:
+                yield link_key(value), Literal(row[item_column])
+        if malformed:
+            logger.warning("Skipped {} rows of {} that have more or fewer fields than the header or no (valid) IRI "
+                           "(rows {}{})".format(len(malformed), file_name, ", ".join(str(n) for n in malformed[:10]),
+                                                ", ..." if len(malformed) > 10 else ""))
+
+
+class KeyIndex(object):
+    """A hash index of items (subjects, rows, values) by the ID they have"""
+
+    def __init__(self, pairs=()):
+        self.items = defaultdict(list)
+        self.size = 0
+        for key, item in pairs:
+            self.add(key, item)
+
+    def add(self, key, item):
+        self.items[key].append(item)
+        self.size += 1
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return link_key(key) in self.items
+
+    def get(self, key):
+        """The items with ID ``key``"""
+        return self.items.get(link_key(key), [])
+
+
+def join(index, pairs, outer=False):
+    """Streams the (key, item) ``pairs`` past ``index``, and yields a (key, indexed item, item) triple for every
+    indexed item with the same key. With ``outer``, items without a match are yielded with None."""
+    items = index.items
+    probed = matched = 0
+    for key, item in pairs:
+        probed += 1
+        found = items.get(key)
+        if found:
+            matched += 1
+            for indexed in found:
+                yield key, indexed, item
+        elif outer:
+            yield key, None, item
+    logger.info("Linked {} of {} items to {} indexed IDs".format(matched, probed, len(index)))
+
+
+def link_triples(links, predicate, reverse=False):
+    """The (indexed item, predicate, item) triples of the ``links`` from :func:`join`, or (item, predicate, indexed
+    item) with ``reverse``; every distinct one once"""
+    seen = set()
+    for key, indexed, item in links:
+        if indexed is None:
+            continue
+        triple = (item, predicate, indexed) if reverse else (indexed, predicate, item)
+        if triple not in seen:
+            seen.add(triple)
+            yield triple
+
+
+def check_subjects(pairs, graph, predicate, samples=5):
+    """Checks that the IRIs :func:`table_keys` gives the rows of a table (``pairs``) are the subjects the conversion
+    of that table gave them: ``graph`` (the converted table) must have every IRI with the ID of its row as the
+    value of ``predicate`` (the key column; as a literal, or as the last part of an IRI made with a valueUrl).
+    Returns the number of rows checked, and raises an exception with the first ``samples`` rows that do not match."""
+    subjects = defaultdict(set)
+    for key, subject in graph_keys(graph, predicate):
+        subjects[subject].add(key)
+    checked = 0
+    mismatches = []
+    for key, subject in pairs:
+        checked += 1
+        found = subjects.get(subject, ())
+        if not any(value == key or value.endswith('/' + key) for value in found):
+            if len(mismatches) < samples:
+                mismatches.append("{} has {} {}".format(subject, predicate, ", ".join(sorted(found)) if found else "no value") +
+                                  " (the row has {})".format(key))
+            else:
+                mismatches.append(None)
+    if mismatches:
+        raise Exception("{} of {} row IRIs do not match the converted data:\n{}".format(
+            len(mismatches), checked, "\n".join(m for m in mismatches if m is not None)))
+    logger.info("The IRIs of all {} rows match the converted data".format(checked))
+    return checked
+
+
+def write_links(triples, file_name, graph=None):
+    """Writes ``triples`` as N-Triples, or as N-Quads in ``graph``, and returns their number"""
+    suffix = " {} .\n".format(graph.n3()) if graph is not None else " .\n"
+    count = 0
+    with open(file_name, 'w', encoding='utf-8') as f:
+        for s, p, o in triples:
+            f.write("{} {} {}{}".format(s.n3(), p.n3(), o.n3(), suffix))
+            count += 1
+    logger.info("Wrote {} links to {}".format(count, file_name))
+    return count
+
+
+def _side(spec, subject, store):
+    """The (key, item) pairs of a table (file.csv:COLUMN) or of a predicate in ``store`` (an IRI)"""
+    if spec.startswith('http://') or spec.startswith('https://'):
+        if store is None:
+            raise Exception("Linking on the predicate {} needs a --store".format(spec))
+        return graph_keys(store, URIRef(spec))
+    file_name, _, column = spec.rpartition(':')
+    if not file_name:
+        raise Exception("Expected a table as file.csv:COLUMN or a predicate IRI, not {}".format(spec))
+    return table_keys(file_name, column, subject)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Link the subjects or rows of two tables or graphs that have the same ID (ID_PACIENTE, ID_ATENDIMENTO, ...)")
+    parser.add_argument('left', type=str, help="The side that is indexed (the smaller one): a table as file.csv:COLUMN, or the IRI of the predicate that holds the ID in --store")
+    parser.add_argument('right', type=str, help="The side that is streamed past the index, given in the same way")
+    parser.add_argument('--left-subject', dest='left_subject', default=None, type=str, help="For a table on the left: the IRI template of a row, e.g. 'https://.../paciente/{ID_PACIENTE}'")
+    parser.add_argument('--right-subject', dest='right_subject', default=None, type=str, help="For a table on the right: the IRI template of a row, e.g. 'https://.../exame/{_row}'")
+    parser.add_argument('--store', dest='store', default=None, type=str, help="The SQLite quad store (see quadstore.py) that predicate sides are read from")
+    parser.add_argument('--predicate', dest='predicate', required=True, type=str, help="The predicate of the link triples")
+    parser.add_argument('--reverse', dest='reverse', action='store_true', help="Link from the right side to the left side instead")
+    parser.add_argument('--graph', dest='graph', default=None, type=str, help="Write the links as N-Quads in this graph")
+    parser.add_argument('--output', dest='output', required=True, type=str, help="The file to write the links to")
+    parser.add_argument('--check', dest='check', nargs='+', default=None, type=str, help="Converted files of the tables: check first that the IRI templates give the IRIs of the converted rows")
+    parser.add_argument('--check-predicate', dest='check_predicate', default=None, type=str, help="With --check: the predicate of the key column in the converted files")
+    args = parser.parse_args()
+
+    store = None
+    if args.store:
+        from rdflib import ConjunctiveGraph
+        from quadstore import QuadStore
+        store = ConjunctiveGraph(store=QuadStore(args.store))
+    try:
+        for side, subject in ((args.left, args.left_subject), (args.right, args.right_subject)):
+            if not (side.startswith('http://') or side.startswith('https://')) and subject is None:
+                raise Exception("Give an IRI template for the rows of {} (--left-subject/--right-subject)".format(side))
+        if args.check:
+            if not args.check_predicate:
+                raise Exception("--check needs the --check-predicate of the key column")
+            from rdflib import ConjunctiveGraph
+            from rdflib.util import guess_format
+            converted = ConjunctiveGraph()
+            for file_name in args.check:
+                converted.parse(file_name, format=guess_format(file_name) or 'turtle')
+            for side, subject in ((args.left, args.left_subject), (args.right, args.right_subject)):
+                if subject is not None:
+                    check_subjects(_side(side, subject, store), converted, URIRef(args.check_predicate))
+        index = KeyIndex(_side(args.left, args.left_subject, store))
+        logger.info("Indexed {} items with {} IDs from {}".format(index.size, len(index), args.left))
+        links = join(index, _side(args.right, args.right_subject, store))
+        write_links(link_triples(links, URIRef(args.predicate), args.reverse), args.output,
+                    URIRef(args.graph) if args.graph else None)
+    finally:
+        if store is not None:
+            store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,8 @@ import linecache
 from iribaker import to_iri
 import csv
 
+from linking import KeyIndex, table_keys, join, link_key
+
 
 def main():
 	data = 'https://repositoriodatasharingfapesp.uspdigital.usp.br/'
@@ -19,6 +21,7 @@ def main():
 	dataset.default_context.parse('/T/dados/tbox/ontology_pacientes.ttl',format='turtle')
 	dataset.bind('datashIdAt', repoDtSh)
 
+	pacientes = KeyIndex()
 	with open('/T/dados/tabelas/HC_PACIENTES_1.csv', mode='r') as csv_file:
 		csv_reader = csv.DictReader(csv_file,delimiter='|')
 		line_count = 0
@@ -27,6 +30,7 @@ def main():
 				line_count += 1
 			#print(f'\t{row["ID_PACIENTE"]} mora em {row["CD_MUNICIPIO"]} e nasceu em {row["AA_NASCIMENTO"]}.')
 			else:
+				pacientes.add(link_key(row["ID_PACIENTE"]), URIRef(graph_uri+row["ID_PACIENTE"]))
 				graph.add(( URIRef (graph_uri+row["ID_PACIENTE"]), DATA.Id, Literal(row["ID_PACIENTE"],datatype = XSD.string)))
 
 				if row["IC_SEXO"] == 'F':
@@ -42,16 +46,12 @@ def main():
 		print(f'Processadas {line_count} linhas.')
 	csv_file.close()
 
-	with open('/T/dados/tabelas/exames_test.csv', mode='r') as csv_file:
-			csv_reader = csv.DictReader(csv_file,delimiter='|')
-			line_count = 0
-			for row in csv_reader:
-				if line_count == 0:
-					line_count += 1
-				else:
-					graph.add(( URIRef (graph_uri+row["ID_PACIENTE"]), DATA.IdAtendimento, Literal(row["ID_aTENDIMENTO"],datatype = XSD.string)))
-					line_count += 1
-	csv_file.close()
+	# Os atendimentos dos exames sao ligados aos pacientes lidos acima por um hash join no ID_PACIENTE.
+	# O DictReader ja le o cabecalho, entao a primeira linha de dados de exames_test tambem e ligada (antes era
+	# pulada), e so atendimentos de pacientes lidos acima sao ligados.
+	atendimentos = table_keys('/T/dados/tabelas/exames_test.csv', 'ID_PACIENTE', 'ID_aTENDIMENTO', delimiter='|')
+	for key, paciente, atendimento in join(pacientes, atendimentos):
+		graph.add(( paciente, DATA.IdAtendimento, Literal(str(atendimento),datatype = XSD.string)))
 	graph.serialize(destination='/T/dados/abox/pacientes.ttl',format='turtle')
 	#print(graph.serialize(format='turtle').decode('UTF-8'))
 
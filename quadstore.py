@@ -0,0 +1,771 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+A persistent quad store in SQLite, usable as an rdflib Store.
+
+Parsing the converted data into an in-memory ConjunctiveGraph takes minutes and gigabytes for the full
+datasets. Here the data is loaded once into an SQLite file, which is opened in milliseconds afterwards:
+
+    python quadstore.py dados/abox/dtsh.sqlite dados/abox/EINSTEIN_Exames_2.csv.nq dados/abox/test_exames.ttl --processes auto
+
+    g = ConjunctiveGraph(store=QuadStore('dados/abox/dtsh.sqlite'))
+    g.query(...)
+
+Terms are stored once, in their N-Triples notation, and the quads as term ids, with indexes on (s, p, o, g),
+(p, o, s) and (o, s, p) so that every triple pattern can be answered from an index.
+
+With ``--processes``, the files are parsed in a process pool (large N-Quads files in byte ranges) and merged into
+the store as they come in; :func:`parallel_load` does the same for any other rdflib graph:
+
+    g = ConjunctiveGraph()
+    parallel_load(['dados/abox/test_exames.ttl', 'dados/abox/EINSTEIN_Exames_2.csv.nq'], g)
+
+The literal values of chosen predicates can also be indexed (:meth:`QuadStore.index_literals`), as they are and in
+lower case without accents, with the trigrams of the latter, for exact, prefix and substring search without scanning
+every statement of the predicate:
+
+    python quadstore.py dados/abox/dtsh.sqlite --index-literals https://repositoriodatasharingfapesp.uspdigital.usp.br/DeExame
+"""
+
+import os
+import re
+import sqlite3
+import unicodedata
+import logging
+import time
+import argparse
+import multiprocessing as mp
+from hashlib import sha1
+from functools import lru_cache
+from itertools import islice
+from pathlib import Path
+from rdflib import Graph, URIRef, BNode, Literal, plugin
+from rdflib.store import Store, VALID_STORE, NO_STORE
+from rdflib.plugins.parsers.ntriples import unquote
+from rdflib.graph import DATASET_DEFAULT_GRAPH_ID
+from streams import compression_of, open_compressed, nquads_statements, bounded_imap, quote_literal
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+logger.addHandler(ch)
+
+# The number of statements added at a time when loading a file
+LOAD_BATCH = 10000
+# Line based files are loaded in parallel in byte ranges of at most LOAD_SPLIT bytes (and at least MIN_SPLIT)
+LOAD_SPLIT = 16 * 1024 * 1024
+MIN_SPLIT = 1024 * 1024
+# The number of term ids that are kept in memory while loading
+TERM_CACHE_SIZE = 1000000
+# Line based files that are appended to are loaded from where the previous load stopped, after checking
+# that the TAIL_CHECK bytes before that point did not change
+TAIL_CHECK = 4096
+# SQLite allows at most 999 parameters per statement in older versions
+MAX_PARAMETERS = 900
+
+# The number of trigrams of a text that are looked up in a substring search; the candidates they give are then
+# checked against the whole text
+TRIGRAM_LOOKUPS = 4
+
+LINE_FORMATS = {'.nq': 'nquads', '.nt': 'nt'}
+
+_LITERAL = re.compile(r'"(.*)"(?:@([A-Za-z0-9-]+)|\^\^<([^>]*)>)?$', re.DOTALL)
+
+
+def term_key(term):
+    """The N-Triples notation of an rdflib ``term``, as it is stored"""
+    if isinstance(term, Literal):
+        return quote_literal(term)
+    if isinstance(term, BNode):
+        return "_:{}".format(term)
+    if isinstance(term, URIRef):
+        return "<{}>".format(term)
+    # A Graph used as a context
+    return term_key(term.identifier)
+
+
+@lru_cache(maxsize=100000)
+def key_term(key):
+    """The rdflib term of a stored N-Triples notation"""
+    if key.startswith('<'):
+        return URIRef(key[1:-1])
+    if key.startswith('_:'):
+        return BNode(key[2:])
+    match = _LITERAL.match(key)
+    if match is None:
+        raise ValueError("Not a term in N-Triples notation: {}".format(key))
+    lexical, lang, datatype = match.groups()
+    return Literal(unquote(lexical), lang=lang, datatype=URIRef(datatype) if datatype else None, normalize=False)
+
+
+def fold(text):
+    """``text`` in lower case and without accents (``Uréia`` becomes ``ureia``), as the literal index compares it"""
+    return ''.join(c for c in unicodedata.normalize('NFKD', text.casefold()) if not unicodedata.combining(c))
+
+
+def trigrams(text):
+    """The distinct substrings of three characters of ``text``, in the order in which they first occur"""
+    return list(dict.fromkeys(text[i:i + 3] for i in range(len(text) - 2)))
+
+
+def normalize_key(text):
+    """The stored notation of a term as written in an N-Quads file, which may escape characters differently"""
+    if text.startswith('"') and '\\' in text:
+        return term_key(key_term(text))
+    return text
+
+
+class QuadStore(Store):
+    """An rdflib Store, kept in the SQLite database ``configuration``.
+
+    Supports contexts (named graphs), so it can back a ConjunctiveGraph or Dataset. Changes made through rdflib are
+    written when the store is committed or closed; :meth:`load` commits as it goes. Files loaded with :meth:`load`
+    are recorded, so that loading them again only adds what was appended to them since."""
+
+    context_aware = True
+    formula_aware = False
+    transaction_aware = True
+    graph_aware = True
+
+    def __init__(self, configuration=None, identifier=None):
+        super(QuadStore, self).__init__()
+        self.identifier = identifier
+        self.connection = None
+        self._ids = {}
+        self._terms = {}
+        self._graphs = {}
+        self._literal_predicates = set()
+        if configuration is not None:
+            self.open(configuration, create=True)
+
+    def open(self, configuration, create=False):
+        if not create and not os.path.exists(configuration):
+            return NO_STORE
+        self._clear_term_caches()
+        self.connection = sqlite3.connect(configuration)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT NOT NULL UNIQUE)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS quads (s INTEGER NOT NULL, p INTEGER NOT NULL, o INTEGER NOT NULL, g INTEGER NOT NULL, "
+                                "PRIMARY KEY (s, p, o, g)) WITHOUT ROWID")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS quads_pos ON quads (p, o, s)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS quads_osp ON quads (o, s, p)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS quads_g ON quads (g)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS graphs (g INTEGER PRIMARY KEY)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS namespaces (prefix TEXT PRIMARY KEY, namespace TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS loaded (file TEXT PRIMARY KEY, mtime REAL, offset INTEGER, tail TEXT, quads INTEGER)")
+        # The literal index: the value of each literal object of an indexed predicate, as is and folded, and the
+        # trigrams of the folded value
+        self.connection.execute("CREATE TABLE IF NOT EXISTS literal_predicates (p INTEGER PRIMARY KEY)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS literal_index (p INTEGER NOT NULL, o INTEGER NOT NULL, value TEXT NOT NULL, "
+                                "folded TEXT NOT NULL, PRIMARY KEY (p, o)) WITHOUT ROWID")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS literal_index_value ON literal_index (p, value)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS literal_index_folded ON literal_index (p, folded)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS literal_trigrams (p INTEGER NOT NULL, gram TEXT NOT NULL, o INTEGER NOT NULL, "
+                                "PRIMARY KEY (p, gram, o)) WITHOUT ROWID")
+        self.connection.commit()
+        self._read_literal_predicates()
+        return VALID_STORE
+
+    def close(self, commit_pending_transaction=True):
+        if self.connection is None:
+            return
+        if commit_pending_transaction:
+            self.connection.commit()
+        self.connection.close()
+        self.connection = None
+        self._clear_term_caches()
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+        # Rolled back term ids are handed out again for other terms
+        self._clear_term_caches()
+        self._read_literal_predicates()
+
+    # Term ids
+
+    def _clear_term_caches(self):
+        self._ids.clear()
+        self._terms.clear()
+
+    def _id(self, term, create=False):
+        """The id of ``term`` (a term or its N-Triples notation), None if it is not stored (unless ``create``)"""
+        key = term if isinstance(term, str) and not isinstance(term, (URIRef, BNode, Literal)) else term_key(term)
+        term_id = self._ids.get(key)
+        if term_id is None:
+            if create:
+                self.connection.execute("INSERT OR IGNORE INTO terms (term) VALUES (?)", (key,))
+            row = self.connection.execute("SELECT id FROM terms WHERE term = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            term_id = self._cache_id(key, row[0])
+        return term_id
+
+    def _cache_id(self, key, term_id):
+        if len(self._ids) >= TERM_CACHE_SIZE:
+            self._ids.clear()
+        self._ids[key] = term_id
+        return term_id
+
+    def _ids_of(self, keys):
+        """Stores the N-Triples ``keys`` that are new, and returns the ids of all of them"""
+        ids = {}
+        missing = []
+        for key in set(keys):
+            term_id = self._ids.get(key)
+            if term_id is None:
+                missing.append(key)
+            else:
+                ids[key] = term_id
+        if missing:
+            self.connection.executemany("INSERT OR IGNORE INTO terms (term) VALUES (?)", ((key,) for key in missing))
+            for start in range(0, len(missing), MAX_PARAMETERS):
+                batch = missing[start:start + MAX_PARAMETERS]
+                for term_id, key in self.connection.execute(
+                        "SELECT id, term FROM terms WHERE term IN ({})".format(",".join("?" * len(batch))), batch):
+                    ids[key] = self._cache_id(key, term_id)
+        return [ids[key] for key in keys]
+
+    def _context_id(self, context, create=False):
+        if context is None:
+            return None
+        return self._id(getattr(context, 'identifier', context), create)
+
+    def _graph(self, identifier):
+        graph = self._graphs.get(identifier)
+        if graph is None:
+            graph = self._graphs[identifier] = Graph(store=self, identifier=identifier)
+        return graph
+
+    # Triples
+
+    def add(self, triple, context, quoted=False):
+        Store.add(self, triple, context, quoted)
+        g = self._context_id(context if context is not None else DATASET_DEFAULT_GRAPH_ID, create=True)
+        s, p, o = [self._id(term, create=True) for term in triple]
+        self.connection.execute("INSERT OR IGNORE INTO quads VALUES (?, ?, ?, ?)", (s, p, o, g))
+        self.connection.execute("INSERT OR IGNORE INTO graphs VALUES (?)", (g,))
+        if p in self._literal_predicates and isinstance(triple[2], Literal):
+            self._index_literal_values(p, [(o, term_key(triple[2]))])
+
+    def addN(self, quads):
+        quads = iter(quads)
+        while True:
+            batch = list(islice(quads, LOAD_BATCH))
+            if not batch:
+                return
+            self._add_keys([(term_key(s), term_key(p), term_key(o), term_key(c)) for s, p, o, c in batch])
+
+    def _add_keys(self, statements):
+        """Adds statements given as four N-Triples notations, returns the number of statements that were new"""
+        ids = self._ids_of([key for statement in statements for key in statement])
+        rows = [tuple(ids[i:i + 4]) for i in range(0, len(ids), 4)]
+        before = self.connection.total_changes
+        self.connection.executemany("INSERT OR IGNORE INTO quads VALUES (?, ?, ?, ?)", rows)
+        added = self.connection.total_changes - before
+        self.connection.executemany("INSERT OR IGNORE INTO graphs VALUES (?)", ((g,) for g in set(row[3] for row in rows)))
+        if self._literal_predicates:
+            literals = {}
+            for row, statement in zip(rows, statements):
+                if row[1] in self._literal_predicates and statement[2].startswith('"'):
+                    literals.setdefault(row[1], {})[row[2]] = statement[2]
+            for p, values in literals.items():
+                self._index_literal_values(p, values.items())
+        return added
+
+    def _where(self, triple, context):
+        """The WHERE clause and parameters for a triple pattern in a context, or None if a term is not stored"""
+        conditions, parameters = [], []
+        for column, term in zip('spog', tuple(triple) + (context,)):
+            if term is None:
+                continue
+            term_id = self._context_id(term) if column == 'g' else self._id(term)
+            if term_id is None:
+                return None
+            conditions.append("q.{} = ?".format(column))
+            parameters.append(term_id)
+        return (" WHERE " + " AND ".join(conditions) if conditions else ""), parameters
+
+    def remove(self, triple, context=None):
+        Store.remove(self, triple, context)
+        where = self._where(triple, context)
+        if where is None:
+            return
+        graphs = [g for (g,) in self.connection.execute("SELECT DISTINCT q.g FROM quads AS q" + where[0], where[1])]
+        self.connection.execute("DELETE FROM quads AS q" + where[0], where[1])
+        # A graph whose last statement was removed is no longer one of the contexts
+        for start in range(0, len(graphs), MAX_PARAMETERS):
+            batch = graphs[start:start + MAX_PARAMETERS]
+            self.connection.execute("DELETE FROM graphs WHERE g IN ({}) AND NOT EXISTS (SELECT 1 FROM quads WHERE quads.g = graphs.g)".format(
+                ",".join("?" * len(batch))), batch)
+
+    def triples(self, triple, context=None):
+        where = self._where(triple, context)
+        if where is None:
+            return
+        if context is not None:
+            contexts = [self._graph(getattr(context, 'identifier', context))]
+            for s, p, o in self.connection.execute(
+                    "SELECT ts.term, tp.term, tobj.term FROM quads AS q JOIN terms AS ts ON ts.id = q.s "
+                    "JOIN terms AS tp ON tp.id = q.p JOIN terms AS tobj ON tobj.id = q.o" + where[0], where[1]):
+                yield (key_term(s), key_term(p), key_term(o)), iter(contexts)
+            return
+        # Every triple once, with all the graphs it is in
+        for s, p, o, graphs in self.connection.execute(
+                "SELECT ts.term, tp.term, tobj.term, group_concat(q.g) FROM quads AS q JOIN terms AS ts ON ts.id = q.s "
+                "JOIN terms AS tp ON tp.id = q.p JOIN terms AS tobj ON tobj.id = q.o" + where[0] +
+                " GROUP BY q.s, q.p, q.o", where[1]):
+            yield (key_term(s), key_term(p), key_term(o)), (self._graph(self._term_of(int(g))) for g in graphs.split(','))
+
+    def _term_of(self, term_id):
+        """The term with id ``term_id``"""
+        term = self._terms.get(term_id)
+        if term is None:
+            if len(self._terms) >= TERM_CACHE_SIZE:
+                self._terms.clear()
+            term = self._terms[term_id] = key_term(
+                self.connection.execute("SELECT term FROM terms WHERE id = ?", (term_id,)).fetchone()[0])
+        return term
+
+    def __len__(self, context=None):
+        if context is not None:
+            g = self._context_id(context)
+            if g is None:
+                return 0
+            return self.connection.execute("SELECT COUNT(*) FROM quads WHERE g = ?", (g,)).fetchone()[0]
+        return self.connection.execute("SELECT COUNT(*) FROM (SELECT DISTINCT s, p, o FROM quads)").fetchone()[0]
+
+    def contexts(self, triple=None):
+        if triple is None:
+            rows = self.connection.execute("SELECT t.term FROM graphs JOIN terms AS t ON t.id = graphs.g")
+        else:
+            where = self._where(triple, None)
+            if where is None:
+                return
+            rows = self.connection.execute("SELECT DISTINCT t.term FROM quads AS q JOIN terms AS t ON t.id = q.g" + where[0], where[1])
+        for (g,) in rows.fetchall():
+            yield self._graph(key_term(g))
+
+    def add_graph(self, graph):
+        self.connection.execute("INSERT OR IGNORE INTO graphs VALUES (?)", (self._context_id(graph, create=True),))
+
+    def remove_graph(self, graph):
+        g = self._context_id(graph)
+        if g is not None:
+            self.connection.execute("DELETE FROM quads WHERE g = ?", (g,))
+            self.connection.execute("DELETE FROM graphs WHERE g = ?", (g,))
+
+    # Namespaces
+
+    def bind(self, prefix, namespace):
+        self.connection.execute("INSERT OR REPLACE INTO namespaces VALUES (?, ?)", (prefix, str(namespace)))
+
+    def namespace(self, prefix):
+        row = self.connection.execute("SELECT namespace FROM namespaces WHERE prefix = ?", (prefix,)).fetchone()
+        return URIRef(row[0]) if row else None
+
+    def prefix(self, namespace):
+        row = self.connection.execute("SELECT prefix FROM namespaces WHERE namespace = ?", (str(namespace),)).fetchone()
+        return row[0] if row else None
+
+    def namespaces(self):
+        for prefix, namespace in self.connection.execute("SELECT prefix, namespace FROM namespaces").fetchall():
+            yield prefix, URIRef(namespace)
+
+    # Literal index
+
+    def _read_literal_predicates(self):
+        self._literal_predicates = {p for (p,) in self.connection.execute("SELECT p FROM literal_predicates")}
+
+    def index_literals(self, predicate):
+        """Indexes the literal objects of ``predicate`` for :meth:`find_literals`, and keeps the index up to date
+        when statements are added. Returns the number of values indexed (0 if the predicate already was)."""
+        p = self._id(predicate, create=True)
+        if p in self._literal_predicates:
+            return 0
+        self.connection.execute("INSERT INTO literal_predicates VALUES (?)", (p,))
+        self._literal_predicates.add(p)
+        values = self.connection.execute("SELECT DISTINCT q.o, t.term FROM quads AS q JOIN terms AS t ON t.id = q.o "
+                                         "WHERE q.p = ? AND substr(t.term, 1, 1) = '\"'", (p,)).fetchall()
+        self._index_literal_values(p, values)
+        self.commit()
+        logger.info("Indexed {} literal values of {}".format(len(values), predicate))
+        return len(values)
+
+    def literals_indexed(self, predicate):
+        """Whether the literal objects of ``predicate`` are indexed"""
+        return self._id(predicate) in self._literal_predicates
+
+    def _index_literal_values(self, p, values):
+        """Adds literals (pairs of a term id and its N-Triples notation) that are objects of predicate ``p``"""
+        index, grams = [], []
+        for o, key in values:
+            value = str(key_term(key))
+            folded = fold(value)
+            index.append((p, o, value, folded))
+            grams.extend((p, gram, o) for gram in trigrams(folded))
+        self.connection.executemany("INSERT OR IGNORE INTO literal_index VALUES (?, ?, ?, ?)", index)
+        self.connection.executemany("INSERT OR IGNORE INTO literal_trigrams VALUES (?, ?, ?)", grams)
+
+    def find_literals(self, predicate, text, match='contains', limit=None):
+        """The literal objects of ``predicate`` whose value is ``text`` ('exact'), or, ignoring case and accents, is
+        ``text`` ('folded'), starts with it ('prefix') or contains it ('contains'). At most ``limit`` are returned.
+
+        The predicate must be indexed (see :meth:`index_literals`). A value followed by a line break counts as an
+        exact match too, as it does for a regex anchored with $."""
+        p = self._id(predicate)
+        if p is None or p not in self._literal_predicates:
+            raise Exception("The literals of {} are not indexed".format(predicate))
+        folded = fold(text)
+        if match == 'exact':
+            condition, parameters = "l.value IN (?, ?)", [text, text + '\n']
+        elif match == 'folded':
+            condition, parameters = "l.folded IN (?, ?)", [folded, folded + '\n']
+        elif match == 'prefix':
+            # Every string starting with the prefix sorts before the prefix followed by the highest character
+            condition, parameters = "l.folded >= ? AND l.folded < ?", [folded, folded + '\U0010ffff']
+        elif match == 'contains':
+            condition, parameters = "instr(l.folded, ?) > 0", [folded]
+            grams = trigrams(folded)
+            if grams:
+                # A few trigrams spread over the text narrow the candidates down enough
+                if len(grams) > TRIGRAM_LOOKUPS:
+                    grams = [grams[i * (len(grams) - 1) // (TRIGRAM_LOOKUPS - 1)] for i in range(TRIGRAM_LOOKUPS)]
+                condition += " AND l.o IN ({})".format(" INTERSECT ".join(["SELECT o FROM literal_trigrams WHERE p = ? AND gram = ?"] * len(grams)))
+                for gram in grams:
+                    parameters += [p, gram]
+        else:
+            raise Exception("Unknown literal match '{}', expected exact, folded, prefix or contains".format(match))
+
+        # Values whose statements were removed stay in the index, but are not returned
+        rows = self.connection.execute(
+            "SELECT t.term FROM literal_index AS l JOIN terms AS t ON t.id = l.o WHERE l.p = ? AND " + condition +
+            " AND EXISTS (SELECT 1 FROM quads AS q WHERE q.p = l.p AND q.o = l.o)" + (" LIMIT {:d}".format(limit) if limit is not None else ""),
+            [p] + parameters)
+        return [key_term(term) for (term,) in rows.fetchall()]
+
+    # Loading
+
+    def _load_plan(self, file_name, format, graph):
+        """How to load ``file_name``: a dict with its format, where to start reading and what to record afterwards;
+        None if it was loaded before and did not change"""
+        file_name = os.path.abspath(file_name)
+        format, line_based, appendable = file_format(file_name, format)
+        mtime = os.path.getmtime(file_name)
+        size = os.path.getsize(file_name)
+        plan = {'file': file_name, 'format': format, 'line_based': line_based, 'appendable': appendable,
+                'graph': graph, 'mtime': mtime, 'size': size, 'start': 0, 'quads': 0}
+        previous = self.connection.execute("SELECT mtime, offset, tail, quads FROM loaded WHERE file = ?", (file_name,)).fetchone()
+        if previous is not None:
+            if previous[0] == mtime and previous[1] == size:
+                logger.info("{} was loaded before and did not change".format(file_name))
+                return None
+            if appendable and size > previous[1] and previous[2] == self._tail(file_name, previous[1]):
+                logger.info("Loading what was appended to {} since byte {}".format(file_name, previous[1]))
+                plan['start'], plan['quads'] = previous[1], previous[3]
+            else:
+                logger.warning("{} changed since it was loaded, adding it again (statements that were removed from it stay in the store)".format(file_name))
+        return plan
+
+    def _loaded(self, plan, offset, added):
+        """Records that the file of ``plan`` was loaded up to byte ``offset``"""
+        # A compressed or parsed file is recorded with its size, so that it counts as unchanged next time
+        offset = offset if plan['appendable'] else plan['size']
+        self.connection.execute("INSERT OR REPLACE INTO loaded VALUES (?, ?, ?, ?, ?)",
+                                (plan['file'], plan['mtime'], offset, self._tail(plan['file'], offset) if plan['appendable'] else None,
+                                 plan['quads'] + added))
+        self.commit()
+
+    def load(self, file_name, format=None, graph=None):
+        """Adds the statements in ``file_name`` to the store, and returns the number of new ones.
+
+        N-Quads and N-Triples (also compressed) are read line by line without building a graph; statements without a
+        graph go to ``graph`` (default: the default graph). Other formats are parsed by rdflib, into ``graph`` or a
+        graph named after the file, as ConjunctiveGraph.parse does. A file that was loaded before is only read again if
+        it changed, and a line based file that was only appended to is read from where the last load stopped."""
+        plan = self._load_plan(file_name, format, graph)
+        if plan is None:
+            return 0
+        file_name = plan['file']
+
+        offset = plan['size']
+        if plan['line_based']:
+            added, offset = self._load_lines(file_name, plan['start'], graph)
+        else:
+            statements, namespaces, _ = _parse_file(file_name, plan['format'], graph)
+            added = self._add_statements(statements, namespaces)
+
+        self._loaded(plan, offset, added)
+        logger.info("Added {} statements from {}".format(added, file_name))
+        return added
+
+    def load_parallel(self, files, processes=None, format=None, graph=None):
+        """Loads ``files`` like :meth:`load`, but parses them in a pool of ``processes`` (default: one per core).
+
+        Uncompressed N-Quads and N-Triples files are split into byte ranges, so that one large file is parsed by all
+        processes too; other files are parsed whole, each by one process. The statements are added to the store in
+        this process as the parts are parsed. Returns a report per file (see :func:`run_load_tasks`)."""
+        plans = {}
+        for file_name in files:
+            plan = self._load_plan(file_name, format, graph)
+            if plan is not None and plan['file'] not in plans:
+                plans[plan['file']] = plan
+        processes = processes or os.cpu_count() or 1
+        tasks = load_tasks(plans.values(), processes)
+
+        def merge(task, result):
+            added = self._add_statements(result[0], result[1])
+            self.commit()
+            return added
+
+        reports = {}
+        for file_name, report in run_load_tasks(tasks, processes, merge):
+            self._loaded(plans[file_name], report['offset'], report['added'])
+            reports[file_name] = report
+        return reports
+
+    def _add_statements(self, statements, namespaces=()):
+        """Adds statements given as N-Triples notations, LOAD_BATCH at a time, and the ``namespaces`` the store does
+        not have a namespace for yet; returns the number of new statements"""
+        added = 0
+        for start in range(0, len(statements), LOAD_BATCH):
+            added += self._add_keys(statements[start:start + LOAD_BATCH])
+        for prefix, namespace in namespaces:
+            if self.namespace(prefix) is None:
+                self.bind(prefix, namespace)
+        return added
+
+    def _tail(self, file_name, offset):
+        with open(file_name, 'rb') as f:
+            f.seek(max(0, offset - TAIL_CHECK))
+            return sha1(f.read(min(offset, TAIL_CHECK))).hexdigest()
+
+    def _load_lines(self, file_name, start, graph):
+        """Loads the statements of an N-Quads or N-Triples file after byte ``start``. Returns the number of new
+        statements, and the offset after the last complete line (a file that is still being written may end halfway)"""
+        default_graph = term_key(graph if graph is not None else DATASET_DEFAULT_GRAPH_ID)
+        added = 0
+        offset = [start]
+
+        def complete_lines(f):
+            for line in f:
+                if not line.endswith(b'\n'):
+                    return
+                offset[0] += len(line)
+                yield line.decode('utf-8')
+
+        with open_compressed(file_name) as f:
+            if start:
+                f.seek(start)
+            statements = nquads_statements(complete_lines(f))
+            while True:
+                batch = [(s, p, normalize_key(o), g if g is not None else default_graph)
+                         for s, p, o, g in islice(statements, LOAD_BATCH)]
+                if not batch:
+                    return added, offset[0]
+                added += self._add_keys(batch)
+                self.commit()
+
+
+def file_format(file_name, format=None):
+    """The rdflib format of ``file_name`` (``format``, or guessed from its extension), whether it is N-Quads or
+    N-Triples (read line by line), and whether it can be read from an offset (a line based file, not compressed)"""
+    compressed = compression_of(file_name) is not None
+    suffix = Path(os.path.splitext(file_name)[0] if compressed else file_name).suffix
+    format = format if format else LINE_FORMATS.get(suffix, 'turtle' if suffix == '.ttl' else suffix.lstrip('.'))
+    line_based = format in LINE_FORMATS.values()
+    return format, line_based, line_based and not compressed
+
+
+def _parse_file(file_name, format, graph):
+    """The statements (as N-Triples notations) and namespaces of a file that rdflib parses, and its size. Triples go
+    to ``graph``, or to a graph named after the file. A compressed file is decompressed while it is parsed."""
+    g = Graph()
+    file_iri = Path(file_name).as_uri()
+    with open_compressed(file_name) as f:
+        g.parse(source=f, format=format, publicID=file_iri)
+    context_key = term_key(graph if graph is not None else URIRef(file_iri))
+    statements = [(term_key(s), term_key(p), term_key(o), context_key) for s, p, o in g]
+    return statements, list(g.namespaces()), os.path.getsize(file_name)
+
+
+def _read_lines(file_name, start, end, graph):
+    """The statements (as N-Triples notations) on the complete lines of a line based file from byte ``start`` (the
+    start of a line) up to byte ``end`` (up to the end of the file if None), and the offset after the last one"""
+    default_graph = term_key(graph if graph is not None else DATASET_DEFAULT_GRAPH_ID)
+    lines = []
+    offset = start
+    with open_compressed(file_name) as f:
+        if start:
+            f.seek(start)
+        while end is None or offset < end:
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            lines.append(line.decode('utf-8'))
+    statements = [(s, p, normalize_key(o), g if g is not None else default_graph)
+                  for s, p, o, g in nquads_statements(lines)]
+    return statements, [], offset
+
+
+def _load_task(task):
+    """Parses a file or a byte range of one in a worker: returns its statements, namespaces, the offset up to which
+    it was read and the number of seconds it took. The statements are rdflib terms if the task asks for them, and
+    otherwise their N-Triples notations."""
+    file_name, format, start, end, graph, as_terms = task
+    started = time.time()
+    if format in LINE_FORMATS.values():
+        statements, namespaces, offset = _read_lines(file_name, start, end, graph)
+    else:
+        statements, namespaces, offset = _parse_file(file_name, format, graph)
+    if as_terms:
+        statements = [tuple(key_term(key) for key in statement) for statement in statements]
+    return statements, namespaces, offset, time.time() - started
+
+
+def _line_ranges(file_name, start, parts):
+    """Splits a line based file from byte ``start`` into about ``parts`` (start, end) byte ranges that begin at the
+    start of a line; the last one ends at None, the end of the file"""
+    size = os.path.getsize(file_name)
+    step = max(MIN_SPLIT, -(-(size - start) // parts))
+    bounds = [start]
+    with open(file_name, 'rb') as f:
+        position = start + step
+        while position < size:
+            f.seek(position)
+            # On to the start of the next line
+            f.readline()
+            position = f.tell()
+            if position >= size:
+                break
+            bounds.append(position)
+            position += step
+    bounds.append(None)
+    return list(zip(bounds, bounds[1:]))
+
+
+def load_tasks(plans, processes, as_terms=False):
+    """The tasks for :func:`_load_task` that load the files of ``plans`` (see QuadStore._load_plan): one per file,
+    and for an uncompressed line based file one per byte range of at most LOAD_SPLIT bytes, but at least one per
+    process"""
+    tasks = []
+    for plan in plans:
+        if plan['appendable']:
+            parts = max(processes, -(-(plan['size'] - plan['start']) // LOAD_SPLIT))
+            ranges = _line_ranges(plan['file'], plan['start'], parts)
+        else:
+            ranges = [(plan['start'], None)]
+        tasks.extend((plan['file'], plan['format'], start, end, plan['graph'], as_terms) for start, end in ranges)
+    return tasks
+
+
+def run_load_tasks(tasks, processes, merge):
+    """Runs the :func:`_load_task` ``tasks`` in a pool of ``processes``, and calls ``merge(task, result)`` in this
+    process for every result, in the order of the tasks. ``merge`` returns the number of new statements, or None.
+
+    Yields a report for every file once all of its parts are merged: a dict with the number of statements, of new
+    ones ('added'), the offset after the last complete line, the parts, the seconds spent parsing (in all processes
+    together) and from the start of its first part to the merge of its last ('seconds'), and the statements per
+    second of the latter, which is also logged."""
+    remaining = {}
+    for task in tasks:
+        remaining[task[0]] = remaining.get(task[0], 0) + 1
+    reports = {}
+
+    pool = mp.Pool(processes=processes) if processes > 1 and len(tasks) > 1 else None
+    try:
+        results = bounded_imap(pool, _load_task, tasks, processes * 2) if pool is not None else map(_load_task, tasks)
+        started = time.time()
+        for task, result in zip(tasks, results):
+            file_name = task[0]
+            report = reports.get(file_name)
+            if report is None:
+                # The first part of a file starts when the previous file's last part is handed out, at the latest
+                report = reports[file_name] = {'statements': 0, 'added': 0, 'offset': 0, 'parts': 0, 'parse_seconds': 0.0, 'started': started}
+            added = merge(task, result)
+            report['statements'] += len(result[0])
+            report['added'] = None if added is None or report['added'] is None else report['added'] + added
+            report['offset'] = max(report['offset'], result[2])
+            report['parts'] += 1
+            report['parse_seconds'] += result[3]
+
+            remaining[file_name] -= 1
+            if remaining[file_name] == 0:
+                finished = time.time()
+                report['seconds'] = finished - report.pop('started')
+                report['rate'] = report['statements'] / report['seconds'] if report['seconds'] > 0 else None
+                logger.info("Loaded {} statements{} from {} in {:.1f}s ({:.0f} statements/s; {} part(s), {:.1f}s parsing)".format(
+                    report['statements'], " ({} new)".format(report['added']) if report['added'] is not None else "",
+                    file_name, report['seconds'], report['rate'] or 0, report['parts'], report['parse_seconds']))
+                started = finished
+                yield file_name, report
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def parallel_load(files, graph, processes=None, format=None, context=None):
+    """Parses ``files`` in a pool of ``processes`` (default: one per core) and adds their statements to ``graph``.
+
+    A QuadStore, or a graph on one, loads them with :meth:`QuadStore.load_parallel`. Any other rdflib graph gets the
+    statements (parsed into terms by the workers) in its contexts, or all in itself if it is not context aware;
+    ``context`` is the graph of the triples, as in :meth:`QuadStore.load`. Returns a report per file."""
+    store = getattr(graph, 'store', graph)
+    if isinstance(store, QuadStore):
+        return store.load_parallel(files, processes, format, context)
+
+    plans = []
+    for file_name in dict.fromkeys(os.path.abspath(file_name) for file_name in files):
+        parsed_as, line_based, appendable = file_format(file_name, format)
+        plans.append({'file': file_name, 'format': parsed_as, 'appendable': appendable, 'graph': context,
+                      'size': os.path.getsize(file_name), 'start': 0})
+    processes = processes or os.cpu_count() or 1
+
+    def merge(task, result):
+        if graph.context_aware:
+            graph.addN((s, p, o, graph.default_context if g == DATASET_DEFAULT_GRAPH_ID else graph.get_context(g))
+                       for s, p, o, g in result[0])
+        else:
+            graph.addN((s, p, o, graph) for s, p, o, g in result[0])
+        return None
+
+    return dict(run_load_tasks(load_tasks(plans, processes, as_terms=True), processes, merge))
+
+# So that rdflib callers can ask for the store by name, e.g. ConjunctiveGraph('SQLiteQuadStore')
+plugin.register('SQLiteQuadStore', Store, 'quadstore', 'QuadStore')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load RDF files into a persistent SQLite quad store")
+    parser.add_argument('store', type=str, help="The SQLite file of the store (created if it does not exist)")
+    parser.add_argument('files', metavar='file', nargs='*', type=str, help="The files to load (N-Quads, N-Triples, possibly compressed, or any format rdflib reads)")
+    parser.add_argument('--format', '-f', dest='format', default=None, type=str, help="The format of the files (guessed from the extension if not given)")
+    parser.add_argument('--graph', dest='graph', default=None, type=str, help="The graph to load triples into (default: the default graph, or a graph named after the file)")
+    parser.add_argument('--index-literals', dest='index_literals', metavar='PREDICATE', action='append', default=[], type=str, help="Index the literal values of this predicate, for exact, prefix and substring search (can be repeated)")
+    parser.add_argument('--processes', dest='processes', default='1', type=str, help="The number of processes that parse the files, or 'auto' for one per core")
+    args = parser.parse_args()
+
+    graph = URIRef(args.graph) if args.graph else None
+    processes = None if args.processes == 'auto' else int(args.processes)
+    store = QuadStore(args.store)
+    try:
+        if processes == 1:
+            for file_name in args.files:
+                store.load(file_name, args.format, graph)
+        elif args.files:
+            store.load_parallel(args.files, processes, args.format, graph)
+        for predicate in args.index_literals:
+            store.index_literals(URIRef(predicate))
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
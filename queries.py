@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+A registry of named, prepared SPARQL queries, read from .rq files.
+
+Each query in a .rq file starts with a ``# name:`` comment line; everything up to the next one is its text:
+
+    # name: medicoes_paciente
+    PREFIX : <http://www.semanticweb.org/datasharingbr#>
+    SELECT ?s ?value WHERE { ?s :hasPatient ?paciente ; schema:value ?value }
+
+A query is parsed and translated to SPARQL algebra (rdflib's prepareQuery) once, the first time it is run.
+Its variables can then be bound per call, so repeated lookups skip parsing altogether:
+
+    QUERIES = QueryRegistry('conjunctive_dtsh.rq')
+    QUERIES.query(g, 'medicoes_paciente', paciente=DTSH['123456789'])
+
+On a QuadStore with a literal index, a ``FILTER regex(?v, "text", "i")`` on the object of an indexed predicate is
+answered from the index: the (few) values the index finds are joined with the graph pattern first, instead of the
+filter testing every value of the predicate. The filter itself is kept, so the results do not change.
+"""
+
+import re
+import logging
+from rdflib import Literal, URIRef, Variable
+from rdflib.term import Node
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.sparql import Query
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.plugins.sparql.algebra import Join, ToMultiSet, Values
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+logger.addHandler(ch)
+
+_NAME = re.compile(r'^#\s*name:\s*(\S+)\s*$', re.MULTILINE)
+_VARIABLE = re.compile(r'[?$](\w+)')
+_REGEX_SPECIAL = set('.^$*+?{}[]|()\\')
+
+# A regex filter is only answered from the literal index if it finds at most this many values; joining more than
+# that with the graph pattern one by one is slower than testing them all
+INDEX_CANDIDATES = 10000
+
+
+def regex_lookup(pattern, flags=''):
+    """How the literal index finds the values that can match ``regex(?v, pattern, flags)``: a (text, match) pair for
+    QuadStore.find_literals, or None if the pattern is more than (anchored) plain text"""
+    if flags not in ('', 'i'):
+        return None
+    start = pattern.startswith('^')
+    body = pattern[1:] if start else pattern
+    end = False
+    text = []
+    escaped = False
+    for i, c in enumerate(body):
+        if escaped:
+            # \d, \w and the like are classes, not characters
+            if c.isalnum():
+                return None
+            text.append(c)
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c == '$' and i == len(body) - 1:
+            end = True
+        elif c in _REGEX_SPECIAL:
+            return None
+        else:
+            text.append(c)
+    if escaped or not text:
+        return None
+    if start and end:
+        return ''.join(text), 'folded' if flags else 'exact'
+    return ''.join(text), 'prefix' if start else 'contains'
+
+
+def _bound(term, bindings):
+    return bindings.get(term) if isinstance(term, Variable) else term
+
+
+def _object_predicates(part, variable):
+    """The predicates of which ``variable`` is the object in every solution of algebra ``part``"""
+    if part.name == 'BGP':
+        for s, p, o in part.triples:
+            if o == variable and isinstance(p, URIRef):
+                yield p
+    elif part.name == 'Join':
+        yield from _object_predicates(part.p1, variable)
+        yield from _object_predicates(part.p2, variable)
+    elif part.name in ('LeftJoin', 'Filter'):
+        yield from _object_predicates(part.p1 if part.name == 'LeftJoin' else part.p, variable)
+
+
+def _index_values(expr, part, store, bindings):
+    """For a regex filter ``expr`` on ``part`` that the literal index can answer: the filtered variable and the values
+    the index finds for it"""
+    if not isinstance(expr, CompValue) or expr.name != 'Builtin_REGEX' or not isinstance(expr.text, Variable):
+        return None
+    pattern = _bound(expr.pattern, bindings)
+    flags = _bound(expr.flags, bindings) if expr.flags is not None else Literal('')
+    if not isinstance(pattern, Literal) or not isinstance(flags, Literal):
+        return None
+    lookup = regex_lookup(str(pattern), str(flags))
+    if lookup is None:
+        return None
+    for predicate in _object_predicates(part, expr.text):
+        if store.literals_indexed(predicate):
+            values = store.find_literals(predicate, *lookup, limit=INDEX_CANDIDATES + 1)
+            if len(values) > INDEX_CANDIDATES:
+                logger.debug("regex({}, {}) matches too many values of {} to use the literal index".format(expr.text, pattern, predicate))
+                return None
+            logger.debug("regex({}, {}): {} values from the literal index of {}".format(expr.text, pattern, len(values), predicate))
+            return expr.text, values
+    return None
+
+
+def _use_literal_index(part, store, bindings):
+    """A copy of algebra ``part`` in which regex filters on indexed literals join the values from the index first,
+    or ``part`` itself if there are none"""
+    changed = {}
+    for key, value in part.items():
+        if isinstance(value, CompValue):
+            rewritten = _use_literal_index(value, store, bindings)
+            if rewritten is not value:
+                changed[key] = rewritten
+    if part.name == 'Filter':
+        filtered = changed.get('p', part.p)
+        expr = part.expr
+        conjuncts = [expr.expr] + list(expr.other) if getattr(expr, 'name', None) == 'ConditionalAndExpression' else [expr]
+        for conjunct in conjuncts:
+            found = _index_values(conjunct, filtered, store, bindings)
+            if found is not None:
+                variable, values = found
+                join = Join(ToMultiSet(Values([{variable: value} for value in values])), filtered)
+                join['lazy'] = True
+                join['_vars'] = set(filtered._vars or ()) | {variable}
+                filtered = changed['p'] = join
+    if not changed:
+        return part
+    rewritten = part.clone()
+    rewritten.update(changed)
+    return rewritten
+
+
+def use_literal_index(query, store, bindings=None):
+    """``query`` (prepared) with its regex filters answered from the literal index of ``store`` where possible"""
+    if not hasattr(store, 'find_literals'):
+        return query
+    bindings = {Variable(variable): value for variable, value in (bindings or {}).items()}
+    algebra = _use_literal_index(query.algebra, store, bindings)
+    return query if algebra is query.algebra else Query(query.prologue, algebra)
+
+
+class NamedQuery(object):
+    """A query from a .rq file, prepared on first use"""
+
+    def __init__(self, name, text, source):
+        self.name = name
+        self.text = text
+        self.source = source
+        self.variables = set(_VARIABLE.findall(text))
+        self._prepared = None
+
+    @property
+    def prepared(self):
+        if self._prepared is None:
+            try:
+                self._prepared = prepareQuery(self.text)
+            except Exception as e:
+                raise Exception("Query '{}' in {} is not valid SPARQL: {}".format(self.name, self.source, e))
+        return self._prepared
+
+
+class QueryRegistry(object):
+    """Named queries from one or more .rq files, run with bound variables"""
+
+    def __init__(self, *files):
+        self.queries = {}
+        for file_name in files:
+            self.load(file_name)
+
+    def load(self, file_name):
+        """Adds the named queries in ``file_name``; a query with the name of an earlier one replaces it"""
+        with open(file_name, 'r', encoding='utf-8') as f:
+            text = f.read()
+
+        headers = list(_NAME.finditer(text))
+        if not headers:
+            raise Exception("No named queries ('# name: ...' lines) in {}".format(file_name))
+        if text[:headers[0].start()].strip():
+            logger.warning("Ignoring the text before the first named query in {}".format(file_name))
+
+        for header, following in zip(headers, headers[1:] + [None]):
+            name = header.group(1)
+            if name in self.queries:
+                logger.warning("Query '{}' in {} replaces the one in {}".format(name, file_name, self.queries[name].source))
+            body = text[header.end():following.start() if following else len(text)]
+            self.queries[name] = NamedQuery(name, body.strip(), file_name)
+
+    def __getitem__(self, name):
+        try:
+            return self.queries[name]
+        except KeyError:
+            raise Exception("There is no query named '{}' (known queries: {})".format(name, ", ".join(sorted(self.queries))))
+
+    def __contains__(self, name):
+        return name in self.queries
+
+    def __iter__(self):
+        return iter(self.queries)
+
+    def query(self, graph, name, **bindings):
+        """Runs query ``name`` on ``graph`` with the given variables bound. Values that are not rdflib terms are
+        bound as plain literals."""
+        named = self[name]
+        unknown = set(bindings) - named.variables
+        if unknown:
+            raise Exception("Query '{}' has no variable(s) {}".format(name, ", ".join(sorted(unknown))))
+        init_bindings = {variable: value if isinstance(value, Node) else Literal(value)
+                         for variable, value in bindings.items()}
+        return graph.query(use_literal_index(named.prepared, graph.store, init_bindings), initBindings=init_bindings)
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Helpers for streaming RDF and CSV files, shared by the converter (csvw.py) and the quad store (quadstore.py):
+compressed files, N-Quads lines and literals and a process pool map with backpressure.
+
+This module only imports the standard library, so that it can be imported from within the converter package as
+well as by the scripts next to it.
+"""
+
+import os
+import re
+import codecs
+import gzip
+import bz2
+import time
+from collections import deque
+
+# The extensions of compressed files, and the name of their compression
+compressions = {'.gz': 'gzip', '.bz2': 'bz2', '.zst': 'zstd'}
+
+# A single N-Quads (or N-Triples) statement: subject, predicate, object and (optionally) graph, in their N-Quads notation
+NQUADS_STATEMENT = re.compile(r'\s*(<[^>]*>|_:\S+)\s*(<[^>]*>)\s*'
+                              r'(<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*"(?:@[A-Za-z]+(?:-[A-Za-z0-9]+)*|\^\^<[^>]*>)?)'
+                              r'\s*(<[^>]*>|_:\S+)?\s*\.\s*$')
+
+
+def quote_literal(literal):
+    """The N-Quads notation of an rdflib Literal (or anything with its ``language`` and ``datatype``), with the
+    escapes of the rdflib N-Triples serializer"""
+    encoded = '"{}"'.format(literal.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"').replace('\r', '\\r'))
+    if literal.language:
+        return "{}@{}".format(encoded, literal.language)
+    if literal.datatype:
+        return "{}^^<{}>".format(encoded, literal.datatype)
+    return encoded
+
+
+def _nt_escape(error):
+    """Writes the characters that cannot be encoded as \\uXXXX or \\UXXXXXXXX escapes, as N-Triples in ascii needs"""
+    return ''.join(('\\u{:04X}' if ord(c) <= 0xFFFF else '\\U{:08X}').format(ord(c))
+                   for c in error.object[error.start:error.end]), error.end
+
+
+# For encoding N-Triples as ascii: text.encode('ascii', 'nt_escape')
+codecs.register_error('nt_escape', _nt_escape)
+
+
+def compression_of(file_name):
+    """Returns the compression extension (``.gz``, ``.bz2`` or ``.zst``) of a file name, or None if it is not compressed"""
+    extension = os.path.splitext(file_name)[1].lower()
+    return extension if extension in compressions else None
+
+
+def open_compressed(file_name, mode='rb'):
+    """Opens a binary file, that is decompressed while reading (or compressed while writing) when its name ends in
+    ``.gz``, ``.bz2`` or ``.zst``. The streaming codecs never hold more than a block of the file in memory.
+    Zstandard needs the ``zstandard`` package."""
+    extension = compression_of(file_name)
+    if extension == '.gz':
+        # The default level (9) is several times slower than 6, for a hardly smaller file
+        return gzip.open(file_name, mode, compresslevel=6)
+    if extension == '.bz2':
+        return bz2.open(file_name, mode)
+    if extension == '.zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("Reading or writing {} needs the zstandard package (pip install zstandard)".format(file_name))
+        return zstandard.open(file_name, mode)
+    return open(file_name, mode)
+
+
+def nquads_statements(lines):
+    """Yields the (subject, predicate, object, graph) terms of every statement on the (text) ``lines`` of an N-Quads
+    or N-Triples file, the graph is None for triples"""
+    for number, line in enumerate(lines, 1):
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        match = NQUADS_STATEMENT.match(line)
+        if match is None:
+            raise Exception("Could not read N-Quads statement on line {}: {}".format(number, line.strip()))
+        yield match.groups()
+
+
+def bounded_imap(pool, func, iterable, max_inflight, metrics=None):
+    """Like ``pool.imap``, but never has more than ``max_inflight`` tasks submitted and not yet consumed.
+
+    ``pool.imap`` feeds the whole ``iterable`` to the workers as fast as it can be read, so its results
+    pile up in memory whenever the consumer is slower than the reader. Here the next item is only taken
+    from ``iterable`` once the oldest result has been handed to the consumer. Results are yielded in order.
+    The latency of every task and the number of tasks still pending are counted in ``metrics``, if given."""
+    pending = deque()
+
+    def oldest():
+        submitted, result = pending.popleft()
+        result = result.get()
+        if metrics is not None:
+            metrics.completed(time.perf_counter() - submitted, len(pending))
+        return result
+
+    for item in iterable:
+        if len(pending) >= max_inflight:
+            yield oldest()
+        pending.append((time.perf_counter(), pool.apply_async(func, (item,))))
+    while pending:
+        yield oldest()